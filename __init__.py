@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import Pool
 from .async import Async, task    # noqa
+from .scheduled import ScheduledCall
 
 
 def register():
     Pool.register(
         Async,
+        ScheduledCall,
         module='async', type_='model'
     )
@@ -0,0 +1,221 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.aio
+
+    Wait for the results of the calls from an asyncio event loop, without
+    blocking it and without a thread per pending result.
+
+    The results of all the calls awaited in a loop are polled together, in
+    as few requests to the result backend as it allows, from a thread of
+    the default executor of the loop. The polling backs off while nothing
+    completes. With a redis result backend which publishes the results
+    (celery 4 and later), the poll happens as soon as one of them is
+    published. The results of the local executors are pushed to the loop
+    when they are set.
+
+    asyncio is only available on python 3, so trollius, its backport to
+    python 2, is used. Its coroutines use `yield From(future)` instead of
+    `await future`. The results are decoded outside of the transaction of
+    the caller, so a call whose result is awaited should not return
+    records.
+"""
+import threading
+from weakref import WeakKeyDictionary
+
+from celery import states
+try:
+    import trollius as asyncio
+    from trollius import From
+except ImportError:
+    asyncio = None
+
+
+def fetch_states(results):
+    """
+    Return the status and the value of the given celery results which are
+    ready, by task id. The results are fetched with a single request if the
+    result backend supports it.
+    """
+    backend = results[0].backend
+    if hasattr(backend, 'mget') and hasattr(backend, 'get_key_for_task'):
+        keys = [backend.get_key_for_task(result.id) for result in results]
+        values = backend.mget(keys)
+        if isinstance(values, dict):
+            # The cache backends return the values by key
+            values = [values.get(key) for key in keys]
+        metas = [
+            (result, value) for result, value in zip(results, values)
+            if value is not None
+        ]
+        decode = backend.decode
+    else:
+        metas = [(result, result) for result in results if result.ready()]
+
+        def decode(result):
+            return {'status': result.status, 'result': result.result}
+
+    fetched = {}
+    for result, value in metas:
+        try:
+            meta = decode(value)
+        except Exception, exc:
+            fetched[result.id] = (states.FAILURE, exc)
+            continue
+        if meta['status'] not in states.READY_STATES:
+            continue
+        value = meta['result']
+        if meta['status'] in states.PROPAGATE_STATES and \
+                not isinstance(value, BaseException):
+            value = backend.exception_to_python(value)
+        fetched[result.id] = (meta['status'], value)
+    return fetched
+
+
+class ResultWaiter(object):
+    """
+    Wait for the results of the calls in an event loop.
+    """
+    # Bounds of the number of seconds between two polls
+    min_interval = 0.01
+    max_interval = 1
+
+    def __init__(self, loop):
+        self.loop = loop
+        # The results being polled and their futures, by task id
+        self.pending = {}
+        self.polling = False
+        self.wakeup = asyncio.Event(loop=loop)
+        self.listening = False
+
+    def wait(self, result):
+        """
+        Return a future of the value of the result.
+        """
+        if hasattr(result, 'batch_result'):
+            return self.loop.create_task(self.wait_batch_item(result))
+        future = asyncio.Future(loop=self.loop)
+        if hasattr(result, 'add_done_callback'):
+            result.add_done_callback(
+                lambda result: self.loop.call_soon_threadsafe(
+                    self.resolve_local, future, result
+                )
+            )
+        elif not hasattr(result, 'backend'):
+            # Like the results of the test mode, which are always ready
+            future.set_result(result.get())
+        else:
+            self.pending.setdefault(result.id, (result, []))[1].append(
+                future
+            )
+            self.listen(result.backend)
+            if not self.polling:
+                self.polling = True
+                self.loop.create_task(self.poll())
+        return future
+
+    def wait_batch_item(self, result):
+        entries = yield From(self.wait(result.batch_result))
+        entry = entries[result.index]
+        if entry['status'] == 'RETRY':
+            value = yield From(self.wait(result._retried_result(entry)))
+        else:
+            value = result.unwrap(entry)
+        raise asyncio.Return(value)
+
+    @staticmethod
+    def resolve(future, status, value):
+        if future.done():
+            # Cancelled
+            return
+        if status in states.PROPAGATE_STATES:
+            future.set_exception(value)
+        else:
+            future.set_result(value)
+
+    def resolve_local(self, future, result):
+        try:
+            value = result.result
+        except Exception, exc:
+            status, value = states.FAILURE, exc
+        else:
+            status = result.status
+        self.resolve(future, status, value)
+
+    def poll(self):
+        interval = self.min_interval
+        try:
+            while self.pending:
+                results = [result for result, _ in self.pending.values()]
+                fetched = yield From(self.loop.run_in_executor(
+                    None, fetch_states, results
+                ))
+                for task_id, (status, value) in fetched.iteritems():
+                    _, futures = self.pending.pop(task_id)
+                    for future in futures:
+                        self.resolve(future, status, value)
+                if fetched:
+                    interval = self.min_interval
+                else:
+                    interval = min(self.max_interval, interval * 2)
+                self.wakeup.clear()
+                try:
+                    yield From(asyncio.wait_for(
+                        self.wakeup.wait(), interval, loop=self.loop
+                    ))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.polling = False
+
+    def listen(self, backend):
+        """
+        Wake the polling up when a pending result is published by the
+        result backend, if it publishes them.
+        """
+        if self.listening:
+            return
+        self.listening = True
+        client = getattr(backend, 'client', None)
+        if not hasattr(backend, 'ResultConsumer') or \
+                not hasattr(client, 'pubsub'):
+            return
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        prefix = backend.get_key_for_task('')
+        pubsub.psubscribe(prefix + '*')
+
+        def run():
+            for message in pubsub.listen():
+                task_id = message['channel'][len(prefix):]
+                if task_id in self.pending:
+                    self.loop.call_soon_threadsafe(self.wakeup.set)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+_waiters = WeakKeyDictionary()
+
+
+def wait(result, loop=None):
+    """
+    Return a future of the value of the result of a call, which can be
+    awaited in the event loop. A failed call raises its exception.
+    """
+    if asyncio is None:
+        raise RuntimeError('trollius is required to wait in an event loop')
+    loop = loop or asyncio.get_event_loop()
+    waiter = _waiters.get(loop)
+    if waiter is None:
+        waiter = _waiters[loop] = ResultWaiter(loop)
+    return waiter.wait(result)
+
+
+def gather(results, loop=None):
+    """
+    Return a future of the list of the values of the results, like the
+    results of `Async.apply_async_many` or `Async.map`.
+    """
+    loop = loop or asyncio.get_event_loop()
+    return asyncio.gather(
+        *[wait(result, loop) for result in results], loop=loop
+    )
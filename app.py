@@ -12,6 +12,7 @@
 from __future__ import absolute_import
 
 import os
+from datetime import timedelta
 
 from celery import Celery
 from trytond.config import config
@@ -28,6 +29,28 @@ else:
 config.update_etc()
 
 
+def parse_routes(value):
+    """
+    Parse the `routes` setting, which has one `<key> = <queue>` route per
+    line. The key is a model name or a model name followed by the name of a
+    method, optionally prefixed by the name of a database and a colon. A
+    route for all the calls in a database has the key `<database>:*`.
+    For example::
+
+        [async]
+        routes =
+            ir.ui.view = bulk
+            sale.sale.process = interactive
+            demo:* = demo
+    """
+    routes = {}
+    for line in value.splitlines():
+        if '=' in line:
+            key, queue = line.split('=', 1)
+            routes[key.strip()] = queue.strip()
+    return routes
+
+
 broker_url = config.get('async', 'broker_url')
 backend_url = config.get('async', 'backend_url')
 
@@ -38,14 +61,198 @@ app = Celery(
     include=['trytond_async.tasks']
 )
 
+# The serializer of the messages and of the payloads they carry, either
+# 'tryson' or 'tryson-msgpack'
+serializer = config.get('async', 'serializer', default='tryson')
+
 app.conf.update(
     CELERY_TASK_RESULT_EXPIRES=3600,
-    CELERY_TASK_SERIALIZER='tryson',
-    CELERY_RESULT_SERIALIZER='tryson',
+    CELERY_TASK_SERIALIZER=serializer,
+    CELERY_RESULT_SERIALIZER=serializer,
     CELERY_ACCEPT_CONTENT=[
         'application/x-tryson',
+        'application/x-tryson-msgpack',
         'application/x-python-serialize'
-    ]
+    ],
+    # Maximum number of seconds a worker trusts its cache of a database
+    # without cleaning it, even if no invalidation was seen.
+    ASYNC_CACHE_CLEAN_INTERVAL=config.getfloat(
+        'async', 'cache_clean_interval', default=300
+    ),
+    # Payloads larger than this number of bytes are compressed with zlib.
+    # Compression is disabled with 0, which is the default so that workers
+    # of older versions can still read all the messages.
+    ASYNC_COMPRESSION_THRESHOLD=config.getint(
+        'async', 'compression_threshold', default=0
+    ),
+    # Binary arguments and payloads larger than this number of bytes are
+    # moved to the payload store and only their reference is sent through
+    # the broker. Disabled with 0.
+    ASYNC_PAYLOAD_STORE_THRESHOLD=config.getint(
+        'async', 'payload_store_threshold', default=0
+    ),
+    # Number of seconds after which data left in the payload store by
+    # tasks which never completed is collected.
+    ASYNC_PAYLOAD_STORE_MAX_AGE=config.getint(
+        'async', 'payload_store_max_age', default=7 * 24 * 60 * 60
+    ),
+    # The url of the redis database which holds the state shared by the
+    # workers, like pending deduplicated tasks. Without it, the features
+    # using the shared state are refused, unless in the test mode or with a
+    # local executor.
+    ASYNC_COORDINATION_URL=config.get(
+        'async', 'coordination_url',
+        default=backend_url or os.environ.get('TRYTOND_ASYNC__BACKEND_URL')
+    ),
+    # Number of seconds after which a pending deduplicated task is
+    # forgotten if it was never executed.
+    ASYNC_DEDUPE_TTL=config.getint('async', 'dedupe_ttl', default=3600),
+    # Number of seconds after which a concurrency lease taken by a task is
+    # released if the worker did not release it, for example because it
+    # was killed.
+    ASYNC_LEASE_TTL=config.getint('async', 'lease_ttl', default=300),
+    # Number of seconds after which a task rejected by its concurrency
+    # limit is executed again, on average.
+    ASYNC_LIMIT_RETRY_DELAY=config.getfloat(
+        'async', 'limit_retry_delay', default=1
+    ),
+    # Number of seconds during which the progress of a job started with
+    # `Async.map` is kept after its last completed chunk.
+    ASYNC_MAP_TTL=config.getint('async', 'map_ttl', default=24 * 60 * 60),
+    # Number of partition queues of the calls routed by affinity. Calls
+    # with the same affinity key, like calls on the same record, are always
+    # sent to the same partition. Each partition queue should be consumed
+    # by a single worker process, for example with:
+    #   celery worker -A trytond_async.tasks -Q trytond_async.affinity.0 -c 1
+    # Routing by affinity is disabled with 0.
+    ASYNC_AFFINITY_PARTITIONS=config.getint(
+        'async', 'affinity_partitions', default=0
+    ),
+    # The prefix of the names of the partition queues
+    ASYNC_AFFINITY_QUEUE=config.get(
+        'async', 'affinity_queue', default='trytond_async.affinity'
+    ),
+    # The queues to which the calls are routed by model and method, unless
+    # a queue is given for the call.
+    ASYNC_ROUTES=parse_routes(config.get('async', 'routes', default='')),
+    # If set, the keys of the context of the calls whose value is the
+    # preference of the user are not sent, and the workers add back the
+    # preferences of the user. Workers of older versions can not execute
+    # these calls.
+    ASYNC_MINIMISE_CONTEXT=config.getboolean(
+        'async', 'minimise_context', default=False
+    ),
+    # If set, the contexts of the calls are stored in the shared state of
+    # the `coordination_url` setting, and only their fingerprint is sent.
+    ASYNC_CONTEXT_FINGERPRINT=config.getboolean(
+        'async', 'context_fingerprint', default=False
+    ),
+    # Number of seconds during which a context is kept in the shared state
+    # after the last call sent with it. Calls executed later fail.
+    ASYNC_CONTEXT_TTL=config.getint(
+        'async', 'context_ttl', default=7 * 24 * 60 * 60
+    ),
+    # Number of decoded contexts cached by each process
+    ASYNC_CONTEXT_CACHE_SIZE=config.getint(
+        'async', 'context_cache_size', default=1024
+    ),
+    # Calls delayed by at least this number of seconds, like retries with
+    # a long backoff, are kept in the `async.scheduled` table until they
+    # are due instead of waiting in the memory of a worker as messages with
+    # an ETA. They are published by the `publish_scheduled` task, which is
+    # run by celery beat for the `scheduler_databases`, for example with:
+    #   celery beat -A trytond_async.tasks
+    # Disabled with 0.
+    ASYNC_SCHEDULE_THRESHOLD=config.getint(
+        'async', 'schedule_threshold', default=0
+    ),
+    # Number of seconds between two runs of `publish_scheduled`. The calls
+    # due before the next run are sent with their ETA.
+    ASYNC_SCHEDULER_INTERVAL=config.getfloat(
+        'async', 'scheduler_interval', default=1
+    ),
+    # Maximum number of scheduled calls sent in one transaction
+    ASYNC_SCHEDULER_BATCH_SIZE=config.getint(
+        'async', 'scheduler_batch_size', default=1000
+    ),
+    ASYNC_SCHEDULER_DATABASES=config.get(
+        'async', 'scheduler_databases', default=''
+    ).replace(',', ' ').split(),
+    # The directory to which each worker process writes its metrics in the
+    # text format of Prometheus, for the textfile collector of the node
+    # exporter, in a file named after the id of the process. Disabled if
+    # empty.
+    ASYNC_METRICS_PATH=config.get('async', 'metrics_path', default=''),
+    # Minimum number of seconds between two writes of the metrics file
+    ASYNC_METRICS_INTERVAL=config.getfloat(
+        'async', 'metrics_interval', default=15
+    ),
+    # If set, each child process of the worker serves its metrics over
+    # HTTP on localhost, on this port plus the index of the child.
+    ASYNC_METRICS_PORT=config.getint('async', 'metrics_port', default=0),
+    # The fraction of the calls which are profiled by the workers, between
+    # 0 and 1, see `trytond_async.profiling`.
+    ASYNC_PROFILE_RATE=config.getfloat('async', 'profile_rate', default=0),
+    # The model.methods whose calls are all profiled
+    ASYNC_PROFILE_TASKS=config.get(
+        'async', 'profile_tasks', default=''
+    ).replace(',', ' ').split(),
+    # How the calls are profiled: 'cprofile' or 'sampler', which samples
+    # the stack of the calls executed in the main thread of the process.
+    ASYNC_PROFILER=config.get('async', 'profiler', default='cprofile'),
+    # The directory of the profiles, by default `async_profiles` in the
+    # directory of the databases.
+    ASYNC_PROFILE_PATH=config.get('async', 'profile_path', default=''),
+    # Maximum number of profile files kept in the directory
+    ASYNC_PROFILE_MAX_FILES=config.getint(
+        'async', 'profile_max_files', default=100
+    ),
+    # Minimum number of seconds between two writes of the profiles
+    ASYNC_PROFILE_FLUSH_INTERVAL=config.getfloat(
+        'async', 'profile_flush_interval', default=60
+    ),
+    # How the calls are executed: 'celery' sends them to the workers
+    # through the broker, 'thread' and 'process' run them on this machine
+    # in a pool of threads or of processes, without a broker.
+    ASYNC_EXECUTOR=config.get('async', 'executor', default='celery'),
+    # Number of threads or processes of the local executors, by default
+    # one per CPU.
+    ASYNC_EXECUTOR_WORKERS=config.getint(
+        'async', 'executor_workers', default=0
+    ),
+    # Number of finished results kept by the local executors once nothing
+    # holds them, so that they can still be read by the id of their call.
+    ASYNC_EXECUTOR_RESULTS=config.getint(
+        'async', 'executor_results', default=10000
+    ),
+    # Maximum number of database pools kept by each worker process. The
+    # least recently used pools are released over it. Unlimited with 0.
+    ASYNC_MAX_POOLS=config.getint('async', 'max_pools', default=0),
+    # Maximum memory, in megabytes, taken by the database pools kept by each
+    # worker process, as measured when they are initialised. The least
+    # recently used pools are released over it. Unlimited with 0.
+    ASYNC_MAX_POOLS_MEMORY=config.getint(
+        'async', 'max_pools_memory', default=0
+    ),
+    # Maximum number of calls executed at once on a database by all the
+    # workers, so that a busy database does not starve the others. The
+    # calls over it are requeued. Unlimited with 0.
+    ASYNC_DATABASE_MAX_CONCURRENCY=config.getint(
+        'async', 'database_max_concurrency', default=0
+    ),
+    # Databases whose pool is initialised by the worker before it forks
+    # its children, so that they share it copy-on-write.
+    ASYNC_PRELOAD_DATABASES=config.get(
+        'async', 'preload_databases', default=''
+    ).replace(',', ' ').split(),
+)
+
+app.conf.CELERYBEAT_SCHEDULE = dict(
+    ('trytond_async.publish_scheduled.%s' % database, {
+        'task': 'trytond_async.tasks.publish_scheduled',
+        'schedule': timedelta(seconds=app.conf.ASYNC_SCHEDULER_INTERVAL),
+        'args': (database,),
+    }) for database in app.conf.ASYNC_SCHEDULER_DATABASES
 )
 
 if __name__ == '__main__':
@@ -7,6 +7,10 @@
     tryton developers are familiar with while making it possible to still
     customize behavior.
 """
+import time
+import zlib
+import hashlib
+import logging
 from uuid import uuid4
 from celery import current_app
 
@@ -14,12 +18,20 @@ import wrapt
 from trytond.pool import PoolMeta, Pool
 from trytond.model import ModelView, Model
 from trytond.transaction import Transaction
-from trytond_async.serialization import json, JSONDecoder, JSONEncoder
-from trytond_async.tasks import execute
+from trytond_async import metrics, coordination, aio, context
+from trytond_async.executors import get_executor
+from trytond_async.payloadstore import store, store_buffers, StoredValue
+from trytond_async.scheduled import get_due
+from trytond_async.serialization import json, json_loads, JSONDecoder, \
+    JSONEncoder, CompressedValue, msgpack_dumps, msgpack_loads
+from trytond_async.tasks import execute, execute_ignore_result, \
+    execute_batch, map_key, finish_map
 
 
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
 
 class task(object):
     """
@@ -35,10 +47,51 @@ class task(object):
     the method `defer` in the model `async.async`. Most of the task deferring
     code itself is implemented there for convenience.
     """
+    # The options which apply to calls sent in batches
+    batch_options = ('after_commit', 'queue', 'priority')
 
-    def __init__(self, ignore_result=True, visibility_timeout=60):
+    def __init__(
+            self, ignore_result=True, visibility_timeout=60,
+            after_commit=False, dedupe_key=None, debounce=0,
+            max_concurrency=None, rate=None, affinity=None,
+            retry_policy=None, queue=None, priority=None,
+            result_expires=None, compress_result=None, store_result=None):
         self.ignore_result = ignore_result
         self.visibility_timeout = visibility_timeout
+        self.after_commit = after_commit
+        self.dedupe_key = dedupe_key
+        self.debounce = debounce
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.affinity = affinity
+        self.retry_policy = retry_policy
+        self.queue = queue
+        self.priority = priority
+        self.result_expires = result_expires
+        self.compress_result = compress_result
+        self.store_result = store_result
+
+    def get_options(self):
+        """
+        Return the options of the deferred calls, which are passed to
+        `apply_async` as keyword arguments. They can be overridden for a
+        single call with the `_defer_options_` keyword argument.
+        """
+        return {
+            'ignore_result': self.ignore_result,
+            'after_commit': self.after_commit,
+            'dedupe_key': self.dedupe_key,
+            'debounce': self.debounce,
+            'max_concurrency': self.max_concurrency,
+            'rate': self.rate,
+            'affinity': self.affinity,
+            'retry_policy': self.retry_policy,
+            'queue': self.queue,
+            'priority': self.priority,
+            'result_expires': self.result_expires,
+            'compress_result': self.compress_result,
+            'store_result': self.store_result,
+        }
 
     @wrapt.decorator
     def __call__(self, wrapped, instance, args, kwargs, **celery_options):
@@ -46,10 +99,15 @@ class task(object):
         Read the docstring of this class before you decide to reimplement this.
         change the behavior in the `defer` method of `async.async` model.
         """
-        if kwargs.pop('_defer_', False) is False:
+        calls = kwargs.pop('_defer_many_', None)
+        options = kwargs.pop('_defer_options_', {})
+        if kwargs.pop('_defer_', False) is False and calls is None:
             # if not a deferred call, return instantly
             return wrapped(*args, **kwargs)
 
+        options = dict(self.get_options(), **options)
+        options.update(celery_options)
+
         # This is a defered call
         model_name = instance.__name__
         if isinstance(instance, Model):
@@ -58,13 +116,25 @@ class task(object):
             active_record = None
 
         Async = Pool().get('async.async')
+        if calls is not None:
+            # Bulk form: `_defer_many_` is a list of (args, kwargs) pairs,
+            # each of which is one deferred call of the method. Only some
+            # of the options apply to calls sent in batches.
+            return Async.apply_async_many([
+                (model_name, wrapped.__name__, active_record,
+                    call_args, call_kwargs)
+                for call_args, call_kwargs in calls
+            ], **dict(
+                (key, options[key]) for key in options
+                if key in self.batch_options
+            ))
         return Async.apply_async(
             model=model_name,
             method=wrapped.__name__,
             instance=active_record,
             args=args,
             kwargs=kwargs,
-            **celery_options
+            **options
         )
 
 
@@ -72,16 +142,311 @@ class MockResult(object):
     """
     A fake object that mimics the result object.
     """
+    status = 'SUCCESS'
+
     def __init__(self, result):
         self.id = unicode(uuid4())
         self.result = result
 
+    def ready(self):
+        return True
+
     def get(self, *args, **kwargs):
         return self.result
 
     wait = get  # Deprecated old syntax
 
 
+class BatchPayloadError(Exception):
+    """
+    Raised when waiting on the result of a call of a batch which failed
+    on the worker. The other calls of the batch are not affected.
+    """
+    def __init__(self, exc_type, exc_message):
+        super(BatchPayloadError, self).__init__(
+            '%s: %s' % (exc_type, exc_message)
+        )
+        self.exc_type = exc_type
+        self.exc_message = exc_message
+
+
+class BatchItemResult(object):
+    """
+    The result of a single call dispatched as part of a batch. The batch is
+    executed by one `execute_batch` task whose result has one entry per
+    call, and this object picks its own entry out of it.
+    """
+    def __init__(self, batch_result, index):
+        self.batch_result = batch_result
+        self.index = index
+        self.id = u'%s:%d' % (batch_result.id, index)
+
+    @staticmethod
+    def _retried_result(entry):
+        return get_executor().result(execute, entry['task_id'])
+
+    @classmethod
+    def unwrap(cls, entry, *args, **kwargs):
+        """
+        Return the value of the given entry of a batch result, waiting for
+        the retry if the call was retried on its own.
+        """
+        if entry['status'] == 'RETRY':
+            return cls._retried_result(entry).get(*args, **kwargs)
+        if entry['status'] == 'FAILURE':
+            raise BatchPayloadError(entry['exc_type'], entry['exc_message'])
+        return entry['result']
+
+    @property
+    def status(self):
+        if not self.batch_result.ready() or \
+                self.batch_result.status != 'SUCCESS':
+            return self.batch_result.status
+        entry = self.batch_result.result[self.index]
+        if entry['status'] == 'RETRY':
+            return self._retried_result(entry).status
+        return entry['status']
+
+    def ready(self):
+        return self.status in ('SUCCESS', 'FAILURE')
+
+    @property
+    def result(self):
+        entry = self.batch_result.result[self.index]
+        if entry['status'] == 'RETRY':
+            return self._retried_result(entry).result
+        if entry['status'] == 'FAILURE':
+            return BatchPayloadError(entry['exc_type'], entry['exc_message'])
+        return entry['result']
+
+    def get(self, *args, **kwargs):
+        return self.unwrap(
+            self.batch_result.get(*args, **kwargs)[self.index],
+            *args, **kwargs
+        )
+
+    wait = get  # Deprecated old syntax
+
+
+class BatchResult(object):
+    """
+    A group-style result handle returned by `Async.apply_async_many`. It
+    behaves like a list of the results of the individual calls, in the
+    order in which they were given.
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    def ready(self):
+        return all(result.ready() for result in self.results)
+
+    def get(self, *args, **kwargs):
+        """
+        Wait for all the calls and return the list of their results
+        """
+        values, batches = [], {}
+        for result in self.results:
+            batch_result = getattr(result, 'batch_result', None)
+            if batch_result is None:
+                values.append(result.get(*args, **kwargs))
+                continue
+            # Fetch each batch only once, not once per call in it
+            if batch_result.id not in batches:
+                batches[batch_result.id] = batch_result.get(*args, **kwargs)
+            values.append(result.unwrap(
+                batches[batch_result.id][result.index], *args, **kwargs
+            ))
+        return values
+
+    join = get
+
+
+class MapResult(object):
+    """
+    The handle of a job started by `Async.map`. It behaves like the list of
+    the results of its chunks, in the order of the chunks, and gives the
+    progress of the job while it runs.
+
+    :param reduced: The result of the reducer, if any.
+    """
+    def __init__(self, job_id, key, results, reduced=None):
+        self.id = job_id
+        self.key = key
+        self.results = results
+        self.reduced = reduced
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    def progress(self):
+        """
+        Return the number of chunks of the job which are done, which
+        failed, and in total, as a dictionary. This reads shared counters
+        only and does not query the result of each chunk.
+        """
+        state = coordination.get_backend()
+        return {
+            'done': int(state.get(self.key + ':done') or 0),
+            'failed': int(state.get(self.key + ':failed') or 0),
+            'total': len(self.results),
+        }
+
+    def ready(self):
+        progress = self.progress()
+        return progress['done'] + progress['failed'] >= progress['total']
+
+    def get(self, *args, **kwargs):
+        """
+        Wait for all the chunks and return the list of their results
+        """
+        return [result.get(*args, **kwargs) for result in self.results]
+
+    join = get
+
+
+def task_name(payload):
+    """
+    Return the name of the task of the payload, used to label metrics.
+    """
+    return '%s.%s' % (payload['model_name'], payload['method_name'])
+
+
+class DispatchDataManager(object):
+    """
+    A Tryton data manager which buffers the calls deferred after commit in
+    a transaction. They are published once the transaction is committed,
+    grouped in as few batches as possible, and dropped if it is rolled back.
+    """
+    chunk_size = 500
+
+    def __init__(self):
+        self.batches = []
+        self.deduplicated = {}
+
+    def __eq__(self, other):
+        # There is only one per transaction
+        return isinstance(other, DispatchDataManager)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def put(self, payload, celery_options, dedupe_key=None):
+        """
+        Buffer the payload and return its result handle.
+
+        Payloads are grouped in batches of the same context and celery
+        options. The ids of the batch tasks are chosen now, so that the
+        result can be returned before the task is sent.
+
+        Payloads with the same deduplication key are coalesced within the
+        transaction.
+        """
+        if dedupe_key in self.deduplicated:
+            metrics.incr('task_coalesced', task=task_name(payload))
+            return self.deduplicated[dedupe_key]
+        context = payload.pop('context')
+        for batch in reversed(self.batches):
+            if batch['context'] == context and \
+                    batch['options'] == celery_options and \
+                    len(batch['payloads']) < self.chunk_size:
+                break
+        else:
+            batch = {
+                'task_id': unicode(uuid4()),
+                'context': context,
+                'options': celery_options,
+                'payloads': [],
+            }
+            self.batches.append(batch)
+        batch['payloads'].append(payload)
+        result = BatchItemResult(
+            get_executor().result(execute_batch, batch['task_id']),
+            len(batch['payloads']) - 1
+        )
+        if dedupe_key:
+            self.deduplicated[dedupe_key] = result
+        return result
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        Async = Pool().get('async.async')
+        batches, self.batches = self.batches, []
+        self.deduplicated = {}
+        for batch in batches:
+            # The transaction is committed already, so a batch which can
+            # not be sent must not fail the commit nor the other batches.
+            try:
+                Async.send_payload(execute_batch, {
+                    'context': batch['context'],
+                    'payloads': batch['payloads'],
+                }, task_id=batch['task_id'], **batch['options'])
+            except Exception:
+                logger.exception(
+                    'Could not send the batch %s of %d calls after commit',
+                    batch['task_id'], len(batch['payloads'])
+                )
+                metrics.incr('batch_send_failed')
+
+    def tpc_abort(self, trans):
+        self.batches = []
+        self.deduplicated = {}
+
+    abort = tpc_abort
+
+
+def join_datamanager():
+    """
+    Return the `DispatchDataManager` of the current transaction, joining a
+    new one to it the first time.
+
+    Tryton 3.4 transactions do not support data managers, so the commit and
+    the rollback of the cursor of the transaction are wrapped to finish or
+    abort the data manager instead.
+    """
+    transaction = Transaction()
+    if hasattr(transaction, 'join'):
+        return transaction.join(DispatchDataManager())
+    cursor = transaction.cursor
+    datamanager = getattr(cursor, 'async_datamanager', None)
+    if datamanager is not None:
+        return datamanager
+    datamanager = cursor.async_datamanager = DispatchDataManager()
+    commit, rollback = cursor.commit, cursor.rollback
+
+    def commit_and_dispatch():
+        commit()
+        datamanager.tpc_finish(transaction)
+
+    def rollback_and_drop():
+        rollback()
+        datamanager.tpc_abort(transaction)
+    cursor.commit, cursor.rollback = commit_and_dispatch, rollback_and_drop
+    return datamanager
+
+
 class Async(ModelView):
     """
     Asynchronous Execution Helper.
@@ -106,10 +471,47 @@ class Async(ModelView):
             return getattr(instance, method)(*args, **kwargs)
         return getattr(Pool().get(model), method)(*args, **kwargs)
 
+    @classmethod
+    def build_payload(
+            cls, method, model=None, instance=None, args=None, kwargs=None):
+        """
+        Build the payload for a call of the given method. The payload does
+        not include the transaction context, which is added by the
+        dispatching method.
+
+        The arguments have the same meaning as the ones of `apply_async`.
+        """
+        if isinstance(method, basestring):
+            method_name = method
+        else:
+            method_name = method.__name__
+
+        if isinstance(model, basestring):
+            model_name = model
+        elif model:
+            model_name = model.__name__
+        else:
+            model_name = None
+
+        if isinstance(instance, Model):
+            model_name = instance.__name__
+
+        return {
+            'model_name': model_name,
+            'instance': instance,
+            'method_name': method_name,
+            'args': args or [],
+            'kwargs': kwargs or {},
+        }
+
     @classmethod
     def apply_async(
             cls, method, model=None, instance=None,
-            args=None, kwargs=None, **celery_options):
+            args=None, kwargs=None, after_commit=False, dedupe_key=None,
+            debounce=0, max_concurrency=None, rate=None, affinity=None,
+            retry_policy=None, queue=None, priority=None,
+            ignore_result=False, result_expires=None, compress_result=None,
+            store_result=None, **celery_options):
         """Wrapper for painless asynchronous dispatch of method
         inside given model.
 
@@ -126,56 +528,562 @@ class Async(ModelView):
                          if it is an instance
         :param args: positional arguments passed on to method as list/tuple.
         :param kwargs: keyword arguments passed on to method as dict.
+        :param after_commit: If True, the call is only sent once the current
+                             transaction is committed, in a batch with the
+                             other calls deferred after commit.
+        :param dedupe_key: If set, the call is coalesced into the pending
+                           call with the same key, if any. True derives the
+                           key from the call and its context. Calls
+                           deferred after commit are only coalesced with
+                           the calls of the same transaction.
+        :param debounce: Number of seconds without a new call with the
+                         same `dedupe_key` after which the call is
+                         executed.
+        :param max_concurrency: Maximum number of calls of the method which
+                                are executed at the same time by all the
+                                workers.
+        :param rate: Maximum number of calls of the method per second.
+                     Calls over the limits are requeued by the workers.
+                     The limits do not apply to calls deferred after
+                     commit, which are executed in batches.
+        :param affinity: If set, the call is sent to the partition queue of
+                         the affinity key so that calls with the same key
+                         are executed one after the other. True uses the
+                         instance as key, which must be a saved record.
+        :param retry_policy: The :class:`RetryPolicy` of the call.
+        :param queue: The queue to which the call is sent, or a dictionary
+                      of queues by database name. By default the call is
+                      routed by affinity if requested, or else by the
+                      `routes` setting.
+        :param priority: The priority of the call, if the broker supports
+                         it.
+        :param ignore_result: If True, the result of the call is not
+                              written to the result backend and the
+                              returned result stays pending.
+        :param result_expires: Number of seconds after which the result of
+                               the call expires, if the result backend
+                               supports it.
+        :param compress_result: Results larger than this number of bytes
+                                are compressed with zlib in the result
+                                backend.
+        :param store_result: Results larger than this number of bytes are
+                             moved to the payload store and only their
+                             reference is kept in the result backend.
         :returns :class:`AsyncResult`:
         """
-        if isinstance(method, basestring):
-            method_name = method
-        else:
-            method_name = method.__name__
+        if affinity is True:
+            if instance is None or instance.id is None:
+                raise ValueError(
+                    'The affinity of the call of %s can not be its instance '
+                    'without a saved instance, give a key instead' % method
+                )
+            affinity = '%s,%s' % (instance.__name__, instance.id)
+        payload = cls.build_payload(method, model, instance, args, kwargs)
+        if retry_policy:
+            payload['retry_policy'] = retry_policy.to_dict()
+        if max_concurrency or rate:
+            payload['limits'] = {
+                'max_concurrency': max_concurrency,
+                'rate': rate,
+            }
+        if result_expires or compress_result or store_result:
+            payload['result_policy'] = {
+                'expires': result_expires,
+                'compress_threshold': compress_result,
+                'store_threshold': store_result,
+            }
+
+        if current_app.conf.get('TEST_MODE', False):
+            return MockResult(cls.execute_payload(payload))
 
+        payload['context'] = Transaction().context
+        if priority is not None:
+            celery_options['priority'] = priority
+        queue = cls.get_queue(queue)
+        if not queue and affinity:
+            queue = cls.get_affinity_queue(affinity)
+        if not queue:
+            queue = cls.get_route(payload)
+        if queue:
+            celery_options.setdefault('queue', queue)
+        if dedupe_key:
+            dedupe_key = cls.get_dedupe_key(payload, dedupe_key)
+        if after_commit:
+            return join_datamanager().put(
+                payload, celery_options, dedupe_key
+            )
+        task = execute_ignore_result if ignore_result else execute
+        if dedupe_key:
+            return cls.send_deduplicated(
+                payload, dedupe_key, debounce, task, **celery_options
+            )
+        return cls.send_payload(task, payload, **celery_options)
+
+    @classmethod
+    def map(
+            cls, model, method, ids=None, domain=None, chunk_size=1000,
+            reducer=None, args=None, kwargs=None, **celery_options):
+        """
+        Call a method on a large set of records in chunks. The method is
+        called once per chunk, as `method(records, *args, **kwargs)`, and
+        each chunk is sent as its own call as soon as it is read so that
+        the records are never all loaded.
+
+        :param model: String representing global name of the model or
+                      reference to model class itself.
+        :param method: Name of the method
+        :param ids: A list of ids of the records. No call is made if it is
+                    empty.
+        :param domain: A domain of the records, instead of their ids.
+        :param chunk_size: Number of records per call.
+        :param reducer: Name of a method of the model called with the list
+                        of the results of the chunks, in the order of the
+                        chunks, once they all succeeded.
+        :param args: Additional positional arguments of the method.
+        :param kwargs: Keyword arguments of the method.
+        :returns :class:`MapResult`:
+        """
+        if (ids is None) == (domain is None):
+            raise ValueError('Either the ids or the domain must be given')
         if isinstance(model, basestring):
-            model_name = model
-        elif model:
-            model_name = model.__name__
+            Model = Pool().get(model)
         else:
-            model_name = None
+            Model = model
+        transaction = Transaction()
+        database = transaction.cursor.database_name
+        job_id = unicode(uuid4())
+        key = map_key(database, job_id)
+        state = coordination.get_backend()
+        ttl = current_app.conf.ASYNC_MAP_TTL
+        test_mode = current_app.conf.get('TEST_MODE', False)
 
-        if isinstance(instance, Model):
-            model_name = instance.__name__
+        queue = cls.get_queue(celery_options.pop('queue', None)) or \
+            cls.get_route(cls.build_payload(method, Model))
+        if queue:
+            celery_options['queue'] = queue
+        if reducer and not test_mode:
+            # The reducer is sent by the worker of the last chunk
+            payload = cls.build_payload(reducer, Model)
+            payload['context'] = transaction.context
+            payload['map_reduce'] = {'key': key, 'job_id': job_id}
+            data, options = cls.encode_payload(
+                payload, celery_options.get('serializer')
+            )
+            state.set(key + ':reducer', json.dumps({
+                'database': database,
+                'user': transaction.user,
+                'data': data,
+                'options': options,
+                'task_id': u'%s-reduce' % job_id,
+                'celery_options': celery_options,
+            }, cls=JSONEncoder), ttl)
+
+        results = []
+        for index, chunk in enumerate(
+                cls.iter_chunks(Model, ids, domain, chunk_size)):
+            payload = cls.build_payload(
+                method, Model, args=[chunk] + list(args or []), kwargs=kwargs
+            )
+            if test_mode:
+                results.append(MockResult(cls.execute_payload(payload)))
+                state.incr(key + ':done', ttl)
+                continue
+            payload['context'] = transaction.context
+            payload['map'] = {'key': key}
+            results.append(cls.send_payload(
+                execute, payload, task_id=u'%s-%d' % (job_id, index),
+                **celery_options
+            ))
+        state.set(key + ':total', len(results), ttl)
+
+        reduced = None
+        if reducer and test_mode:
+            reduced = MockResult(
+                getattr(Model, reducer)([r.result for r in results])
+            )
+        elif reducer:
+            reduced = get_executor().result(
+                execute, u'%s-reduce' % job_id
+            )
+            # All the chunks may have completed already
+            finish_map(key)
+        return MapResult(job_id, key, results, reduced)
+
+    @classmethod
+    def iter_chunks(cls, Model, ids, domain, chunk_size):
+        """
+        Yield the records of the list of ids, or else of the domain, in
+        lists of `chunk_size` records. The records of a domain are searched
+        page by page, in the order of their ids and from the last id of the
+        previous page, so that each page is as fast as the first one.
+        """
+        if ids is not None:
+            for start in xrange(0, len(ids), chunk_size):
+                yield Model.browse(ids[start:start + chunk_size])
+            return
+        last_id = 0
+        while True:
+            chunk = Model.search(
+                [domain, ('id', '>', last_id)],
+                order=[('id', 'ASC')], limit=chunk_size
+            )
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1].id
+
+    @classmethod
+    def apply_async_aio(cls, *args, **kwargs):
+        """
+        Same as `apply_async`, but return a future of the value returned by
+        the call, which can be awaited in an asyncio event loop without
+        blocking it. The call is sent right away, in the transaction.
+
+        :param loop: The event loop, by default the current one.
+        """
+        loop = kwargs.pop('loop', None)
+        return aio.wait(cls.apply_async(*args, **kwargs), loop)
+
+    @classmethod
+    def get_queue(cls, queue):
+        """
+        Return the queue for the database of the transaction, if `queue` is
+        a dictionary of queues by database name.
+        """
+        if isinstance(queue, dict):
+            return queue.get(Transaction().cursor.database_name)
+        return queue
+
+    @classmethod
+    def get_route(cls, payload):
+        """
+        Return the queue of the payload in the `routes` setting, or None.
+        The most specific route wins: the routes of the database before the
+        others, and the routes of the method before the ones of the model.
+        """
+        routes = current_app.conf.ASYNC_ROUTES
+        if not routes:
+            return None
+        database = Transaction().cursor.database_name
+        model, method = payload['model_name'], payload['method_name']
+        for key in (
+                '%s:%s.%s' % (database, model, method),
+                '%s:%s' % (database, model),
+                '%s:*' % database,
+                '%s.%s' % (model, method),
+                model):
+            if key in routes:
+                return routes[key]
+        return None
+
+    @classmethod
+    def get_affinity_queue(cls, key):
+        """
+        Return the name of the partition queue of the affinity key, or None
+        if routing by affinity is disabled.
+        """
+        partitions = current_app.conf.ASYNC_AFFINITY_PARTITIONS
+        if not partitions:
+            return None
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, str):
+            key = str(key)
+        # crc32 is the same in all processes, unlike hash
+        partition = (zlib.crc32(key) & 0xffffffff) % partitions
+        return '%s.%d' % (current_app.conf.ASYNC_AFFINITY_QUEUE, partition)
+
+    @classmethod
+    def get_dedupe_key(cls, payload, dedupe_key):
+        """
+        Return the key in the shared state of the deduplication key of the
+        payload. If the key is True, it is derived from the call and its
+        context.
+        """
+        transaction = Transaction()
+        if dedupe_key is True:
+            dedupe_key = '%s:%s' % (transaction.user, hashlib.sha1(
+                json.dumps(payload, cls=JSONEncoder, sort_keys=True)
+            ).hexdigest())
+        return 'trytond_async:dedupe:%s:%s' % (
+            transaction.cursor.database_name, dedupe_key
+        )
+
+    @classmethod
+    def send_deduplicated(
+            cls, payload, dedupe_key, debounce=0, task=execute,
+            **celery_options):
+        """
+        Send the payload unless a call with the same deduplication key is
+        still pending, in which case the result of the pending call is
+        returned. The key is released by the worker when the call starts.
+
+        With a debounce, the call is delayed until no new call with the
+        same key was made for `debounce` seconds.
+        """
+        backend = coordination.get_backend()
+        ttl = current_app.conf.ASYNC_DEDUPE_TTL
+        if debounce:
+            backend.set(dedupe_key + ':last', time.time(), ttl)
+
+        task_id = unicode(uuid4())
+        if not backend.add(dedupe_key, task_id, ttl):
+            pending_id = backend.get(dedupe_key)
+            # The pending call may have started in the meantime
+            if pending_id is not None:
+                metrics.incr('task_coalesced', task=task_name(payload))
+                return get_executor().result(task, pending_id)
+            backend.set(dedupe_key, task_id, ttl)
+
+        payload['dedupe'] = {'key': dedupe_key, 'debounce': debounce}
+        if debounce:
+            celery_options.setdefault('countdown', debounce)
+        return cls.send_payload(
+            task, payload, task_id=task_id, **celery_options
+        )
 
-        args = args or []
-        kwargs = kwargs or {}
+    @classmethod
+    def apply_async_many(
+            cls, calls, chunk_size=500, after_commit=False, queue=None,
+            priority=None, **celery_options):
+        """
+        Dispatch many method calls at once. Instead of one broker message
+        per call, the calls are grouped in chunks of `chunk_size` and each
+        chunk is serialized in one pass and published as a single message.
+        The transaction context, database and user are shared by all the
+        calls of a chunk.
+
+        :param calls: iterable of `(model, method, instance, args, kwargs)`
+                      tuples, with the same meaning as the arguments of
+                      `apply_async`.
+        :param chunk_size: Maximum number of calls sent in one message.
+        :param after_commit: If True, the calls are only sent once the
+                             current transaction is committed.
+        :param queue: The queue to which the calls are sent, like for
+                      `apply_async`. By default the calls are routed by
+                      the `routes` setting.
+        :param priority: The priority of the calls.
+        :returns :class:`BatchResult`:
+        """
+        payloads = [
+            cls.build_payload(method, model, instance, args, kwargs)
+            for model, method, instance, args, kwargs in calls
+        ]
 
         if current_app.conf.get('TEST_MODE', False):
-            if instance:
-                return MockResult(
-                    getattr(instance, method_name)(*args, **kwargs)
-                )
-            else:
-                CurrentModel = Pool().get(model_name)
-                return MockResult(
-                    getattr(CurrentModel, method_name)(*args, **kwargs)
-                )
+            return BatchResult([
+                MockResult(cls.execute_payload(payload))
+                for payload in payloads
+            ])
 
-        payload = {
-            'model_name': model_name,
-            'instance': instance,
-            'method_name': method_name,
-            'args': args,
-            'kwargs': kwargs,
-            'context': Transaction().context,
-        }
-        return execute.apply_async(
-            # Args for the call
-            (
-                Transaction().cursor.database_name,
-                Transaction().user,
-                cls.serialize_payload(payload)
-            ),
+        context = Transaction().context
+        if priority is not None:
+            celery_options['priority'] = priority
+        queue = cls.get_queue(queue)
+        if queue:
+            celery_options['queue'] = queue
+
+        # Without a queue for all the calls, they are sent in batches per
+        # routed queue.
+        if 'queue' in celery_options:
+            routes = {celery_options.pop('queue'): range(len(payloads))}
+        else:
+            routes = {}
+            for index, payload in enumerate(payloads):
+                routes.setdefault(cls.get_route(payload), []).append(index)
+
+        results = [None] * len(payloads)
+        for queue, indexes in routes.iteritems():
+            options = dict(celery_options)
+            if queue:
+                options['queue'] = queue
+            if after_commit:
+                datamanager = join_datamanager()
+                for index in indexes:
+                    results[index] = datamanager.put(
+                        dict(payloads[index], context=context), options
+                    )
+                continue
+            for start in xrange(0, len(indexes), chunk_size):
+                chunk = indexes[start:start + chunk_size]
+                batch_result = cls.send_payload(execute_batch, {
+                    'context': context,
+                    'payloads': [payloads[index] for index in chunk],
+                }, **options)
+                for position, index in enumerate(chunk):
+                    results[index] = BatchItemResult(batch_result, position)
+        return BatchResult(results)
+
+    @classmethod
+    def send_payload(cls, task, payload, **celery_options):
+        """
+        Encode the payload and send it to the workers as a call of the given
+        celery task, in the database and as the user of the transaction.
+        The call is run by the executor of the `executor` setting, or kept
+        in `async.scheduled` until it is due if it is delayed for long.
+
+        :param task: `execute`, `execute_ignore_result` or `execute_batch`
+        :param payload: The payload, or the batch of payloads.
+        :returns :class:`AsyncResult`:
+        """
+        transaction = Transaction()
+        # The worker measures the wait in the queue from the time at which
+        # the call is ready to be executed.
+        payload = dict(
+            payload,
+            queued_at=time.time() + (celery_options.get('countdown') or 0)
+        )
+        data, options = cls.encode_payload(
+            payload, celery_options.get('serializer')
+        )
+        # Args for the call
+        args = (transaction.cursor.database_name, transaction.user, data)
+        due = get_due(celery_options)
+        if due is not None:
+            return Pool().get('async.scheduled').schedule(
+                due, task, args, options or None, **celery_options
+            )
+        return get_executor().submit(
+            task, args,
+            # The options needed to decode the payload. They are only sent
+            # when there are some, so that the messages of small payloads
+            # are unchanged.
+            options or None,
             # Additional celery options
             **celery_options
         )
 
+    @classmethod
+    def encode_payload(cls, payload, serializer=None):
+        """
+        Serialize the payload and compress it if it is larger than the
+        `compression_threshold` setting. Binary arguments and payloads
+        larger than the `payload_store_threshold` setting are moved to the
+        payload store.
+
+        Returns the encoded payload and the options which must be given
+        back to `deserialize_payload` as keyword arguments.
+        """
+        options = {}
+        database = Transaction().cursor.database_name
+        payload = cls.shrink_context(payload)
+        store_threshold = current_app.conf.ASYNC_PAYLOAD_STORE_THRESHOLD
+        if store_threshold:
+            keys = []
+            payload = store_buffers(payload, store_threshold, database, keys)
+            if keys:
+                # The worker deletes them once the task succeeded
+                payload = dict(payload, stored_keys=keys)
+
+        data = cls.serialize_payload(payload, serializer)
+        threshold = current_app.conf.ASYNC_COMPRESSION_THRESHOLD
+        if threshold and len(data) >= threshold:
+            start = time.time()
+            compressed = zlib.compress(str(data))
+            metrics.incr('payload_compressed')
+            metrics.incr('payload_compress_seconds', time.time() - start)
+            metrics.incr('payload_bytes_uncompressed', len(data))
+            metrics.incr('payload_bytes_compressed', len(compressed))
+            data, options['encoding'] = buffer(compressed), 'zlib'
+
+        if store_threshold and len(data) >= store_threshold:
+            data, options['stored'] = store.put(database, str(data)), True
+        return data, options
+
+    @classmethod
+    def shrink_context(cls, payload):
+        """
+        Return the payload with its context minimised and replaced by its
+        fingerprint, according to the `minimise_context` and
+        `context_fingerprint` settings. The context is restored by
+        `restore_context` on the worker.
+        """
+        conf = current_app.conf
+        if not payload.get('context') or not (
+                conf.ASYNC_MINIMISE_CONTEXT or conf.ASYNC_CONTEXT_FINGERPRINT):
+            return payload
+        payload = payload.copy()
+        encoder = cls.get_json_encoder()
+        size = None
+        if conf.ASYNC_MINIMISE_CONTEXT:
+            size = len(json.dumps(payload['context'], cls=encoder))
+            payload['context'], payload['context_unset'] = context.minimise(
+                payload['context']
+            )
+        fingerprint = None
+        if conf.ASYNC_CONTEXT_FINGERPRINT:
+            # The serialized context is reused to measure what is saved
+            fingerprint, data = context.share(payload['context'])
+        if fingerprint:
+            payload['context_fingerprint'] = fingerprint
+            del payload['context']
+            if size is None:
+                size = len(data)
+            size -= len(fingerprint)
+        elif size is not None:
+            size -= len(json.dumps(payload['context'], cls=encoder))
+        else:
+            size = 0
+        metrics.incr('context_bytes_saved', size)
+        return payload
+
+    @classmethod
+    def restore_context(cls, payload):
+        """
+        Restore the context of the payload, as it was before
+        `shrink_context`, in the transaction of the worker.
+        """
+        if 'context_fingerprint' in payload:
+            payload['context'] = context.lookup(
+                payload.pop('context_fingerprint')
+            )
+        if 'context_unset' in payload:
+            payload['context'] = context.expand(
+                payload['context'], payload.pop('context_unset')
+            )
+        return payload
+
+    @classmethod
+    def release_payload(cls, data, payload, stored=False, **options):
+        """
+        Delete the data of the payload from the payload store. This is
+        called by the worker once the task succeeded.
+
+        :param data: The payload as received by the worker.
+        :param payload: The deserialized payload.
+        """
+        database = Transaction().cursor.database_name
+        for key in payload.get('stored_keys', []):
+            store.delete(database, key)
+        if stored:
+            store.delete(database, data)
+
+    @classmethod
+    def encode_result(cls, result, policy):
+        """
+        Return the result of a call as it is written to the result backend.
+        This is called by the worker when the call has a result policy.
+
+        Results larger than the `store_threshold` of the policy are moved to
+        the payload store, where they are collected after the
+        `payload_store_max_age` setting, and the ones larger than its
+        `compress_threshold` are compressed. Both are decoded back to the
+        result by the serializers when the result is read.
+        """
+        compress_threshold = policy.get('compress_threshold')
+        store_threshold = policy.get('store_threshold')
+        if not compress_threshold and not store_threshold:
+            return result
+        data = json.dumps(result, cls=cls.get_json_encoder())
+        if store_threshold and len(data) >= store_threshold:
+            database = Transaction().cursor.database_name
+            metrics.incr('result_stored')
+            return StoredValue(database, store.put(database, data))
+        if compress_threshold and len(data) >= compress_threshold:
+            metrics.incr('result_compressed')
+            return CompressedValue(buffer(zlib.compress(data)))
+        return result
+
     @classmethod
     def get_json_encoder(cls):
         """
@@ -185,10 +1093,23 @@ class Async(ModelView):
         return JSONEncoder
 
     @classmethod
-    def serialize_payload(cls, payload):
+    def get_serializer(cls):
+        """
+        Return the name of the serializer used for payloads when none is
+        given in the celery options of the call. This is the serializer of
+        the messages by default.
         """
-        Serialize the given payload to JSON
+        return current_app.conf.CELERY_TASK_SERIALIZER
+
+    @classmethod
+    def serialize_payload(cls, payload, serializer=None):
         """
+        Serialize the given payload to JSON, or to msgpack if the serializer
+        is `tryson-msgpack`. Msgpack payloads are binary and are returned as
+        a buffer.
+        """
+        if (serializer or cls.get_serializer()) == 'tryson-msgpack':
+            return buffer(msgpack_dumps(payload))
         return json.dumps(payload, cls=cls.get_json_encoder())
 
     @classmethod
@@ -204,8 +1125,29 @@ class Async(ModelView):
         return JSONDecoder()
 
     @classmethod
-    def deserialize_payload(cls, payload):
+    def deserialize_payload(cls, payload, encoding=None, stored=False):
         """
         Deserialize the given message to a javascript payload
+
+        :param encoding: The compression of the payload, as returned by
+                         `encode_payload`.
+        :param stored: True if the payload is the key of the payload in
+                       the payload store, as returned by `encode_payload`.
         """
-        return json.loads(payload, object_hook=cls.get_json_decoder())
+        if stored:
+            payload = store.read(Transaction().cursor.database_name, payload)
+            if not encoding and not payload.startswith('{'):
+                payload = buffer(payload)
+        if encoding == 'zlib':
+            start = time.time()
+            payload = zlib.decompress(str(payload))
+            metrics.incr('payload_decompress_seconds', time.time() - start)
+            # Payloads are always mappings, so a JSON payload starts with a
+            # brace and a msgpack one with a map header.
+            if not payload.startswith('{'):
+                payload = buffer(payload)
+        if isinstance(payload, buffer):
+            payload = msgpack_loads(str(payload))
+        else:
+            payload = json_loads(payload, cls.get_json_decoder())
+        return cls.restore_context(payload)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks for the hot paths of trytond_async.
+
+    The benchmarks are plain scripts meant to be run from the root of the
+    repository, for example::
+
+        python -m benchmarks.bench_apply_async_many
+
+    Unless a broker is configured in the environment, the in-memory
+    transport of kombu is used so that the numbers measure the code in this
+    module and not the network.
+
+    `benchmarks.suite` runs the benchmarks of the hot paths together and
+    writes machine readable results, to compare commits.
+"""
+import os
+import json
+import time
+
+os.environ.setdefault('TRYTOND_ASYNC__BROKER_URL', 'memory://')
+
+
+def measure(func, repeat=3):
+    """
+    Call `func` `repeat` times and return the best wall clock time in
+    seconds.
+    """
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def report(name, **values):
+    """
+    Print one line of results for the benchmark `name`.
+    """
+    print '%-40s %s' % (
+        name,
+        ' '.join('%s=%s' % item for item in sorted(values.items()))
+    )
+
+
+def fork(func, *args):
+    """
+    Call `func(*args)` in a forked process and return the process, to be
+    given to `collect` for the result. The result is sent back as JSON.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        try:
+            os.write(write, json.dumps(func(*args)))
+        finally:
+            os._exit(0)
+    os.close(write)
+    return pid, read
+
+
+def collect(child):
+    """
+    Wait for the process started by `fork` and return its result.
+    """
+    pid, read = child
+    chunks = []
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return json.loads(''.join(chunks))
+
+
+def in_child(func, *args):
+    """
+    Return the result of `func(*args)` run in a forked process.
+    """
+    return collect(fork(func, *args))
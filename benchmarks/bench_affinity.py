@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    Throughput of conflicting updates with and without routing by record
+    affinity.
+
+    Many calls of `ir.sequence.get_id` are sent on a few sequences, so that
+    concurrent calls on the same sequence conflict. Without affinity, they
+    are consumed by one worker with several processes and the conflicts
+    are retried. With affinity, each partition queue is consumed by its own
+    single process worker.
+
+    Unlike the other benchmarks, this one needs a real broker and result
+    backend shared with the workers, and a PostgreSQL database.
+"""
+import os
+import time
+import subprocess
+
+from benchmarks import report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond_async.app import app
+
+CALLS = 2000
+SEQUENCES = 4
+PARTITIONS = 4
+
+
+def start_workers(queues):
+    return [
+        subprocess.Popen([
+            'celery', 'worker', '-A', 'trytond_async.tasks',
+            '-l', 'warning', '-c', str(concurrency), '-Q', queue,
+            '-n', 'bench%d@%%h' % index,
+        ], env=dict(os.environ))
+        for index, (queue, concurrency) in enumerate(queues)
+    ]
+
+
+def run(Async, sequences, affinity):
+    start = time.time()
+    results = [
+        Async.apply_async(
+            'get_id', 'ir.sequence', args=[sequences[i % len(sequences)]],
+            affinity='ir.sequence,%d' % sequences[i % len(sequences)]
+            if affinity else None,
+        )
+        for i in xrange(CALLS)
+    ]
+    if affinity:
+        workers = start_workers([
+            ('%s.%d' % (app.conf.ASYNC_AFFINITY_QUEUE, i), 1)
+            for i in xrange(PARTITIONS)
+        ])
+    else:
+        workers = start_workers([('celery', PARTITIONS)])
+    try:
+        for result in results:
+            result.get(timeout=600)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+    return time.time() - start
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+    Async = POOL.get('async.async')
+    app.conf.ASYNC_AFFINITY_PARTITIONS = PARTITIONS
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        Sequence = POOL.get('ir.sequence')
+        POOL.get('ir.sequence.type').create([{
+            'name': 'Benchmark',
+            'code': 'trytond_async.benchmark',
+        }])
+        sequences = [
+            s.id for s in Sequence.create([{
+                'name': 'Benchmark %d' % i,
+                'code': 'trytond_async.benchmark',
+            } for i in xrange(SEQUENCES)])
+        ]
+        transaction.cursor.commit()
+
+        for affinity in (False, True):
+            seconds = run(Async, sequences, affinity)
+            report(
+                'affinity' if affinity else 'no_affinity',
+                calls=CALLS, seconds='%.2f' % seconds,
+                calls_per_second='%.1f' % (CALLS / seconds),
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    Publish throughput of `Async.apply_async_many` compared to calling
+    `Async.apply_async` once per call.
+"""
+from benchmarks import measure, report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+
+SIZES = (100, 1000, 10000)
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+    Async = POOL.get('async.async')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        View = POOL.get('ir.ui.view')
+        views = View.search([], limit=1)
+
+        for size in SIZES:
+            def one_by_one():
+                for _ in xrange(size):
+                    Async.apply_async(
+                        method='search_read', model=View.__name__,
+                        args=[[('id', 'in', views)]],
+                    )
+
+            def batched():
+                Async.apply_async_many([
+                    (View.__name__, 'search_read', None,
+                        [[('id', 'in', views)]], None)
+                    for _ in xrange(size)
+                ])
+
+            for name, func in (
+                    ('apply_async', one_by_one),
+                    ('apply_async_many', batched)):
+                seconds = measure(func)
+                report(
+                    name, calls=size, seconds='%.4f' % seconds,
+                    calls_per_second='%.0f' % (size / seconds),
+                )
+
+
+if __name__ == '__main__':
+    main()
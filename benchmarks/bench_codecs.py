@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+    Bytes on the wire and encode/decode time of the tryson JSON codec
+    compared to the tryson msgpack codec.
+"""
+import datetime
+from decimal import Decimal
+
+from benchmarks import measure, report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond_async.serialization import json, JSONEncoder, JSONDecoder, \
+    msgpack_dumps, msgpack_loads
+
+
+def payloads(View):
+    now = datetime.datetime.now()
+    yield 'scalars', {
+        'args': [
+            [now, now.date(), Decimal('12.50'), u'label %d' % i]
+            for i in xrange(1000)
+        ],
+    }
+    yield 'records', {'args': [View.browse(range(1, 10001))]}
+    yield 'binary', {'args': [buffer('\x00\x01\x02\xff' * 256 * 1024)]}
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        View = POOL.get('ir.ui.view')
+
+        for name, payload in payloads(View):
+            data = json.dumps(payload, cls=JSONEncoder)
+            report(
+                'tryson.%s' % name, bytes=len(data),
+                encode='%.6f' % measure(
+                    lambda: json.dumps(payload, cls=JSONEncoder)
+                ),
+                decode='%.6f' % measure(
+                    lambda: json.loads(data, object_hook=JSONDecoder())
+                ),
+            )
+            data = msgpack_dumps(payload)
+            report(
+                'tryson-msgpack.%s' % name, bytes=len(data),
+                encode='%.6f' % measure(lambda: msgpack_dumps(payload)),
+                decode='%.6f' % measure(lambda: msgpack_loads(data)),
+            )
+
+
+if __name__ == '__main__':
+    main()
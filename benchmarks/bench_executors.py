@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    Throughput of the executors on a CPU bound and an IO bound method.
+
+    The CPU bound calls read all the views with `ir.ui.view.search_read`,
+    which mostly spends its time in the ORM. The IO bound calls take the
+    next number of a sequence with `ir.sequence.get_id`, which mostly waits
+    for the database to lock the sequence and commit.
+
+    The local executors need a database which can be opened by several
+    connections, like PostgreSQL. The celery executor also needs a real
+    broker and result backend shared with the workers, which are started
+    with as many processes as the local pools.
+"""
+import time
+import subprocess
+import multiprocessing
+
+from benchmarks import report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond_async import executors
+from trytond_async.app import app
+
+CALLS = 500
+SEQUENCES = 16
+WORKERS = multiprocessing.cpu_count()
+
+
+def run(Async, calls):
+    start = time.time()
+    results = [
+        Async.apply_async(method, model, args=args)
+        for model, method, args in calls
+    ]
+    for result in results:
+        result.get(timeout=600)
+    return time.time() - start
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+    Async = POOL.get('async.async')
+    app.conf.ASYNC_EXECUTOR_WORKERS = WORKERS
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        POOL.get('ir.sequence.type').create([{
+            'name': 'Benchmark',
+            'code': 'trytond_async.benchmark',
+        }])
+        sequences = [
+            s.id for s in POOL.get('ir.sequence').create([{
+                'name': 'Benchmark %d' % i,
+                'code': 'trytond_async.benchmark',
+            } for i in xrange(SEQUENCES)])
+        ]
+        transaction.cursor.commit()
+
+        workloads = (
+            ('cpu', [('ir.ui.view', 'search_read', [[]])] * CALLS),
+            ('io', [
+                ('ir.sequence', 'get_id', [sequences[i % SEQUENCES]])
+                for i in xrange(CALLS)
+            ]),
+        )
+        for name in ('celery', 'thread', 'process'):
+            app.conf.ASYNC_EXECUTOR = name
+            executors._executor = None
+            worker = None
+            if name == 'celery':
+                worker = subprocess.Popen([
+                    'celery', 'worker', '-A', 'trytond_async.tasks',
+                    '-l', 'warning', '-c', str(WORKERS),
+                ])
+            try:
+                for workload, calls in workloads:
+                    seconds = run(Async, calls)
+                    report(
+                        '%s_%s' % (name, workload), calls=CALLS,
+                        workers=WORKERS, seconds='%.2f' % seconds,
+                        calls_per_second='%.1f' % (CALLS / seconds),
+                    )
+            finally:
+                if worker is not None:
+                    worker.terminate()
+                    worker.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    Encode and decode time of the tryson JSON codec on payloads of about
+    1 KB, 100 KB and 10 MB, of plain data only, like the keyword arguments
+    of most calls, and of data mixed with dates, decimals and records, whose
+    objects are tagged with their class.
+"""
+import datetime
+from decimal import Decimal
+
+from benchmarks import measure, report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond_async.serialization import json, json_loads, JSONEncoder
+
+SIZES = (('1kb', 1024), ('100kb', 100 * 1024), ('10mb', 10 * 1024 * 1024))
+
+
+def plain_line(index):
+    return {
+        'sequence': index,
+        'description': u'Line %d of the order' % index,
+        'quantity': 3.0,
+        'unit': u'Unit',
+        'taxes': [1, 2],
+        'note': None,
+    }
+
+
+def mixed_line(index, View):
+    return {
+        'sequence': index,
+        'description': u'Line %d of the order' % index,
+        'quantity': 3.0,
+        'unit_price': Decimal('12.50'),
+        'date': datetime.date(2015, 1, 1),
+        'write_date': datetime.datetime(2015, 1, 1, 12, 30),
+        'view': View(1),
+    }
+
+
+def payload(line, size):
+    """
+    Return a payload of about `size` bytes, with as many lines as needed.
+    """
+    line_size = len(json.dumps(line(0), cls=JSONEncoder))
+    return {
+        'model_name': 'sale.sale',
+        'method_name': 'write',
+        'args': [[1], {'lines': [
+            line(index) for index in xrange(max(1, size // line_size))
+        ]}],
+        'kwargs': {},
+    }
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        View = POOL.get('ir.ui.view')
+        for kind, line in (
+                ('plain', plain_line),
+                ('mixed', lambda index: mixed_line(index, View))):
+            for name, size in SIZES:
+                value = payload(line, size)
+                data = json.dumps(value, cls=JSONEncoder)
+                repeat = max(1, 1024 * 1024 // size)
+                report(
+                    '%s.%s' % (kind, name), bytes=len(data),
+                    encode_ms='%.3f' % (measure(lambda: [
+                        json.dumps(value, cls=JSONEncoder)
+                        for _ in xrange(repeat)
+                    ]) / repeat * 1e3),
+                    decode_ms='%.3f' % (measure(lambda: [
+                        json_loads(data)
+                        for _ in xrange(repeat)
+                    ]) / repeat * 1e3),
+                )
+
+
+if __name__ == '__main__':
+    main()
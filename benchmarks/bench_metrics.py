@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+    Overhead of the metrics recorded for each call executed by a worker,
+    checked against the budget documented in `trytond_async.metrics`.
+
+    The recording of the metrics of a call, with as many labels and phases
+    as `run_payload` records, is timed on its own, together with the clock
+    reads which time the phases. It is compared to the budget and to the
+    time of a call of a quick method executed like by a worker.
+"""
+import time
+
+from benchmarks import measure, report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond_async import metrics, tasks
+
+CALLS = 100000
+# The budget per call, in seconds
+BUDGET = 25e-6
+PHASES = ('cache_clean', 'deserialize', 'execute', 'commit')
+
+
+def record(calls):
+    for index in xrange(calls):
+        call = {
+            'start': time.time(),
+            'phases': {},
+            'task': 'ir.ui.view.read',
+            'queued_at': time.time(),
+            'records': 1,
+        }
+        # Each phase reads the clock before and after
+        for phase in PHASES:
+            start = time.time()
+            call['phases'][phase] = time.time() - start
+        tasks.record_call(DB_NAME, 'success', 200, call)
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+    Async = POOL.get('async.async')
+
+    seconds = measure(lambda: record(CALLS)) / CALLS
+    report(
+        'record_call', calls=CALLS,
+        overhead_us='%.2f' % (seconds * 1e6),
+        budget_us='%.2f' % (BUDGET * 1e6),
+        within_budget=seconds <= BUDGET,
+    )
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        payload = Async.build_payload('search', 'ir.ui.view', args=[[]])
+        payload['context'] = Transaction().context
+        data, options = Async.encode_payload(payload)
+    calls = 200
+    call_seconds = measure(lambda: [
+        tasks.execute.apply((DB_NAME, USER, data), options)
+        for _ in xrange(calls)
+    ]) / calls
+    metrics.reset()
+    report(
+        'execute', calls=calls,
+        call_us='%.0f' % (call_seconds * 1e6),
+        overhead_percent='%.2f' % (100 * seconds / call_seconds),
+    )
+
+
+if __name__ == '__main__':
+    main()
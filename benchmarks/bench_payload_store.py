@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+    Broker message size and dispatch to decode latency of payloads with
+    large binary arguments, sent through the broker and moved to the
+    payload store.
+"""
+from benchmarks import measure, report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond_async.app import app
+
+MEGABYTE = 1024 * 1024
+SIZES = (1, 10, 100)
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+    Async = POOL.get('async.async')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        for size in SIZES:
+            payload = Async.build_payload(
+                'import_data', 'ir.attachment',
+                args=[buffer('\x00\x01\x02\xff' * (size * MEGABYTE / 4))],
+            )
+            payload['context'] = CONTEXT
+            for name, threshold in (('broker', 0), ('store', MEGABYTE)):
+                app.conf.ASYNC_PAYLOAD_STORE_THRESHOLD = threshold
+
+                def round_trip():
+                    data, options = Async.encode_payload(payload)
+                    decoded = Async.deserialize_payload(data, **options)
+                    # Page in the data, as the method would
+                    str(decoded['args'][0])
+                    Async.release_payload(data, decoded, **options)
+                    return data
+
+                report(
+                    'payload.%s' % name, megabytes=size,
+                    message_bytes=len(round_trip()),
+                    seconds='%.4f' % measure(round_trip),
+                )
+        app.conf.ASYNC_PAYLOAD_STORE_THRESHOLD = 0
+
+
+if __name__ == '__main__':
+    main()
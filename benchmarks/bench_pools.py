@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    Resident size and throughput of a worker process serving many
+    databases, keeping all their pools compared to keeping at most
+    `MAX_POOLS` of them.
+
+    The databases are copies of the SQLite database of the tests, in a
+    temporary directory. Half of the calls are on a busy database and the
+    others on a random one, each mode running in a process of its own
+    forked from the benchmark. The number of databases is given as first
+    argument::
+
+        python -m benchmarks.bench_pools 32
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from benchmarks import in_child, report
+
+if 'DB_NAME' not in os.environ:
+    DATABASE_PATH = tempfile.mkdtemp(prefix='trytond_async_bench')
+    os.environ['DB_NAME'] = 'bench'
+    from trytond.config import config  # noqa
+    config.set('database', 'path', DATABASE_PATH)
+else:
+    DATABASE_PATH = None
+
+import trytond.tests.test_tryton  # noqa
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond_async import metrics, pools, tasks  # noqa
+from trytond_async.app import app  # noqa
+
+CALLS = 2000
+DATABASES = 16
+MAX_POOLS = 4
+
+
+def run(databases, calls, data, options, max_pools):
+    app.conf.ASYNC_MAX_POOLS = max_pools
+    random.seed(0)
+    rss = pools.get_rss()
+    max_rss = rss
+    start = time.time()
+    for _ in xrange(calls):
+        if random.random() < 0.5:
+            database = databases[0]
+        else:
+            database = random.choice(databases)
+        tasks.execute.apply((database, USER, data), options)
+        max_rss = max(max_rss, pools.get_rss())
+    seconds = time.time() - start
+
+    counts = dict.fromkeys(('pool_hit', 'pool_miss', 'pool_evicted'), 0)
+    for (name, _), value in metrics.snapshot().iteritems():
+        if name in counts:
+            counts[name] += value
+    return dict(
+        counts,
+        calls_per_second=calls / seconds,
+        rss_growth_mb=(max_rss - rss) / 1024. / 1024,
+    )
+
+
+def main():
+    if DATABASE_PATH is None:
+        sys.exit(
+            'The databases are copies of a SQLite database created by the '
+            'benchmark, so DB_NAME must not be set'
+        )
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DATABASES
+    try:
+        trytond.tests.test_tryton.install_module('async')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Async = POOL.get('async.async')
+            payload = Async.build_payload('search', 'ir.ui.view', args=[[]])
+            payload['context'] = {}
+            data, options = Async.encode_payload(payload)
+
+        databases = ['tenant_%02d' % i for i in xrange(count)]
+        for database in databases:
+            shutil.copy(
+                os.path.join(DATABASE_PATH, DB_NAME + '.sqlite'),
+                os.path.join(DATABASE_PATH, database + '.sqlite')
+            )
+
+        for name, max_pools in (('unlimited', 0), ('max_pools', MAX_POOLS)):
+            result = in_child(
+                run, databases, CALLS, data, options, max_pools
+            )
+            report(
+                name, databases=count, max_pools=max_pools, calls=CALLS,
+                calls_per_second='%.1f' % result['calls_per_second'],
+                rss_growth_mb='%.1f' % result['rss_growth_mb'],
+                hits=result['pool_hit'], misses=result['pool_miss'],
+                evictions=result['pool_evicted'],
+            )
+    finally:
+        shutil.rmtree(DATABASE_PATH)
+
+
+if __name__ == '__main__':
+    main()
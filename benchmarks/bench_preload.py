@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+    Startup time and memory of the children of a worker which initialise
+    the pool of the database on their first call, compared to children
+    which inherit the pool initialised by the parent with the
+    `preload_databases` setting.
+
+    Each mode runs in a process of its own, forked from the benchmark,
+    which plays the parent of the worker and forks the children at once.
+    Each child makes one call of `tasks.execute` and reports the time from
+    the fork until the call is done, its resident size and its private
+    memory, which is not shared with the parent or the other children. The
+    private memory is only known on Linux.
+
+    Unless a database is given in the environment, a SQLite database is
+    created in a temporary directory. The number of children is given as
+    first argument::
+
+        python -m benchmarks.bench_preload 8
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from benchmarks import collect, fork, in_child, report
+
+if 'DB_NAME' not in os.environ:
+    DATABASE_PATH = tempfile.mkdtemp(prefix='trytond_async_bench')
+    os.environ['DB_NAME'] = 'bench'
+    from trytond.config import config  # noqa
+    config.set('database', 'path', DATABASE_PATH)
+else:
+    DATABASE_PATH = None
+
+import trytond.tests.test_tryton  # noqa
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond_async import pools, tasks  # noqa
+from trytond_async.app import app  # noqa
+
+CHILDREN = 4
+
+
+def get_private():
+    """
+    Return the memory of the process in bytes which is not shared with
+    other processes, or None if it is not known.
+    """
+    private = 0
+    try:
+        with open('/proc/self/smaps_rollup') as fp:
+            for line in fp:
+                if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                    private += int(line.split()[1]) * 1024
+    except (IOError, ValueError, IndexError):
+        return None
+    return private
+
+
+def megabytes(value):
+    return '%.1f' % (value / 1024. / 1024) if value is not None else '-'
+
+
+def install():
+    """
+    Install the module and return the encoded payload of a search.
+    """
+    trytond.tests.test_tryton.install_module('async')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        Async = POOL.get('async.async')
+        payload = Async.build_payload('search', 'ir.ui.view', args=[[]])
+        payload['context'] = {}
+        return Async.encode_payload(payload)
+
+
+def first_call(start, data, options):
+    tasks.execute.apply((DB_NAME, USER, data), options)
+    return {
+        'seconds': time.time() - start,
+        'rss': pools.get_rss(),
+        'private': get_private(),
+    }
+
+
+def run(children, preload, data, options):
+    """
+    Start the children, after preloading the pool if asked to, and return
+    the time until they all made their first call and their memory.
+    """
+    start = time.time()
+    if preload:
+        app.conf.ASYNC_PRELOAD_DATABASES = [DB_NAME]
+        tasks.preload_databases()
+    preload_seconds = time.time() - start
+
+    start = time.time()
+    results = [
+        collect(child) for child in [
+            fork(first_call, start, data, options)
+            for _ in xrange(children)
+        ]
+    ]
+    known = [r['private'] for r in results if r['private'] is not None]
+    return {
+        'preload_seconds': preload_seconds,
+        'startup_seconds': max(r['seconds'] for r in results),
+        'first_call_seconds': sum(r['seconds'] for r in results) / children,
+        'rss': sum(r['rss'] or 0 for r in results) / children,
+        'private': sum(known) / len(known) if known else None,
+    }
+
+
+def main():
+    if DB_NAME == ':memory:':
+        sys.exit('The children can not open an in-memory database')
+    children = int(sys.argv[1]) if len(sys.argv) > 1 else CHILDREN
+    try:
+        # The pool is initialised in another process, so that the parent
+        # of the lazy children does not hold it.
+        data, options = in_child(install)
+        for name, preload in (('lazy', False), ('preloaded', True)):
+            result = in_child(run, children, preload, data, options)
+            report(
+                name, children=children,
+                preload_ms='%.1f' % (result['preload_seconds'] * 1e3),
+                startup_ms='%.1f' % (result['startup_seconds'] * 1e3),
+                first_call_ms='%.1f' % (result['first_call_seconds'] * 1e3),
+                rss_mb=megabytes(result['rss']),
+                private_mb=megabytes(result['private']),
+            )
+    finally:
+        if DATABASE_PATH is not None:
+            shutil.rmtree(DATABASE_PATH)
+
+
+if __name__ == '__main__':
+    main()
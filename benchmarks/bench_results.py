@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    Writes to the result backend and memory of the worker when executing
+    fire-and-forget calls as `execute`, which stores their result, compared
+    to `execute_ignore_result`, which does not.
+
+    The calls are run through the tracer of celery, like in a worker, so
+    that the result backend is written to exactly as by a worker. Unless a
+    result backend is configured in the environment, the in-memory cache
+    backend is used. The number of calls is given as first argument::
+
+        python -m benchmarks.bench_results 100000
+"""
+import os
+import sys
+import time
+import resource
+from uuid import uuid4
+
+from benchmarks import report
+
+os.environ.setdefault('TRYTOND_ASYNC__BACKEND_URL', 'cache+memory://')
+
+from celery.app.trace import build_tracer  # noqa
+import trytond.tests.test_tryton  # noqa
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond_async.tasks import execute, execute_ignore_result  # noqa
+
+CALLS = 100000
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+    trytond.tests.test_tryton.install_module('async')
+    Async = POOL.get('async.async')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        payload = Async.build_payload('search', 'ir.ui.view', args=[[]])
+        payload['context'] = Transaction().context
+        data, options = Async.encode_payload(payload)
+
+    # Count what the worker writes to the result backend
+    backend = execute.backend
+    writes = {'count': 0, 'bytes': 0}
+    set_ = backend.set
+
+    def counting_set(key, value):
+        writes['count'] += 1
+        writes['bytes'] += len(value)
+        return set_(key, value)
+    backend.set = counting_set
+
+    # Ignored results first, as the maximum resident size only grows
+    for task in (execute_ignore_result, execute):
+        tracer = build_tracer(task.name, task, app=task.app)
+        writes.update(count=0, bytes=0)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        for _ in xrange(calls):
+            tracer(str(uuid4()), (DB_NAME, USER, data), options)
+        seconds = time.time() - start
+        report(
+            task.name.rsplit('.', 1)[-1], calls=calls,
+            seconds='%.2f' % seconds,
+            calls_per_second='%.0f' % (calls / seconds),
+            backend_writes=writes['count'],
+            backend_bytes=writes['bytes'],
+            max_rss_growth_kb=resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss - rss,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    Load test of the retry policies on conflicting tasks.
+
+    Many tasks updating the same row are started at the same time. An
+    attempt holds the row for the duration of its transaction, and an
+    attempt which starts while the row is held conflicts, like with a
+    `DatabaseOperationalError`, and is retried after the delay given by the
+    retry policy. The simulation reports how long it takes for all the
+    conflicts to settle and how many attempts were made.
+
+    This needs neither a broker nor a database, so that the policies can
+    be compared quickly.
+"""
+import heapq
+import random
+
+from benchmarks import report
+
+from trytond_async.tasks import RetryPolicy
+
+TASKS = (10, 100, 1000)
+DURATION = 0.05  # Duration of a transaction in seconds
+WORKERS = 32
+
+POLICIES = [
+    ('fixed_2s', RetryPolicy(max_retries=None)),
+    ('exponential_jitter', RetryPolicy.exponential(
+        base_delay=DURATION, max_delay=60, max_retries=None
+    )),
+]
+
+
+def simulate(policy, tasks):
+    """
+    Return the time when the last task succeeded and the number of
+    attempts.
+    """
+    # Attempts to start: (time, task, retries)
+    attempts = [(random.uniform(0, DURATION), i, 0) for i in xrange(tasks)]
+    heapq.heapify(attempts)
+    # End time of the transactions in progress on each worker
+    workers = [0] * WORKERS
+    row_free_at = 0
+    count = end = 0
+    while attempts:
+        now, task, retries = heapq.heappop(attempts)
+        # Wait for a free worker
+        worker = min(xrange(WORKERS), key=workers.__getitem__)
+        now = max(now, workers[worker])
+        workers[worker] = now + DURATION
+        count += 1
+        if now < row_free_at:
+            # Conflict: the attempt fails at the end of its transaction
+            heapq.heappush(attempts, (
+                now + DURATION + policy.get_delay(retries),
+                task, retries + 1
+            ))
+        else:
+            row_free_at = end = now + DURATION
+    return end, count
+
+
+def main():
+    random.seed(0)
+    for tasks in TASKS:
+        for name, policy in POLICIES:
+            seconds, attempts = simulate(policy, tasks)
+            report(
+                'retry.%s' % name, tasks=tasks, attempts=attempts,
+                settle_seconds='%.2f' % seconds,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    Memory of the worker and lateness of the calls when many calls are
+    delayed, as messages with an ETA held by the worker compared to calls
+    kept in `async.scheduled` until they are due.
+
+    The calls are sent with a countdown of `DELAY` seconds, then a worker
+    is started. The resident size of the worker and of its children is
+    sampled until all the calls are done, and the lateness of each call is
+    the time at which its result was stored minus the time at which it was
+    due. The scheduled calls are published by running `publish_scheduled`
+    every `scheduler_interval` seconds, like celery beat would.
+
+    It needs a database which can be opened by several connections, like
+    PostgreSQL, and a real broker and result backend shared with the
+    worker. The number of calls is given as first argument::
+
+        python -m benchmarks.bench_scheduled 100000
+"""
+import os
+import sys
+import time
+import signal
+import datetime
+import threading
+import subprocess
+
+from benchmarks import report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond_async import tasks
+from trytond_async.app import app
+
+CALLS = 100000
+DELAY = 120
+THRESHOLD = 60
+
+
+def group_rss(pgid):
+    """
+    Return the resident size in kB of the processes of the group.
+    """
+    output = subprocess.check_output(['ps', '-o', 'rss=', '-g', str(pgid)])
+    return sum(int(line) for line in output.split())
+
+
+def run(Async, calls):
+    delay = datetime.timedelta(seconds=DELAY)
+    start = time.time()
+    results = []
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        for _ in xrange(calls):
+            due = datetime.datetime.utcnow() + delay
+            results.append((due, Async.apply_async(
+                'search_count', 'ir.ui.view', args=[[('id', '<', 0)]],
+                countdown=DELAY
+            )))
+        transaction.cursor.commit()
+    dispatch_seconds = time.time() - start
+
+    stop = threading.Event()
+
+    def publish():
+        while not stop.wait(app.conf.ASYNC_SCHEDULER_INTERVAL):
+            tasks.publish_scheduled(DB_NAME)
+    if app.conf.ASYNC_SCHEDULE_THRESHOLD:
+        publisher = threading.Thread(target=publish)
+        publisher.daemon = True
+        publisher.start()
+
+    worker = subprocess.Popen([
+        'celery', 'worker', '-A', 'trytond_async.tasks', '-l', 'warning',
+    ], preexec_fn=os.setsid)
+    max_rss, done = 0, 0
+    try:
+        # The calls are due in the order in which they were sent
+        while done < len(results):
+            max_rss = max(max_rss, group_rss(worker.pid))
+            while done < len(results) and results[done][1].ready():
+                done += 1
+            time.sleep(1)
+    finally:
+        stop.set()
+        os.killpg(worker.pid, signal.SIGTERM)
+        worker.wait()
+
+    lateness = sorted(
+        (result.backend.get_task_meta(result.id)['date_done'] - due)
+        .total_seconds() for due, result in results
+    )
+    return dispatch_seconds, max_rss, lateness
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+    trytond.tests.test_tryton.install_module('async')
+    Async = POOL.get('async.async')
+
+    for name, threshold in (('eta', 0), ('scheduled', THRESHOLD)):
+        app.conf.ASYNC_SCHEDULE_THRESHOLD = threshold
+        dispatch_seconds, max_rss, lateness = run(Async, calls)
+        report(
+            name, calls=calls, delay=DELAY,
+            dispatch_seconds='%.1f' % dispatch_seconds,
+            worker_max_rss_kb=max_rss,
+            lateness_p50='%.2f' % lateness[len(lateness) // 2],
+            lateness_p99='%.2f' % lateness[len(lateness) * 99 // 100],
+            lateness_max='%.2f' % lateness[-1],
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+    Encode and decode time and payload size of lists of records, with the
+    id references of the tryson codec and with the former `repr` based
+    encoding.
+"""
+from benchmarks import measure, report
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond.model import Model
+from trytond_async.serialization import json, JSONEncoder, JSONDecoder
+
+SIZES = (1, 100, 10000)
+
+
+class ReprEncoder(JSONEncoder):
+    """
+    The encoding of records used before id references.
+    """
+    def iterencode(self, o, _one_shot=False):
+        return super(JSONEncoder, self).iterencode(o, _one_shot)
+
+    def default(self, obj):
+        if isinstance(obj, Model):
+            return {'__class__': 'Model', 'repr': repr(obj)}
+        return super(ReprEncoder, self).default(obj)
+
+
+def main():
+    trytond.tests.test_tryton.install_module('async')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        View = POOL.get('ir.ui.view')
+
+        for size in SIZES:
+            payload = {'args': [View.browse(range(1, size + 1))]}
+            for name, encoder in (('repr', ReprEncoder), ('ids', JSONEncoder)):
+                data = json.dumps(payload, cls=encoder)
+                report(
+                    'records.%s' % name, records=size, bytes=len(data),
+                    encode='%.6f' % measure(
+                        lambda: json.dumps(payload, cls=encoder)
+                    ),
+                    decode='%.6f' % measure(
+                        lambda: json.loads(data, object_hook=JSONDecoder())
+                    ),
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+    The benchmark suite of the hot paths, with machine readable results to
+    compare commits.
+
+    It measures, offline:
+
+        * the encoding and decoding of realistic payloads with `JSONEncoder`
+          and `JSONDecoder`,
+        * the rate at which `Async.apply_async` publishes calls to the
+          in-memory transport of kombu,
+        * the time of a call of `tasks.execute`, by phase, from the metrics
+          recorded by `run_payload`,
+        * the end-to-end number of calls per second and their wait in the
+          queue with 1, 4 and 16 consumers of the broker in this process,
+          while the calls are published.
+
+    The consumers run the messages through the tracer of celery, like a
+    worker, in threads so that they share the in-memory transport. Unless a
+    database is given in the environment, a SQLite database is created in a
+    temporary directory, as the in-memory databases of SQLite can not be
+    shared by threads. SQLite serialises the transactions, so the numbers
+    of several consumers are only meaningful with PostgreSQL::
+
+        DB_NAME=bench TRYTOND_DATABASE_URI=postgresql:// \\
+            python -m benchmarks.suite
+
+    The results are printed and, with `--output`, written as JSON with the
+    commit they were measured on. With `--compare`, they are compared to
+    the results of another run, and the command fails if a time or a rate
+    is worse by more than `--tolerance` percent::
+
+        python -m benchmarks.suite --output base.json
+        git checkout my-branch
+        python -m benchmarks.suite --compare base.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import decimal
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+
+from benchmarks import measure, report
+
+os.environ.setdefault('TRYTOND_ASYNC__BACKEND_URL', 'cache+memory://')
+if 'DB_NAME' not in os.environ:
+    DATABASE_PATH = tempfile.mkdtemp(prefix='trytond_async_bench')
+    os.environ['DB_NAME'] = 'bench'
+    from trytond.config import config  # noqa
+    config.set('database', 'path', DATABASE_PATH)
+else:
+    DATABASE_PATH = None
+
+from celery.app.trace import build_tracer  # noqa
+import trytond.tests.test_tryton  # noqa
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond import backend  # noqa
+from trytond.transaction import Transaction  # noqa
+from trytond_async import metrics, tasks  # noqa
+from trytond_async.app import app  # noqa
+from trytond_async.serialization import JSONEncoder, JSONDecoder  # noqa
+
+CALLS = 1000
+CONCURRENCIES = (1, 4, 16)
+PHASES = ('pool_init', 'cache_clean', 'deserialize', 'execute', 'commit')
+# The metrics compared between runs, by suffix of their name, and whether
+# a higher value is better
+COMPARED = {
+    '_us': False,
+    '_bytes': False,
+    '_seconds': False,
+    '_per_second': True,
+}
+
+
+def direction(metric):
+    for suffix, higher_is_better in COMPARED.iteritems():
+        if metric.endswith(suffix):
+            return higher_is_better
+    return None
+
+
+def get_commit():
+    """
+    Return the commit of the working tree, with a `+` if it has changes.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT
+        ).strip()
+        if subprocess.check_output(['git', 'status', '--porcelain', '-uno']):
+            commit += '+'
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def payloads(Async):
+    """
+    Return the realistic payloads by name: a search with the context of the
+    user, and a write of a hundred records.
+    """
+    View = POOL.get('ir.ui.view')
+    context = dict(
+        POOL.get('res.user').get_preferences(context_only=True),
+        active_id=1, active_ids=range(1, 11), active_model='ir.ui.view',
+    )
+    search = Async.build_payload(
+        'search', 'ir.ui.view',
+        args=[[('type', '=', 'form'), ('model', 'ilike', 'ir.%')]],
+        kwargs={'limit': 80, 'order': [('id', 'ASC')]},
+    )
+    write = Async.build_payload(
+        'write', 'ir.ui.view', args=[View.browse(range(1, 101)), {
+            'name': u'Vue modifiée',
+            'priority': 20,
+            'write_date': datetime.datetime.now(),
+            'date': datetime.date.today(),
+            'amount': decimal.Decimal('1234.56'),
+        }]
+    )
+    return [
+        (name, dict(payload, context=context, queued_at=time.time()))
+        for name, payload in (('search', search), ('write', write))
+    ]
+
+
+def bench_serialization(Async, results, calls):
+    for name, payload in payloads(Async):
+        data = json.dumps(payload, cls=JSONEncoder)
+        encode = measure(lambda: [
+            json.dumps(payload, cls=JSONEncoder) for _ in xrange(calls)
+        ])
+        decode = measure(lambda: [
+            json.loads(data, object_hook=JSONDecoder())
+            for _ in xrange(calls)
+        ])
+        results['serialization.%s' % name] = {
+            'payload_bytes': len(data),
+            'encode_us': encode / calls * 1e6,
+            'decode_us': decode / calls * 1e6,
+        }
+
+
+def purge(queue):
+    with app.connection() as connection:
+        connection.default_channel.queue_purge(queue)
+
+
+def bench_publish(Async, results, calls):
+    queue = app.conf.CELERY_DEFAULT_QUEUE
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        seconds = measure(lambda: [
+            Async.apply_async('search_count', 'ir.ui.view', args=[[]])
+            for _ in xrange(calls)
+        ])
+    purge(queue)
+    results['apply_async'] = {
+        'call_us': seconds / calls * 1e6,
+        'calls_per_second': calls / seconds,
+    }
+
+
+def bench_execute(Async, results, calls):
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        payload = Async.build_payload('search', 'ir.ui.view', args=[[]])
+        payload['context'] = Transaction().context
+        data, options = Async.encode_payload(payload)
+    tasks.execute.apply((DB_NAME, USER, data), options)
+
+    metrics.reset()
+    start = time.time()
+    for _ in xrange(calls):
+        tasks.execute.apply((DB_NAME, USER, data), options)
+    seconds = time.time() - start
+    result = {'call_us': seconds / calls * 1e6}
+    for phase in PHASES:
+        count, total = metrics.get_histogram(
+            'phase_seconds', database=DB_NAME, task='ir.ui.view.search',
+            phase=phase
+        )
+        # The pool is only initialised by the first call of the process
+        if count:
+            result['%s_us' % phase] = total / count * 1e6
+    result['overhead_us'] = result['call_us'] - result['execute_us']
+    results['execute'] = result
+
+
+def consume(queue, published, errors):
+    """
+    Execute the messages of the queue like a worker until the queue is
+    empty once all the calls are published.
+    """
+    tracers = {}
+    try:
+        with app.connection() as connection:
+            channel = connection.default_channel
+            while True:
+                message = channel.basic_get(queue, no_ack=True)
+                if message is None:
+                    if published.is_set():
+                        return
+                    time.sleep(0.001)
+                    continue
+                body = message.decode()
+                tracer = tracers.get(body['task'])
+                if tracer is None:
+                    task = app.tasks[body['task']]
+                    tracer = tracers[body['task']] = build_tracer(
+                        task.name, task, app=app
+                    )
+                tracer(body['id'], body['args'], body['kwargs'], body)
+    except Exception, exc:
+        errors.append(exc)
+        raise
+
+
+def bench_end_to_end(Async, results, calls):
+    queue = app.conf.CELERY_DEFAULT_QUEUE
+    for concurrency in CONCURRENCIES:
+        purge(queue)
+        metrics.reset()
+        published = threading.Event()
+        errors = []
+        consumers = [
+            threading.Thread(target=consume, args=(queue, published, errors))
+            for _ in xrange(concurrency)
+        ]
+        start = time.time()
+        for consumer in consumers:
+            consumer.start()
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            for _ in xrange(calls):
+                Async.apply_async('search_count', 'ir.ui.view', args=[[]])
+        published.set()
+        for consumer in consumers:
+            consumer.join()
+        seconds = time.time() - start
+        if errors:
+            raise errors[0]
+
+        done, _ = metrics.get_histogram(
+            'phase_seconds', database=DB_NAME,
+            task='ir.ui.view.search_count', phase='execute'
+        )
+        count, wait = metrics.get_histogram(
+            'queue_wait_seconds', database=DB_NAME,
+            task='ir.ui.view.search_count'
+        )
+        results['end_to_end.%02d' % concurrency] = {
+            'concurrency': concurrency,
+            'calls': done,
+            'calls_per_second': done / seconds,
+            'queue_wait_us': wait / count * 1e6 if count else 0,
+        }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the changes from the baseline and return the regressions.
+    """
+    regressions = []
+    for name in sorted(results):
+        changes = {}
+        for metric, value in sorted(results[name].iteritems()):
+            higher_is_better = direction(metric)
+            base = baseline.get(name, {}).get(metric)
+            if higher_is_better is None or not base:
+                continue
+            change = 100. * (value - base) / base
+            changes[metric] = '%+.1f%%' % change
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((name, metric, base, value))
+        if changes:
+            report(name, **changes)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--calls', type=int, default=CALLS,
+        help='The number of calls of each benchmark'
+    )
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument(
+        '--compare', metavar='BASELINE',
+        help='Compare the results to the ones written to this file'
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=10,
+        help='The change in percent above which a metric regressed'
+    )
+    options = parser.parse_args()
+
+    try:
+        trytond.tests.test_tryton.install_module('async')
+        Async = POOL.get('async.async')
+        results = {}
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            bench_serialization(Async, results, options.calls)
+        bench_publish(Async, results, options.calls)
+        bench_execute(Async, results, options.calls)
+        if DB_NAME == ':memory:':
+            print 'end_to_end skipped: the database is only in this thread'
+        else:
+            bench_end_to_end(Async, results, options.calls)
+    finally:
+        if DATABASE_PATH is not None:
+            shutil.rmtree(DATABASE_PATH)
+
+    for name in sorted(results):
+        report(name, **dict(
+            (metric, '%.2f' % value if isinstance(value, float) else value)
+            for metric, value in results[name].iteritems()
+        ))
+
+    run = {
+        'commit': get_commit(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'database': backend.name(),
+        'calls': options.calls,
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'wb') as fp:
+            json.dump(run, fp, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare, 'rb') as fp:
+            baseline = json.load(fp)
+        print 'Compared to %s:' % baseline['commit']
+        regressions = compare(results, baseline['results'], options.tolerance)
+        for name, metric, base, value in regressions:
+            print 'REGRESSION %s %s: %.2f -> %.2f' % (
+                name, metric, base, value
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
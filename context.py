@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.context
+
+    Smaller transaction contexts in the payloads.
+
+    The context of the transaction is sent with every payload, and it is
+    often larger than the arguments of the call, with the language, the
+    company and the other preferences of the user. With the
+    `minimise_context` setting, the keys whose value is the preference of
+    the user are left out, and the worker adds the preferences of the user
+    back.
+
+    With the `context_fingerprint` setting, the context is not sent at all.
+    It is stored once in the shared state under its fingerprint, which is
+    sent instead. The processes keep the contexts they decoded in an LRU
+    cache by fingerprint, so they only read and decode the contexts they
+    did not see yet. This needs a coordination backend shared by the
+    workers and the dispatching processes, like redis.
+"""
+import hashlib
+import threading
+
+from trytond.cache import LRUDict
+from trytond.model import Model
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond_async import metrics, coordination
+from trytond_async.app import app
+from trytond_async.serialization import json, json_loads, JSONEncoder
+
+_lock = threading.Lock()
+# The decoded contexts by database and fingerprint
+_contexts = LRUDict(app.conf.ASYNC_CONTEXT_CACHE_SIZE)
+
+
+class ContextExpired(Exception):
+    """
+    Raised by the worker when the context of a call is no longer in the
+    shared state, because the call was executed more than `context_ttl`
+    seconds after it was sent.
+    """
+
+
+def get_preferences():
+    return Pool().get('res.user').get_preferences(context_only=True)
+
+
+def minimise(context):
+    """
+    Return the context without the keys whose value is the preference of
+    the user, and the sorted list of the preferences which are not in the
+    context.
+    """
+    preferences = get_preferences()
+    minimised = dict(
+        (key, value) for key, value in context.iteritems()
+        if key not in preferences or preferences[key] != value
+    )
+    unset = sorted(key for key in preferences if key not in context)
+    return minimised, unset
+
+
+def expand(context, unset=()):
+    """
+    Return the context with the preferences of the user added back, except
+    the `unset` ones.
+    """
+    expanded = get_preferences()
+    for key in unset:
+        expanded.pop(key, None)
+    expanded.update(context)
+    return expanded
+
+
+def has_records(value):
+    if isinstance(value, Model):
+        return True
+    if isinstance(value, (list, tuple)):
+        return any(has_records(item) for item in value)
+    if isinstance(value, dict):
+        return any(has_records(item) for item in value.itervalues())
+    return False
+
+
+def shared_key(database, fingerprint):
+    return 'trytond_async:context:%s:%s' % (database, fingerprint)
+
+
+def share(context):
+    """
+    Store the context in the shared state and return its fingerprint and
+    its serialized data, or `(None, None)` if it can not be shared. The
+    contexts with records are not shared, as their records belong to the
+    transaction of a call.
+
+    The context is stored again by every call, so that it does not expire
+    while it is still used and is back if the shared state lost it.
+    """
+    if not context or has_records(context):
+        return None, None
+    data = json.dumps(context, cls=JSONEncoder, sort_keys=True)
+    fingerprint = hashlib.sha1(data).hexdigest()
+    coordination.get_backend().set(
+        shared_key(Transaction().cursor.database_name, fingerprint), data,
+        app.conf.ASYNC_CONTEXT_TTL
+    )
+    return fingerprint, data
+
+
+def lookup(fingerprint):
+    """
+    Return a copy of the context with the fingerprint, from the cache of the
+    process or else from the shared state.
+    """
+    key = (Transaction().cursor.database_name, fingerprint)
+    with _lock:
+        context = _contexts.pop(key, None)
+        if context is not None:
+            # Most recently used last
+            _contexts[key] = context
+    if context is not None:
+        metrics.incr('context_cache_hit')
+        return dict(context)
+
+    metrics.incr('context_cache_miss')
+    data = coordination.get_backend().get(shared_key(*key))
+    if data is None:
+        raise ContextExpired('The context %s expired' % fingerprint)
+    context = json_loads(data)
+    with _lock:
+        _contexts[key] = context
+    return dict(context)
+
+
+def clear():
+    """
+    Empty the caches of the process.
+    """
+    with _lock:
+        _contexts.clear()
@@ -0,0 +1,218 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.coordination
+
+    State shared by the workers and the processes dispatching tasks, like
+    the registry of pending tasks used to coalesce identical calls, and the
+    leases and token buckets used to limit the concurrency and the rate of
+    tasks.
+
+    The state is kept in redis when the `coordination_url` setting (which
+    defaults to the result backend) is a redis url. Otherwise it is kept in
+    the memory of the process, which is only allowed in the test mode and
+    with the local executors, whose calls all run in the process: the
+    workers would not see the state of the dispatching processes.
+"""
+import time
+import threading
+
+from trytond_async.app import app
+from trytond_async.executors import EXECUTORS
+
+
+class LocalBackend(object):
+    """
+    Keep the shared state in the memory of the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _get(self, key):
+        value, expires = self._values.get(key, (None, None))
+        if expires is not None and expires < time.time():
+            del self._values[key]
+            return None
+        return value
+
+    def add(self, key, value, ttl):
+        """
+        Set the key to the value for `ttl` seconds if it is not set, and
+        return True if it was set.
+        """
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._values[key] = (value, time.time() + ttl)
+            return True
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def incr(self, key, ttl):
+        """
+        Increment the counter of the key, which expires `ttl` seconds after
+        its last increment, and return its new value.
+        """
+        with self._lock:
+            value = (self._get(key) or 0) + 1
+            self._values[key] = (value, time.time() + ttl)
+            return value
+
+    def acquire_lease(self, key, token, limit, ttl):
+        """
+        Take one of the `limit` leases of the key for `ttl` seconds and
+        return True, or return False if they are all taken.
+        """
+        now = time.time()
+        with self._lock:
+            leases = dict(
+                (t, expires)
+                for t, expires in self._values.get(key, {}).iteritems()
+                if expires > now
+            )
+            acquired = len(leases) < limit
+            if acquired:
+                leases[token] = now + ttl
+            self._values[key] = leases
+            return acquired
+
+    def release_lease(self, key, token):
+        with self._lock:
+            self._values.get(key, {}).pop(token, None)
+
+    def take_token(self, key, rate):
+        """
+        Take a token from the bucket of the key, which is refilled with
+        `rate` tokens per second and holds at most one second of tokens.
+        Return 0 if a token was taken, or else the number of seconds to
+        wait for the next token.
+        """
+        burst = max(1.0, rate)
+        now = time.time()
+        with self._lock:
+            tokens, timestamp = self._values.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - timestamp) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._values[key] = (tokens, now)
+            return wait
+
+
+# KEYS: the sorted set of leases, scored by expiry
+# ARGV: now, ttl, limit, token
+ACQUIRE_LEASE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[2]), ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2]) * 1000))
+    return 1
+end
+return 0
+"""
+
+# KEYS: the hash of the bucket
+# ARGV: now, rate
+TAKE_TOKEN = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = math.max(1, rate)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - timestamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', ARGV[1])
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBackend(object):
+    """
+    Keep the shared state in redis.
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self._acquire_lease = self.client.register_script(ACQUIRE_LEASE)
+        self._take_token = self.client.register_script(TAKE_TOKEN)
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(key, value, px=int(ttl * 1000), nx=True))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, px=int(ttl * 1000))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def incr(self, key, ttl):
+        pipe = self.client.pipeline()
+        pipe.incr(key)
+        pipe.pexpire(key, int(ttl * 1000))
+        value, _ = pipe.execute()
+        return value
+
+    def acquire_lease(self, key, token, limit, ttl):
+        return bool(self._acquire_lease(
+            keys=[key], args=[repr(time.time()), ttl, limit, token]
+        ))
+
+    def release_lease(self, key, token):
+        self.client.zrem(key, token)
+
+    def take_token(self, key, rate):
+        return float(self._take_token(
+            keys=[key], args=[repr(time.time()), rate]
+        ))
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Return the backend of the shared state for the `coordination_url`
+    setting.
+
+    The features using the shared state, like the deduplication, the
+    limits, `Async.map` and the context fingerprints, are refused without a
+    redis url unless the state does not need to be shared.
+    """
+    global _backend
+    if _backend is None:
+        url = app.conf.ASYNC_COORDINATION_URL
+        if url and url.startswith('redis'):
+            _backend = RedisBackend(url)
+        elif app.conf.get('TEST_MODE', False) or \
+                EXECUTORS[app.conf.ASYNC_EXECUTOR].local:
+            _backend = LocalBackend()
+        else:
+            raise RuntimeError(
+                'The coordination_url setting must be a redis url to share '
+                'the state of the tasks with the workers'
+            )
+    return _backend
@@ -0,0 +1,314 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.executors
+
+    The executors which run the calls sent by `Async`. The default one sends
+    them to the celery workers through the broker. The local ones run them
+    on this machine, in a pool of threads or of processes, without a broker.
+
+    The local executors execute the same celery tasks with `Task.apply`, so
+    that each call runs in its own transaction exactly like on a worker.
+    Their results are kept in the memory of the process which sent the
+    calls, for as long as it holds them and, once they are finished, among
+    the last `executor_results` ones, like the results of the calls retried
+    out of a batch which are only read by their id.
+"""
+import time
+import datetime
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from weakref import WeakValueDictionary
+from uuid import uuid4
+
+from celery.exceptions import TimeoutError, TaskRevokedError
+from kombu.serialization import dumps, loads
+from trytond import backend
+from trytond.cache import LRUDict
+
+from trytond_async.app import app
+
+
+class CeleryExecutor(object):
+    """
+    Send the calls to the celery workers.
+    """
+    local = False
+
+    def submit(self, task, args, kwargs=None, **celery_options):
+        """
+        Send a call of the celery task and return its result.
+        """
+        return task.apply_async(args, kwargs, **celery_options)
+
+    def result(self, task, task_id):
+        """
+        Return the result of the call of the task with the given id.
+        """
+        return task.AsyncResult(task_id)
+
+
+def to_utc(when):
+    """
+    Return the datetime as a naive datetime in UTC. Naive datetimes, like
+    the ETA of most calls, are in UTC already.
+    """
+    if when.tzinfo is not None:
+        when = when.replace(tzinfo=None) - when.utcoffset()
+    return when
+
+
+class LocalResult(object):
+    """
+    The result of a call run by a local executor. It behaves like the
+    `AsyncResult` of celery.
+    """
+
+    def __init__(self, task_id):
+        self.id = task_id
+        self.status = 'PENDING'
+        self._value = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def set(self, outcome):
+        with self._lock:
+            self.status, self._value = outcome
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback` with this result once it is ready, from the thread
+        which sets it, or right away if it is ready.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def ready(self):
+        return self._event.is_set()
+
+    @property
+    def result(self):
+        if self.status == 'SUCCESS':
+            # Decoded like a result read from the result backend, in the
+            # transaction of the reader.
+            content_type, encoding, data = self._value
+            return loads(data, content_type, encoding)
+        return self._value
+
+    def get(self, timeout=None, propagate=True, **kwargs):
+        if not self._event.wait(timeout):
+            raise TimeoutError('The operation timed out.')
+        if self.status in ('FAILURE', 'REVOKED') and propagate:
+            raise self._value
+        return self.result
+
+    wait = get  # Deprecated old syntax
+
+
+def run_task(task_name, args, kwargs, task_id, buffers=()):
+    """
+    Run the call of the task in this process, retrying it like a worker
+    would, and return its status and its encoded result.
+
+    :param buffers: The indexes of the arguments which are buffers, which
+                    are passed as strings to be sent to other processes.
+    """
+    task = app.tasks[task_name]
+    args = [
+        buffer(arg) if index in buffers else arg
+        for index, arg in enumerate(args)
+    ]
+    retries = 0
+    while True:
+        try:
+            result = task.apply(
+                args, kwargs, task_id=task_id, retries=retries
+            )
+        except Exception, exc:
+            # Otherwise the result would never be set
+            return 'FAILURE', exc
+        if result.status != 'RETRY':
+            break
+        # The tasks raise a plain Retry when they are applied, with the
+        # exception of the failure for retries and without one for
+        # requeued calls, which do not count as retries.
+        retry = result.result
+        if retry.exc is not None:
+            retries += 1
+        time.sleep(retry.when or 0)
+    if result.status == 'SUCCESS':
+        return 'SUCCESS', dumps(
+            result.result, app.conf.CELERY_RESULT_SERIALIZER
+        )
+    return result.status, result.result
+
+
+class LocalExecutor(object):
+    """
+    The base of the executors which run the calls in a local pool of
+    `workers` threads or processes, by default one per CPU.
+    """
+    local = True
+
+    def __init__(self, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self._pool = None
+        self._lock = threading.Lock()
+        self._results = WeakValueDictionary()
+        # The last finished results, which nothing else may hold
+        self._finished = LRUDict(app.conf.ASYNC_EXECUTOR_RESULTS)
+
+    def create_pool(self):
+        raise NotImplementedError
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = self.create_pool()
+            return self._pool
+
+    def submit(
+            self, task, args, kwargs=None, task_id=None, countdown=None,
+            eta=None, expires=None, **celery_options):
+        """
+        Run a call of the celery task in the pool and return its result.
+        The call is delayed by its `countdown` or until its `eta`, and it
+        is revoked instead of run if it is not started before `expires`, in
+        seconds or as a datetime, like on a worker. The options of celery
+        which only apply to the broker, like the queue, are ignored.
+        """
+        result = self.result(task, task_id or unicode(uuid4()))
+        result.add_done_callback(self._keep)
+        if eta is not None:
+            countdown = (
+                to_utc(eta) - datetime.datetime.utcnow()
+            ).total_seconds()
+        if isinstance(expires, datetime.datetime):
+            expires = (
+                to_utc(expires) - datetime.datetime.utcnow()
+            ).total_seconds()
+        start = self._start
+        if expires is not None:
+            deadline = time.time() + expires
+
+            def start(task, args, kwargs, result):
+                if time.time() > deadline:
+                    result.set(('REVOKED', TaskRevokedError('expired')))
+                else:
+                    self._start(task, args, kwargs, result)
+        if countdown and countdown > 0:
+            timer = threading.Timer(
+                countdown, start, (task, args, kwargs, result)
+            )
+            timer.daemon = True
+            timer.start()
+        else:
+            start(task, args, kwargs, result)
+        return result
+
+    def _start(self, task, args, kwargs, result):
+        buffers = [
+            index for index, arg in enumerate(args)
+            if isinstance(arg, buffer)
+        ]
+        self.pool.apply_async(run_task, (
+            task.name,
+            [str(arg) if isinstance(arg, buffer) else arg for arg in args],
+            kwargs or {},
+            result.id,
+            buffers,
+        ), callback=result.set)
+
+    def _keep(self, result):
+        with self._lock:
+            self._finished[result.id] = result
+
+    def result(self, task, task_id):
+        # The result may be asked for before the call is submitted, like
+        # the results of the calls sent after commit.
+        with self._lock:
+            result = self._results.get(task_id)
+            if result is None:
+                result = self._results[task_id] = LocalResult(task_id)
+            return result
+
+
+class ThreadExecutor(LocalExecutor):
+    """
+    Run the calls in a pool of threads of this process. This suits the
+    calls which mostly wait for the database.
+    """
+
+    def create_pool(self):
+        return ThreadPool(self.workers)
+
+
+# The connections inherited by a child of the process pool
+_inherited = []
+
+
+def init_process():
+    """
+    Initialise a child of the process pool. The connections to the
+    databases inherited from the parent are forgotten without being closed,
+    as closing them would close them for the parent too, so that the child
+    opens its own. The calls sent by the calls of the child run in a pool
+    of threads of the child.
+    """
+    global _executor
+    Database = backend.get('Database')
+    databases = getattr(Database, '_databases', None)
+    if databases:
+        _inherited.append(dict(databases))
+        databases.clear()
+    _executor = ThreadExecutor()
+
+
+class ProcessExecutor(LocalExecutor):
+    """
+    Run the calls in a pool of processes forked from this one. This suits
+    the calls which are bound by the CPU.
+    """
+
+    def create_pool(self):
+        # The children are forked from a new thread, so that they do not
+        # inherit the transaction of the calling thread.
+        pools = []
+        thread = threading.Thread(target=lambda: pools.append(
+            multiprocessing.Pool(self.workers, initializer=init_process)
+        ))
+        thread.start()
+        thread.join()
+        return pools[0]
+
+
+EXECUTORS = {
+    'celery': CeleryExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+}
+
+_executor = None
+
+
+def get_executor():
+    """
+    Return the executor for the `executor` setting.
+    """
+    global _executor
+    if _executor is None:
+        Executor = EXECUTORS[app.conf.ASYNC_EXECUTOR]
+        if Executor.local:
+            _executor = Executor(app.conf.ASYNC_EXECUTOR_WORKERS)
+        else:
+            _executor = Executor()
+    return _executor
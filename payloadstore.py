@@ -0,0 +1,202 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.payloadstore
+
+    A side store for payloads and binary arguments too large to travel
+    through the broker. Only a reference to the stored data is sent with
+    the task and the worker reads the data from the store when it executes
+    the task.
+
+    The store is a directory which must be shared by the workers and the
+    processes dispatching the tasks.
+"""
+import os
+import time
+import errno
+import mmap
+from uuid import uuid4
+
+from trytond.config import config
+
+from trytond_async import metrics
+from trytond_async.serialization import json_loads, JSONEncoder, JSONDecoder, \
+    MsgPackEncoder, MsgPackDecoder
+
+
+class PayloadStore(object):
+    """
+    Store data in files named by a random key, under a directory per
+    database.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path or config.get(
+            'async', 'payload_store_path',
+            default=os.path.join(config.get('database', 'path'), 'async')
+        )
+
+    def filename(self, database, key):
+        return os.path.join(self.path, database, key)
+
+    def put(self, database, data):
+        """
+        Store the data and return its key.
+        """
+        key = uuid4().hex
+        directory = os.path.join(self.path, database)
+        try:
+            os.makedirs(directory)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        filename = self.filename(database, key)
+        # Write to a temporary file first, so that a reader never sees a
+        # partially written file.
+        with open(filename + '.tmp', 'wb') as fp:
+            fp.write(data)
+        os.rename(filename + '.tmp', filename)
+        metrics.incr('payload_stored', database=database)
+        metrics.incr('payload_stored_bytes', len(data), database=database)
+        return key
+
+    def read(self, database, key):
+        """
+        Return the data stored with the key as a string.
+        """
+        with open(self.filename(database, key), 'rb') as fp:
+            return fp.read()
+
+    def map(self, database, key):
+        """
+        Return the data stored with the key as a buffer on a read-only
+        memory map of the file, so that it is only paged in when used.
+        """
+        with open(self.filename(database, key), 'rb') as fp:
+            return buffer(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def delete(self, database, key):
+        try:
+            os.unlink(self.filename(database, key))
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def collect(self, max_age):
+        """
+        Delete the data stored more than `max_age` seconds ago. This
+        collects the data of tasks which never completed.
+
+        Returns the number of deleted files.
+        """
+        if not os.path.isdir(self.path):
+            return 0
+        limit = time.time() - max_age
+        count = 0
+        for database in os.listdir(self.path):
+            directory = os.path.join(self.path, database)
+            for name in os.listdir(directory):
+                filename = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(filename) < limit:
+                        os.unlink(filename)
+                        count += 1
+                except OSError, exc:
+                    # Deleted by the worker in the meantime
+                    if exc.errno != errno.ENOENT:
+                        raise
+        metrics.incr('payload_collected', count)
+        return count
+
+
+store = PayloadStore()
+
+
+class StoredBuffer(object):
+    """
+    A reference to binary data moved to the store. It is decoded to a
+    buffer on the stored data in the transaction of the worker.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+
+def load_buffer(key):
+    # Imported here as the transaction is only used when decoding on the
+    # worker.
+    from trytond.transaction import Transaction
+    return store.map(Transaction().cursor.database_name, key)
+
+JSONEncoder.register(
+    StoredBuffer,
+    lambda o: {
+        '__class__': 'StoredBuffer',
+        'key': o.key,
+    })
+JSONDecoder.register('StoredBuffer', lambda dct: load_buffer(dct['key']))
+MsgPackEncoder.register(StoredBuffer, 7, lambda o: o.key)
+MsgPackDecoder.register(7, load_buffer)
+
+
+class StoredValue(object):
+    """
+    A reference to a value serialized to JSON and moved to the store, like
+    a large task result. Unlike `StoredBuffer`, it carries its database so
+    that it can be decoded outside of a transaction.
+    """
+
+    def __init__(self, database, key):
+        self.database = database
+        self.key = key
+
+
+def load_value(database, key):
+    return json_loads(store.read(database, key))
+
+JSONEncoder.register(
+    StoredValue,
+    lambda o: {
+        '__class__': 'StoredValue',
+        'database': o.database,
+        'key': o.key,
+    })
+JSONDecoder.register(
+    'StoredValue', lambda dct: load_value(dct['database'], dct['key'])
+)
+MsgPackEncoder.register(StoredValue, 9, lambda o: (o.database, o.key))
+MsgPackDecoder.register(9, lambda value: load_value(*value))
+
+
+def store_buffers(value, threshold, database, keys):
+    """
+    Return the value with the buffers of at least `threshold` bytes moved
+    to the store and replaced by a reference. The keys of the stored data
+    are appended to `keys`. The containers are copied only if something in
+    them was replaced.
+    """
+    if isinstance(value, buffer):
+        if len(value) < threshold:
+            return value
+        key = store.put(database, value)
+        keys.append(key)
+        return StoredBuffer(key)
+    if isinstance(value, (list, tuple)):
+        stored = [
+            store_buffers(item, threshold, database, keys) for item in value
+        ]
+        if any(a is not b for a, b in zip(stored, value)):
+            return stored
+        return value
+    if isinstance(value, dict):
+        stored = dict(
+            (key, store_buffers(item, threshold, database, keys))
+            for key, item in value.iteritems()
+        )
+        if any(stored[key] is not value[key] for key in value):
+            return stored
+        return value
+    return value
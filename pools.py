@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.pools
+
+    The pools of the databases resident in a worker process.
+
+    The pool of a database, with its models and their caches, is initialised
+    by the first call a process executes on the database, and Tryton keeps
+    it for the life of the process. A worker serving many databases ends up
+    holding the pools of all of them. With the `max_pools` and
+    `max_pools_memory` settings, the least recently used pools are released
+    once there are more of them, or once they take more memory, than
+    allowed. A pool is never released while a call uses it.
+
+    The memory of a pool is approximated by the growth of the resident size
+    of the process while the pool is initialised, which is only known on
+    Linux. Python seldom gives memory back to the system, so releasing
+    pools bounds the growth of the process rather than shrinking it: the
+    memory of a released pool is reused by the next one.
+"""
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond_async import metrics
+from trytond_async.app import app
+
+_lock = threading.Lock()
+# The approximate memory in bytes of the resident pools, by database, least
+# recently used first
+_pools = OrderedDict()
+# The number of calls using the pool of each database
+_users = {}
+
+
+def get_rss():
+    """
+    Return the resident size of the process in bytes, or None if it is not
+    known.
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def prepare(database):
+    """
+    Make the pool of the database ready for use and the most recently used
+    one, releasing the least recently used ones over the limits. Return
+    True if it was initialised.
+    """
+    with _lock:
+        resident = database in Pool.database_list()
+        if resident:
+            added = database not in _pools
+            _pools[database] = _pools.pop(database, 0)
+    if resident:
+        metrics.incr('pool_hit', database=database)
+        if added:
+            # Initialised by someone else, like the tests
+            evict()
+        return False
+
+    metrics.incr('pool_miss', database=database)
+    before = get_rss()
+    with Transaction().start(database, 0, readonly=True):
+        Pool(database).init()
+    after = get_rss()
+    with _lock:
+        _pools[database] = (
+            max(0, after - before) if None not in (before, after) else 0
+        )
+    evict()
+    return True
+
+
+@contextmanager
+def using(database):
+    """
+    Keep the pool of the database resident while the calls of the block
+    use it.
+    """
+    with _lock:
+        _users[database] = _users.get(database, 0) + 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _users[database] -= 1
+            if not _users[database]:
+                del _users[database]
+
+
+def evict():
+    """
+    Release the least recently used pools which are not in use while there
+    are more pools than the `max_pools` setting, or while they take more
+    megabytes than the `max_pools_memory` setting. Return the databases
+    whose pool was released.
+    """
+    max_pools = app.conf.ASYNC_MAX_POOLS
+    max_memory = app.conf.ASYNC_MAX_POOLS_MEMORY * 1024 * 1024
+    if not max_pools and not max_memory:
+        return []
+
+    evicted = []
+    # The pools are released under the lock, so that they are not used
+    # again in the meantime.
+    with _lock:
+        count, memory = len(_pools), sum(_pools.itervalues())
+        for database, size in _pools.items():
+            if (not max_pools or count <= max_pools) and \
+                    (not max_memory or memory <= max_memory):
+                break
+            if database in _users:
+                continue
+            del _pools[database]
+            release(database)
+            evicted.append(database)
+            count -= 1
+            memory -= size
+    for database in evicted:
+        metrics.incr('pool_evicted', database=database)
+    return evicted
+
+
+def release(database):
+    """
+    Release the pool of the database, its caches and its connections.
+    """
+    Pool.stop(database)
+    Cache.drop(database)
+    Database = backend.get('Database')
+    Database(database).close()
+    # The connection pool of each database is kept by the class
+    databases = getattr(Database, '_databases', None)
+    if databases:
+        databases.pop(database, None)
@@ -0,0 +1,253 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.profiling
+
+    Profile the calls executed by the workers, to find out why a method got
+    slower in production.
+
+    A sampled fraction of the calls (the `profile_rate` setting) and all the
+    calls of the model.methods of the `profile_tasks` setting are profiled,
+    either with cProfile or with a stack sampler, which interrupts the call
+    every few milliseconds to record its stack and has a much lower
+    overhead. The SQL queries of the profiled calls are counted too.
+
+    The profiles are aggregated by model.method in each process and written
+    to the directory of the `profile_path` setting every
+    `profile_flush_interval` seconds, in one file per model.method, process
+    and hour:
+
+        * `<model.method>.<pid>.<hour>.prof` with cProfile, to be read with
+          `pstats` or a viewer like snakeviz.
+        * `<model.method>.<pid>.<hour>.folded` with the sampler, with one
+          line per stack and its number of samples, to be drawn as a flame
+          graph.
+
+    Only the `profile_max_files` most recent files are kept. When profiling
+    is disabled, which is the default, the calls are not wrapped at all.
+"""
+import os
+import time
+import errno
+import random
+import signal
+import cProfile
+import pstats
+import threading
+from collections import defaultdict
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+from trytond_async import metrics
+from trytond_async.app import app
+
+
+class StackSampler(object):
+    """
+    Count the stacks of the main thread every `interval` seconds of CPU
+    time, from the signal of a profiling timer.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._handler = None
+
+    @staticmethod
+    def available():
+        # Signals are only delivered to the main thread
+        return isinstance(
+            threading.current_thread(), threading._MainThread
+        )
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (
+                code.co_name, code.co_filename, code.co_firstlineno
+            ))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._handler = signal.signal(signal.SIGPROF, self.sample)
+        # Restart the system calls interrupted by a sample, like the reads
+        # of the queries, instead of failing them.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._handler or signal.SIG_DFL)
+
+
+class Profiler(object):
+    """
+    The hook which profiles the sampled calls and aggregates their profiles
+    by model.method.
+    """
+    # Number of seconds of the profiles aggregated in a file
+    period = 3600
+
+    def __init__(
+            self, path, rate=0, tasks=(), sampler=False, max_files=100,
+            flush_interval=60):
+        self.path = path
+        self.rate = rate
+        self.tasks = set(tasks)
+        self.sampler = sampler
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # The aggregated profiles of the current period, by model.method:
+        # a pstats.Stats or a dictionary of the number of samples by stack
+        self._profiles = {}
+        self._period = None
+        self._flushed = time.time()
+
+    def sampled(self, name):
+        return name in self.tasks or (
+            self.rate and random.random() < self.rate
+        )
+
+    def __call__(self, func, payload):
+        """
+        Return `func(payload)`, profiling it if it is sampled.
+        """
+        name = '%s.%s' % (payload['model_name'], payload['method_name'])
+        if not self.sampled(name):
+            return func(payload)
+
+        # The queries are counted by wrapping the cursor of the transaction
+        cursor = Transaction().cursor
+        wrapped = cursor.__dict__.get('execute')
+        execute = cursor.execute
+        queries = [0]
+
+        def counting_execute(*args, **kwargs):
+            queries[0] += 1
+            return execute(*args, **kwargs)
+        cursor.execute = counting_execute
+
+        if self.sampler and StackSampler.available():
+            profile = StackSampler()
+            start_profile, stop_profile = profile.start, profile.stop
+        else:
+            profile = cProfile.Profile()
+            start_profile, stop_profile = profile.enable, profile.disable
+        start = time.time()
+        start_profile()
+        try:
+            return func(payload)
+        finally:
+            stop_profile()
+            if wrapped is None:
+                del cursor.execute
+            else:
+                cursor.execute = wrapped
+            metrics.incr('profiled_calls', task=name)
+            metrics.incr('profiled_seconds', time.time() - start, task=name)
+            metrics.incr('profiled_sql_queries', queries[0], task=name)
+            self.add(name, profile)
+
+    def add(self, name, profile):
+        now = time.time()
+        period = int(now // self.period)
+        with self._lock:
+            if period != self._period:
+                # The profiles of the previous period are complete
+                self._flush()
+                self._profiles = {}
+                self._period = period
+            aggregated = self._profiles.get(name)
+            if isinstance(profile, StackSampler):
+                if aggregated is None:
+                    aggregated = self._profiles[name] = defaultdict(int)
+                for stack, count in profile.stacks.iteritems():
+                    aggregated[stack] += count
+            elif aggregated is None:
+                self._profiles[name] = pstats.Stats(profile)
+            else:
+                aggregated.add(profile)
+            if time.time() - self._flushed >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """
+        Write the aggregated profiles of the current period, and remove the
+        oldest files over `max_files`.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._flushed = time.time()
+        if not self._profiles:
+            return
+        try:
+            os.makedirs(self.path)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        for name, profile in self._profiles.iteritems():
+            filename = os.path.join(self.path, '%s.%d.%d' % (
+                name, os.getpid(), self._period
+            ))
+            if isinstance(profile, pstats.Stats):
+                filename += '.prof'
+                profile.dump_stats(filename + '.tmp')
+            else:
+                filename += '.folded'
+                with open(filename + '.tmp', 'wb') as fp:
+                    for stack, count in sorted(profile.iteritems()):
+                        fp.write('%s %d\n' % (stack, count))
+            os.rename(filename + '.tmp', filename)
+        self.rotate()
+
+    def rotate(self):
+        filenames = []
+        for name in os.listdir(self.path):
+            if not name.endswith(('.prof', '.folded')):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                filenames.append((os.path.getmtime(filename), filename))
+            except OSError:
+                # Removed by another process in the meantime
+                pass
+        filenames.sort()
+        for _, filename in filenames[:-self.max_files]:
+            try:
+                os.unlink(filename)
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+
+
+# The profiler hook of the process, or None if profiling is disabled
+hook = None
+
+
+def configure():
+    """
+    Set the profiler hook according to the settings. This is done when the
+    module is imported.
+    """
+    global hook
+    conf = app.conf
+    if not conf.ASYNC_PROFILE_RATE and not conf.ASYNC_PROFILE_TASKS:
+        hook = None
+        return
+    hook = Profiler(
+        conf.ASYNC_PROFILE_PATH or os.path.join(
+            config.get('database', 'path'), 'async_profiles'
+        ),
+        rate=conf.ASYNC_PROFILE_RATE,
+        tasks=conf.ASYNC_PROFILE_TASKS,
+        sampler=conf.ASYNC_PROFILER == 'sampler',
+        max_files=conf.ASYNC_PROFILE_MAX_FILES,
+        flush_interval=conf.ASYNC_PROFILE_FLUSH_INTERVAL,
+    )
+
+configure()
@@ -0,0 +1,136 @@
+# -*- coding: UTF-8 -*-
+"""
+    trytond_async.scheduled
+
+    A store in the database for the calls delayed for a long time, like
+    retries with a long backoff or calls sent with a large countdown.
+
+    Celery keeps the messages with an ETA in the memory of the worker which
+    received them until they are due, without acknowledging them. Tens of
+    thousands of them bloat the workers, starve their prefetch, and are
+    delivered again by brokers with a visibility timeout, like SQS or
+    redis, when they are not acknowledged in time. Instead, the calls
+    delayed by at least the `schedule_threshold` setting are kept in the
+    `async.scheduled` table, indexed on their due time, and published by the
+    `publish_scheduled` task, in batches, when they are due. Calls delayed
+    less still use the ETA of the broker.
+"""
+import datetime
+from uuid import uuid4
+
+from sql import Table
+from trytond.model import ModelSQL, fields
+from trytond.transaction import Transaction
+
+from trytond_async import metrics
+from trytond_async.app import app
+from trytond_async.executors import get_executor, to_utc
+from trytond_async.serialization import json, json_loads, JSONEncoder
+
+
+def get_due(celery_options):
+    """
+    Return the time, in UTC, at which the call sent with the given celery
+    options is due if it must be kept in `async.scheduled` until then, or
+    None if it is sent right away.
+    """
+    threshold = app.conf.ASYNC_SCHEDULE_THRESHOLD
+    if not threshold or get_executor().local:
+        # The local executors do not use the broker
+        return None
+    now = datetime.datetime.utcnow()
+    if celery_options.get('countdown'):
+        due = now + datetime.timedelta(seconds=celery_options['countdown'])
+    elif celery_options.get('eta'):
+        due = to_utc(celery_options['eta'])
+    else:
+        return None
+    if (due - now).total_seconds() < threshold:
+        return None
+    return due
+
+
+class ScheduledCall(ModelSQL):
+    "Scheduled Call"
+    __name__ = 'async.scheduled'
+
+    due = fields.DateTime('Due', required=True, select=True)
+    task = fields.Char('Task', required=True)
+    call = fields.Text('Call', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ScheduledCall, cls).__setup__()
+        cls._order.insert(0, ('due', 'ASC'))
+
+    @classmethod
+    def schedule(cls, due, task, args, kwargs=None, **celery_options):
+        """
+        Keep the call of the celery task until `due` and return its result.
+        The call is stored and committed in a transaction of its own, so it
+        is sent even if the current transaction is rolled back, like a call
+        sent to the broker.
+        """
+        celery_options.pop('countdown', None)
+        celery_options.pop('eta', None)
+        task_id = celery_options.setdefault('task_id', unicode(uuid4()))
+        with Transaction().new_cursor():
+            cls.create([{
+                'due': due,
+                'task': task.name,
+                'call': json.dumps({
+                    'args': list(args),
+                    'kwargs': kwargs,
+                    'celery_options': celery_options,
+                }, cls=JSONEncoder),
+            }])
+            Transaction().cursor.commit()
+        metrics.incr('calls_scheduled', task=task.name)
+        return get_executor().result(task, task_id)
+
+    @classmethod
+    def publish_due(cls, batch_size=1000, lookahead=0):
+        """
+        Send the calls which are due within `lookahead` seconds, oldest
+        first, in batches of `batch_size` calls, and return their number.
+        The calls which are not due yet are sent with their due time as
+        ETA, so that they are not late by up to `lookahead` seconds.
+
+        Each batch is deleted and committed once sent, so a call may be sent
+        twice if the commit fails but it is never lost.
+        """
+        cursor = Transaction().cursor
+        table = Table(cls._table)
+        executor = get_executor()
+        count = 0
+        while True:
+            now = datetime.datetime.utcnow()
+            cursor.lock(cls._table)
+            cursor.execute(*table.select(
+                table.id, table.due, table.task, table.call,
+                where=table.due <= now + datetime.timedelta(seconds=lookahead),
+                order_by=[table.due.asc, table.id.asc],
+                limit=batch_size,
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                return count
+            for _, due, task, call in rows:
+                call = json_loads(call)
+                if due > now:
+                    call['celery_options']['eta'] = due
+                else:
+                    metrics.incr(
+                        'scheduled_lateness_seconds',
+                        (now - due).total_seconds(), task=task
+                    )
+                executor.submit(
+                    app.tasks[task], call['args'], call['kwargs'],
+                    **call['celery_options']
+                )
+                metrics.incr('scheduled_published', task=task)
+            cursor.execute(*table.delete(
+                where=table.id.in_([row[0] for row in rows])
+            ))
+            cursor.commit()
+            count += len(rows)
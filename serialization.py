@@ -4,6 +4,7 @@
 
     Backports the 3.4 implementation of JSONEncoder and Decoder.
 """
+import zlib
 import functools
 import datetime
 from decimal import Decimal
@@ -12,11 +13,64 @@ try:
 except ImportError:
     import json
 import base64
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 from trytond.model import Model
 from trytond.pool import Pool
 from trytond.tools import safe_eval
 
 
+# The key of the objects tagged with their class, as found in the JSON data
+TAG = '"__class__"'
+
+
+def find_serializer(serializers, klass):
+    """
+    Return the serializer registered for the class or for its nearest base
+    class, or None.
+    """
+    for base in klass.__mro__:
+        serializer = serializers.get(base)
+        if serializer is not None:
+            return serializer
+    return None
+
+
+def dispatch_class(obj):
+    """
+    Return the class of the object under which its serializer is cached.
+    The classes of the models are built by each pool, so all the records
+    are serialized as `Model` and the cache does not keep the classes of
+    the pools which are gone.
+    """
+    if isinstance(obj, Model):
+        return Model
+    return type(obj)
+
+
+def has_payload_records(value):
+    """
+    Return True if the value is a payload, or a batch of payloads, called
+    on a record or with records or lists of records as arguments.
+    """
+    if not isinstance(value, dict):
+        return False
+    if 'payloads' in value:
+        return any(
+            has_payload_records(payload) for payload in value['payloads']
+        )
+    if isinstance(value.get('instance'), Model):
+        return True
+    for arg in value.get('args') or ():
+        if isinstance(arg, Model) or (
+                isinstance(arg, (list, tuple)) and arg and
+                isinstance(arg[0], Model)):
+            return True
+    return False
+
+
 class JSONDecoder(object):
 
     decoders = {}
@@ -27,8 +81,10 @@ class JSONDecoder(object):
         cls.decoders[klass] = decoder
 
     def __call__(self, dct):
-        if dct.get('__class__') in self.decoders:
-            return self.decoders[dct['__class__']](dct)
+        if '__class__' in dct:
+            decoder = self.decoders.get(dct['__class__'])
+            if decoder is not None:
+                return decoder(dct)
         return dct
 
 JSONDecoder.register(
@@ -55,14 +111,39 @@ JSONDecoder.register(
 JSONDecoder.register(
     'Decimal', lambda dct: Decimal(dct['decimal'])
 )
-JSONDecoder.register(
-    'Model', lambda dct: safe_eval(dct['repr'], {'Pool': Pool})
-)
+
+
+def decode_model(dct):
+    """
+    Decode a reference to a record or to a list of records of the same
+    model. A list is rebuilt with a single browse call.
+    """
+    if 'repr' in dct:
+        # Format used before references were introduced. It is still
+        # accepted so that messages already queued can be executed.
+        return safe_eval(dct['repr'], {'Pool': Pool})
+    Target = Pool().get(dct['model'])
+    if 'ids' in dct:
+        return Target.browse(dct['ids'])
+    return Target(dct['id'])
+JSONDecoder.register('Model', decode_model)
+
+
+class RecordFound(Exception):
+    """
+    Raised by the encoder when it meets a record while it encodes the value
+    as is, as the lists of records must be collapsed first.
+    """
 
 
 class JSONEncoder(json.JSONEncoder):
 
     serializers = {}
+    # The serializer of each class encoded, found along its MRO, or None
+    _dispatch = {}
+    # False while the value is encoded as is, before its lists of records
+    # are collapsed
+    _collapsed = True
 
     def __init__(self, *args, **kwargs):
         super(JSONEncoder, self).__init__(*args, **kwargs)
@@ -73,15 +154,38 @@ class JSONEncoder(json.JSONEncoder):
     def register(cls, klass, encoder):
         assert klass not in cls.serializers
         cls.serializers[klass] = encoder
+        cls._dispatch.clear()
+
+    def iterencode(self, o, _one_shot=False):
+        # Most values have no records, so they are encoded as is first, by
+        # the C encoder alone when it is available, and the lists of
+        # records are only collapsed, in python, if a record is met. The
+        # payloads known to hold records are collapsed first.
+        if not has_payload_records(o):
+            self._collapsed = False
+            try:
+                return list(
+                    super(JSONEncoder, self).iterencode(o, _one_shot)
+                )
+            except RecordFound:
+                pass
+        self._collapsed = True
+        return super(JSONEncoder, self).iterencode(
+            collapse_records(o), _one_shot
+        )
 
     def default(self, obj):
-        if isinstance(obj, Model):
-            marshaller = self.serializers[Model]
-        else:
-            marshaller = self.serializers.get(
-                type(obj),
-                super(JSONEncoder, self).default
+        klass = dispatch_class(obj)
+        if klass is Model and not self._collapsed:
+            raise RecordFound
+        try:
+            marshaller = self._dispatch[klass]
+        except KeyError:
+            marshaller = self._dispatch[klass] = find_serializer(
+                self.serializers, klass
             )
+        if marshaller is None:
+            return super(JSONEncoder, self).default(obj)
         return marshaller(obj)
 
 
@@ -120,20 +224,240 @@ JSONEncoder.register(
         '__class__': 'buffer',
         'base64': base64.encodestring(o),
     })
+# Decoded as a buffer, like the other binary data
+JSONEncoder.register(bytearray, JSONEncoder.serializers[buffer])
 JSONEncoder.register(
     Decimal,
     lambda o: {
         '__class__': 'Decimal',
         'decimal': str(o),
     })
+
+
+def is_stored(record):
+    return record.id is not None and record.id >= 0
+
+
+class RecordList(object):
+    """
+    A list of stored records of the same model, which is serialized as a
+    single reference holding all their ids.
+    """
+    def __init__(self, model, ids):
+        self.model = model
+        self.ids = ids
+
+
+def encode_model(record):
+    """
+    Encode a reference to a record. Records which are not stored yet can
+    not be referenced by id and are encoded with their representation.
+    """
+    if not is_stored(record):
+        return {'__class__': 'Model', 'repr': repr(record)}
+    return {
+        '__class__': 'Model',
+        'model': record.__name__,
+        'id': record.id,
+    }
+JSONEncoder.register(Model, encode_model)
 JSONEncoder.register(
-    Model,
+    RecordList,
     lambda o: {
         '__class__': 'Model',
-        'repr': repr(o),
+        'model': o.model,
+        'ids': o.ids,
     })
 
 
+class CompressedValue(object):
+    """
+    A value serialized to JSON and compressed with zlib, like a large task
+    result. It is decoded back to the value.
+    """
+    def __init__(self, data):
+        self.data = data
+
+
+def decompress_value(data):
+    return json_loads(zlib.decompress(str(data)))
+JSONEncoder.register(
+    CompressedValue,
+    lambda o: {
+        '__class__': 'CompressedValue',
+        'zlib': o.data,
+    })
+JSONDecoder.register(
+    'CompressedValue', lambda dct: decompress_value(dct['zlib'])
+)
+
+
+def collapse_records(value):
+    """
+    Return the value with the lists of stored records of the same model
+    replaced by a single reference holding all their ids. The containers
+    are copied only if something in them was replaced.
+    """
+    if isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], Model):
+            name = value[0].__name__
+            if all(
+                    isinstance(record, Model) and
+                    record.__name__ == name and is_stored(record)
+                    for record in value):
+                return RecordList(name, [record.id for record in value])
+        items = enumerate(value)
+    elif isinstance(value, dict):
+        items = value.iteritems()
+    else:
+        return value
+    collapsed = None
+    # Only the containers are walked into, as the payloads are mostly made
+    # of scalars
+    for key, item in items:
+        if not isinstance(item, (list, tuple, dict)):
+            continue
+        new_item = collapse_records(item)
+        if new_item is not item:
+            if collapsed is None:
+                collapsed = (
+                    dict(value) if isinstance(value, dict) else list(value)
+                )
+            collapsed[key] = new_item
+    return value if collapsed is None else collapsed
+
+
+class MsgPackDecoder(object):
+    """
+    The `ext_hook` of msgpack which decodes the extension types registered
+    with their code.
+    """
+
+    decoders = {}
+
+    @classmethod
+    def register(cls, code, decoder):
+        assert code not in cls.decoders
+        cls.decoders[code] = decoder
+
+    def __call__(self, code, data):
+        if code in self.decoders:
+            return self.decoders[code](msgpack_loads(data))
+        return msgpack.ExtType(code, data)
+
+MsgPackDecoder.register(
+    1, lambda value: datetime.datetime(*value)
+)
+MsgPackDecoder.register(
+    2, lambda value: datetime.date(*value)
+)
+MsgPackDecoder.register(
+    3, lambda value: datetime.time(*value)
+)
+MsgPackDecoder.register(
+    4, lambda value: buffer(value)
+)
+MsgPackDecoder.register(
+    5, lambda value: Decimal(value)
+)
+
+
+def decode_model_ext(value):
+    if isinstance(value, basestring):
+        return safe_eval(value, {'Pool': Pool})
+    model, ids = value
+    if isinstance(ids, list):
+        return Pool().get(model).browse(ids)
+    return Pool().get(model)(ids)
+MsgPackDecoder.register(6, decode_model_ext)
+MsgPackDecoder.register(8, decompress_value)
+
+
+def json_loads(data, object_hook=None):
+    """
+    Deserialize the JSON data with the tryson objects. The data without any
+    tagged object is decoded without the object hook, which is a call of
+    python code for each object, by the C scanner alone when it is
+    available.
+
+    :param object_hook: The instance of `JSONDecoder` to use.
+    """
+    if TAG not in data:
+        return json.loads(data)
+    return json.loads(data, object_hook=object_hook or JSONDecoder())
+
+
+class MsgPackEncoder(object):
+    """
+    The `default` hook of msgpack which encodes the registered classes as
+    extension types. The encoder of a class returns a value which can be
+    packed by msgpack and is given back to the decoder of the same code.
+    """
+
+    serializers = {}
+    # The code and serializer of each class encoded, found along its MRO,
+    # or None
+    _dispatch = {}
+
+    @classmethod
+    def register(cls, klass, code, encoder):
+        assert klass not in cls.serializers
+        cls.serializers[klass] = (code, encoder)
+        cls._dispatch.clear()
+
+    def __call__(self, obj):
+        klass = dispatch_class(obj)
+        try:
+            serializer = self._dispatch[klass]
+        except KeyError:
+            serializer = self._dispatch[klass] = find_serializer(
+                self.serializers, klass
+            )
+        if serializer is None:
+            raise TypeError(repr(obj) + " is not msgpack serializable")
+        code, encoder = serializer
+        return msgpack.ExtType(code, msgpack_dumps(encoder(obj)))
+
+MsgPackEncoder.register(
+    datetime.datetime, 1,
+    lambda o: (
+        o.year, o.month, o.day, o.hour, o.minute, o.second, o.microsecond
+    ))
+MsgPackEncoder.register(
+    datetime.date, 2, lambda o: (o.year, o.month, o.day)
+)
+MsgPackEncoder.register(
+    datetime.time, 3,
+    lambda o: (o.hour, o.minute, o.second, o.microsecond)
+)
+# Binary data is carried as is, without the base64 encoding of JSON
+MsgPackEncoder.register(buffer, 4, str)
+MsgPackEncoder.register(bytearray, 4, str)
+MsgPackEncoder.register(Decimal, 5, str)
+MsgPackEncoder.register(
+    Model, 6,
+    lambda o: (o.__name__, o.id) if is_stored(o) else repr(o)
+)
+MsgPackEncoder.register(RecordList, 6, lambda o: (o.model, o.ids))
+MsgPackEncoder.register(CompressedValue, 8, lambda o: str(o.data))
+
+
+def msgpack_dumps(value):
+    """
+    Serialize the value to msgpack with the tryson extension types.
+    """
+    return msgpack.packb(
+        collapse_records(value), default=MsgPackEncoder(), use_bin_type=True
+    )
+
+
+def msgpack_loads(data):
+    """
+    Deserialize the msgpack data with the tryson extension types.
+    """
+    return msgpack.unpackb(data, ext_hook=MsgPackDecoder(), raw=False)
+
+
 def register_serializer():
     """
     This is needed for the Kombu entry point to load encoders and decoders
@@ -144,8 +468,16 @@ def register_serializer():
     register(
         'tryson',
         functools.partial(json.dumps, cls=JSONEncoder),
-        functools.partial(json.loads, object_hook=JSONDecoder()),
+        json_loads,
         content_type='application/x-tryson',
         content_encoding='binary',
     )
+    if msgpack is not None:
+        register(
+            'tryson-msgpack',
+            msgpack_dumps,
+            msgpack_loads,
+            content_type='application/x-tryson-msgpack',
+            content_encoding='binary',
+        )
 register_serializer()
@@ -12,12 +12,38 @@
 """
 from __future__ import absolute_import
 
+import os
+import time
+import random
+import calendar
+from contextlib import contextmanager
+from uuid import uuid4
+
+from sql import Table
+from billiard.process import current_process
+from celery import signals
+from celery.exceptions import Ignore, Retry
+from celery.utils.iso8601 import parse_iso8601
 from trytond import backend
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.model import Model
 from trytond.cache import Cache
 
+from trytond_async import metrics, coordination, profiling, pools
 from trytond_async.app import app
+from trytond_async.executors import get_executor
+from trytond_async.payloadstore import store
+from trytond_async.scheduled import get_due
+from trytond_async.serialization import json_loads
+
+# The last seen state of the cache invalidations of each database and the
+# time at which the cache was last cleaned: {database: (state, time)}
+_cache_states = {}
+# The time at which the metrics were last written by the process
+_metrics_written = 0
+# The labels of the metrics of the calls, by database and task
+_call_labels = {}
 
 
 class RetryWithDelay(Exception):
@@ -34,48 +60,853 @@ class RetryWithDelay(Exception):
         self.delay = delay
 
 
-@app.task(bind=True, default_retry_delay=2)
-def execute(app, database, user, payload_json):
+class RetryPolicy(object):
+    """
+    How a task is retried when it raises `RetryWithDelay` or a
+    `DatabaseOperationalError`.
+
+    The delay before a retry grows exponentially with the number of
+    retries, from `base_delay` by a factor of `backoff`, up to `max_delay`.
+    With `jitter`, the delay is drawn uniformly between 0 and this value
+    ("full jitter"), so that tasks which conflicted do not all retry at
+    the same time and conflict again.
+
+    The default policy retries 3 times after a fixed delay of 2 seconds.
+
+    :param max_retries: Maximum number of retries before the task fails.
+    """
+
+    def __init__(
+            self, base_delay=2, backoff=1, max_delay=300, max_retries=3,
+            jitter=False):
+        self.base_delay = base_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.jitter = jitter
+
+    @classmethod
+    def exponential(cls, base_delay=1, max_delay=300, max_retries=10):
+        """
+        Return the policy of exponential backoff with full jitter.
+        """
+        return cls(
+            base_delay=base_delay, backoff=2, max_delay=max_delay,
+            max_retries=max_retries, jitter=True,
+        )
+
+    def to_dict(self):
+        return {
+            'base_delay': self.base_delay,
+            'backoff': self.backoff,
+            'max_delay': self.max_delay,
+            'max_retries': self.max_retries,
+            'jitter': self.jitter,
+        }
+
+    @classmethod
+    def from_payload(cls, payload):
+        return cls(**payload.get('retry_policy') or {})
+
+    def get_delay(self, retries, requested=0):
+        """
+        Return the delay in seconds before the retry which follows
+        `retries` retries. The delay is at least the `requested` one, like
+        the delay of a `RetryWithDelay`.
+        """
+        delay = min(self.max_delay, self.base_delay * self.backoff ** retries)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return max(delay, requested)
+
+
+def prepare_database(database):
+    """
+    Make the pool of the database ready for use by the worker. Return True
+    if it was initialised. The least recently used pools are released if
+    the worker holds more than allowed.
+    """
+    return pools.prepare(database)
+
+
+@signals.worker_init.connect
+def preload_databases(**kwargs):
+    """
+    Initialise the pools of the databases listed in the `preload_databases`
+    setting when the worker starts. This happens in the parent process
+    before the pool of children is forked, so the children inherit the
+    initialised pools instead of each of them initialising its own on its
+    first task.
+    """
+    databases = app.conf.ASYNC_PRELOAD_DATABASES
+    for database in databases:
+        prepare_database(database)
+
+    # The connections opened by the parent must not be shared by the
+    # children, who open their own on their first transaction.
+    Database = backend.get('Database')
+    for database in databases:
+        Database(database).close()
+
+
+@signals.worker_process_init.connect
+def serve_metrics(**kwargs):
+    """
+    Serve the metrics of the child process of the worker over HTTP, if the
+    `metrics_port` setting is set.
+    """
+    port = app.conf.ASYNC_METRICS_PORT
+    if port:
+        metrics.serve(port + (getattr(current_process(), 'index', 0) or 0))
+
+
+def metrics_filename():
+    return os.path.join(
+        app.conf.ASYNC_METRICS_PATH, 'trytond_async_%d.prom' % os.getpid()
+    )
+
+
+@signals.task_postrun.connect
+def write_metrics(**kwargs):
+    """
+    Write the metrics of the process to the directory of the `metrics_path`
+    setting, at most every `metrics_interval` seconds.
+    """
+    global _metrics_written
+    if not app.conf.ASYNC_METRICS_PATH:
+        return
+    now = time.time()
+    if now - _metrics_written >= app.conf.ASYNC_METRICS_INTERVAL:
+        _metrics_written = now
+        metrics.write(metrics_filename())
+
+
+@signals.worker_process_shutdown.connect
+def flush_profiles(**kwargs):
+    """
+    Write the profiles aggregated by the child process of the worker when
+    it exits.
+    """
+    if profiling.hook is not None:
+        profiling.hook.flush()
+
+
+@signals.worker_process_shutdown.connect
+def remove_metrics(**kwargs):
+    """
+    Remove the metrics file of the child process when it exits, so that
+    the metrics of the processes which are gone are not collected.
+    """
+    if app.conf.ASYNC_METRICS_PATH:
+        try:
+            os.unlink(metrics_filename())
+        except OSError:
+            pass
+
+
+def retry(task, payload, exc, cause, requested=0):
+    """
+    Return the retry of the task, according to the retry policy of the
+    payload, for the exception `exc`.
+
+    :param cause: The name of the cause of the retry, used to label the
+                  metrics.
+    """
+    policy = RetryPolicy.from_payload(payload)
+    countdown = policy.get_delay(task.request.retries, requested)
+    name = '%s.%s' % (payload['model_name'], payload['method_name'])
+    metrics.incr('retries', task=name, cause=cause)
+    metrics.incr('retry_wait_seconds', countdown, task=name)
+    if task.request.is_eager:
+        # Applied by a local executor, which retries the call itself
+        if task.request.retries >= policy.max_retries:
+            return exc
+        return Retry(exc=exc, when=countdown)
+    if task.request.retries < policy.max_retries and \
+            schedule_again(task, countdown, task.request.retries + 1):
+        return Retry(exc=exc, when=countdown)
+    return task.retry(
+        exc=exc, countdown=countdown, max_retries=policy.max_retries
+    )
+
+
+def requeue(task, countdown):
+    """
+    Send the task being executed again, with the same id and arguments,
+    to be executed in `countdown` seconds, and stop the current execution.
+    Unlike a retry, this does not count against the retries of the task.
+    """
+    request = task.request
+    if request.is_eager:
+        # Applied by a local executor, which requeues the call itself
+        raise Retry(when=countdown)
+    if schedule_again(task, countdown, request.retries):
+        raise Ignore()
+    delivery_info = request.delivery_info or {}
+    task.apply_async(
+        request.args, request.kwargs,
+        task_id=request.id,
+        countdown=countdown,
+        retries=request.retries,
+        exchange=delivery_info.get('exchange'),
+        routing_key=delivery_info.get('routing_key'),
+    )
+    raise Ignore()
+
+
+def schedule_again(task, countdown, retries):
+    """
+    Keep the call of the task being executed in `async.scheduled`, to be
+    sent again with the same id and arguments in `countdown` seconds, if it
+    is delayed by at least the `schedule_threshold` setting. Return True if
+    it was kept.
+    """
+    due = get_due({'countdown': countdown})
+    if due is None:
+        return False
+    request = task.request
+    delivery_info = request.delivery_info or {}
+    Pool().get('async.scheduled').schedule(
+        due, task, request.args, request.kwargs,
+        task_id=request.id,
+        retries=retries,
+        exchange=delivery_info.get('exchange'),
+        routing_key=delivery_info.get('routing_key'),
+    )
+    return True
+
+
+def release_dedupe_key(task, dedupe):
+    """
+    Release the deduplication key of the payload before it is executed,
+    so that the calls made from now on are not coalesced into it. If the
+    call is debounced and another call was made during the debounce
+    window, the task is requeued to the end of the window instead.
+    """
+    state = coordination.get_backend()
+    if dedupe['debounce']:
+        last = state.get(dedupe['key'] + ':last')
+        if last is not None:
+            remaining = float(last) + dedupe['debounce'] - time.time()
+            if remaining > 0:
+                requeue(task, remaining)
+    state.delete(dedupe['key'])
+
+
+@contextmanager
+def task_limits(task, database, payload):
+    """
+    Enforce the concurrency and rate limits of the payload, and the limit
+    of the calls executed at once on the database of the
+    `database_max_concurrency` setting, shared by all the workers. If the
+    limits are reached, the task is requeued without counting as a retry.
+    """
+    limits = payload.get('limits') or {}
+    database_limit = app.conf.ASYNC_DATABASE_MAX_CONCURRENCY
+    if not limits and not database_limit:
+        yield
+        return
+
+    state = coordination.get_backend()
+    name = '%s.%s' % (payload['model_name'], payload['method_name'])
+    key = 'trytond_async:limit:%s:%s' % (database, name)
+
+    start = time.time()
+    leases = []
+    try:
+        if database_limit:
+            # A busy database can not take all the workers, which would
+            # starve the calls on the other databases.
+            leases.append(acquire_lease(
+                task, 'trytond_async:database_limit:%s' % database,
+                database_limit, name, 'database', start
+            ))
+        if limits.get('max_concurrency'):
+            leases.append(acquire_lease(
+                task, key + ':leases', limits['max_concurrency'], name,
+                'concurrency', start
+            ))
+        # The token is taken last, so that it is not spent by a call
+        # requeued for its leases.
+        if limits.get('rate'):
+            wait = state.take_token(key + ':rate', limits['rate'])
+            if wait:
+                metrics.incr(
+                    'limit_wait_seconds', time.time() - start, task=name
+                )
+                metrics.incr('limit_rejected', task=name, limit='rate')
+                requeue(task, wait)
+        metrics.incr('limit_wait_seconds', time.time() - start, task=name)
+        yield
+    finally:
+        for lease_key, token in leases:
+            state.release_lease(lease_key, token)
+
+
+def acquire_lease(task, key, limit, name, kind, start):
+    """
+    Take one of the `limit` leases of the key for the task and return the
+    key and the token of the lease, or requeue the task if they are all
+    taken.
+    """
+    token = uuid4().hex
+    acquired = coordination.get_backend().acquire_lease(
+        key, token, limit, app.conf.ASYNC_LEASE_TTL
+    )
+    if not acquired:
+        metrics.incr('limit_wait_seconds', time.time() - start, task=name)
+        metrics.incr('limit_rejected', task=name, limit=kind)
+        # Spread the requeued tasks so that they do not all come back at
+        # the same time.
+        requeue(task, app.conf.ASYNC_LIMIT_RETRY_DELAY * random.uniform(
+            0.5, 1.5
+        ))
+    return key, token
+
+
+def clean_cache(database):
+    """
+    Clean the cache of the database if it could be stale. This must be
+    called in the transaction of the task, before the payload is used.
+
+    The invalidations are recorded by Tryton in the `ir_cache` table. As
+    the transaction of the task starts after the task is dequeued, it sees
+    every invalidation committed before that. If they did not change since
+    the last clean, the clean would be a no-op and it is skipped, unless
+    the cache is older than the `cache_clean_interval` setting. Like
+    `Cache.clean`, the timestamp of every cache is compared, as a new
+    invalidation may still be older than the newest one.
+    """
+    cursor = Transaction().cursor
+    table = Table('ir_cache')
+    cursor.execute(*table.select(table.name, table.timestamp))
+    state = dict(cursor.fetchall())
+
+    now = time.time()
+    last_state, last_clean = _cache_states.get(database, (None, 0))
+    if state == last_state and \
+            now - last_clean < app.conf.ASYNC_CACHE_CLEAN_INTERVAL:
+        metrics.incr('cache_clean_skipped', database=database)
+        return
+
+    Cache.clean(database)
+    _cache_states[database] = (state, now)
+    metrics.incr('cache_clean_performed', database=database)
+
+
+def execute_payload(Async, payload):
+    """
+    Execute the payload with `Async.execute_payload`, through the profiler
+    hook if profiling is enabled.
+    """
+    if profiling.hook is None:
+        return Async.execute_payload(payload)
+    return profiling.hook(Async.execute_payload, payload)
+
+
+def count_records(payload):
+    """
+    Return the number of records the call of the payload is made on: its
+    instance and the records given as arguments.
+    """
+    count = 1 if payload['instance'] else 0
+    for arg in payload['args']:
+        if isinstance(arg, Model):
+            count += 1
+        elif isinstance(arg, (list, tuple)) and arg and \
+                isinstance(arg[0], Model):
+            count += len(arg)
+    return count
+
+
+def get_queued_at(task, payload):
+    """
+    Return the time at which the call was ready to be executed: when it was
+    sent or, if it was delayed, when it was due.
+    """
+    queued_at = payload.get('queued_at')
+    if task.request.eta:
+        eta = task.request.eta
+        if isinstance(eta, basestring):
+            eta = parse_iso8601(eta)
+        eta = calendar.timegm(eta.utctimetuple()) + eta.microsecond / 1e6
+        queued_at = max(queued_at, eta)
+    return queued_at
+
+
+def record_call(database, status, size, call):
+    """
+    Record the metrics of a call executed by `run_payload`, by database and
+    task: the duration of each of its phases, its wait in the queue, its
+    payload size in bytes, the number of records it was made on and its
+    status.
+    """
+    task = call['task'] or 'unknown'
+    labels = _call_labels.get((database, task))
+    if labels is None:
+        labels = _call_labels[(database, task)] = metrics.Labels(
+            database=database, task=task
+        )
+    observations = [
+        (labels.key('phase_seconds', ('phase', phase)), seconds)
+        for phase, seconds in call['phases'].iteritems()
+    ]
+    if call['queued_at']:
+        observations.append((
+            labels.key('queue_wait_seconds'),
+            max(0, call['start'] - call['queued_at'])
+        ))
+    metrics.add([
+        (labels.key('calls', ('status', status)), 1),
+        (labels.key('payload_bytes'), size),
+        (labels.key('records'), call['records']),
+    ], observations)
+
+
+def run_payload(app, database, user, payload_json, **options):
     """
     Execute the task identified by the given payload in the given database
-    as `user`.
+    as `user`. This is the body of the `execute` tasks.
+
+    The duration of the phases of the execution are recorded: the
+    initialisation of the pool, the clean of the cache, the decoding of the
+    payload, the call of the method and the commit.
     """
-    if database not in Pool.database_list():
-        # Initialise the database if this is the first time we see the
-        # database being used.
-        with Transaction().start(database, 0, readonly=True):
-            Pool(database).init()
+    call = {
+        'start': time.time(),
+        'phases': {},
+        'task': None,
+        'queued_at': None,
+        'records': 0,
+    }
+    status = 'failure'
+    try:
+        with pools.using(database):
+            result = _run_payload(
+                app, database, user, payload_json, call, **options
+            )
+        status = 'success'
+        return result
+    except (Retry, Ignore):
+        status = 'retry'
+        raise
+    finally:
+        record_call(database, status, len(payload_json), call)
 
-    with Transaction().start(database, 0):
-        Cache.clean(database)
+
+def _run_payload(app, database, user, payload_json, call, **options):
+    phases = call['phases']
+    if prepare_database(database):
+        phases['pool_init'] = time.time() - call['start']
 
     with Transaction().start(database, user) as transaction:
+        start = time.time()
+        clean_cache(database)
+        phases['cache_clean'] = time.time() - start
+
         Async = Pool().get('async.async')
         DatabaseOperationalError = backend.get('DatabaseOperationalError')
 
         # De-serialize the payload in the transaction context so that
         # active records are constructed in the same transaction cache and
         # context.
-        payload = Async.deserialize_payload(payload_json)
+        start = time.time()
+        payload = Async.deserialize_payload(payload_json, **options)
+        phases['deserialize'] = time.time() - start
+        call['task'] = '%s.%s' % (
+            payload['model_name'], payload['method_name']
+        )
+        call['queued_at'] = get_queued_at(app, payload)
+        call['records'] = count_records(payload)
+        if payload.get('map'):
+            # Counted once the result of the chunk is stored
+            app.request.map_key = payload['map']['key']
+        if payload.get('map_reduce'):
+            payload['args'] = [gather_map(payload['map_reduce'])] + \
+                list(payload['args'])
+
+        with task_limits(app, database, payload):
+            if payload.get('dedupe'):
+                release_dedupe_key(app, payload['dedupe'])
+
+            try:
+                start = time.time()
+                with Transaction().set_context(payload['context']):
+                    results = execute_payload(Async, payload)
+                phases['execute'] = time.time() - start
+            except RetryWithDelay, exc:
+                # A special error that would be raised by Tryton models to
+                # retry the task after a certain delay. Useful when the task
+                # got triggered before the record is ready and similar
+                # cases.
+                transaction.cursor.rollback()
+                raise retry(
+                    app, payload, exc, 'retry_with_delay', exc.delay
+                )
+            except DatabaseOperationalError, exc:
+                # Strict transaction handling may cause this.
+                # Rollback and Retry the whole transaction if within
+                # max retries, or raise exception and quit.
+                transaction.cursor.rollback()
+                raise retry(app, payload, exc, 'operational_error')
+            except Exception, exc:
+                transaction.cursor.rollback()
+                raise
+            else:
+                start = time.time()
+                transaction.cursor.commit()
+                phases['commit'] = time.time() - start
+                Async.release_payload(payload_json, payload, **options)
+                policy = payload.get('result_policy')
+                if policy and not app.ignore_result:
+                    app.request.result_expires = policy.get('expires')
+                    return Async.encode_result(results, policy)
+                return results
+
+
+@app.task(bind=True, default_retry_delay=2)
+def execute(app, database, user, payload_json, **options):
+    """
+    Execute the task identified by the given payload in the given database
+    as `user`.
+    """
+    return run_payload(app, database, user, payload_json, **options)
+
+
+@app.task(bind=True, default_retry_delay=2, ignore_result=True)
+def execute_ignore_result(app, database, user, payload_json, **options):
+    """
+    Same as `execute`, for the calls whose result is not needed. Their
+    result is never written to the result backend.
+    """
+    return run_payload(app, database, user, payload_json, **options)
+
+
+@signals.task_postrun.connect
+def expire_result(task=None, task_id=None, **kwargs):
+    """
+    Apply the expiry of the result policy of the call, if any, to its
+    result once it is stored. Only the backends which can expire a key,
+    like redis, support it; the others keep the `CELERY_TASK_RESULT_EXPIRES`
+    expiry.
+    """
+    expires = getattr(task.request, 'result_expires', None)
+    if not expires or task.ignore_result:
+        return
+    backend = task.backend
+    if hasattr(backend, 'expire') and hasattr(backend, 'get_key_for_task'):
+        backend.expire(backend.get_key_for_task(task_id), int(expires))
+
 
+def map_key(database, job_id):
+    """
+    Return the key in the shared state of the job started by `Async.map`.
+    """
+    return 'trytond_async:map:%s:%s' % (database, job_id)
+
+
+@signals.task_postrun.connect
+def count_map_chunk(task=None, state=None, **kwargs):
+    """
+    Count the chunk of a job started by `Async.map` as done or failed once
+    its result is stored, and start the reducer of the job if it was the
+    last chunk. Retried chunks are only counted when they complete.
+    """
+    key = getattr(task.request, 'map_key', None)
+    if key is None or state not in ('SUCCESS', 'FAILURE'):
+        return
+    coordination.get_backend().incr(
+        key + (':done' if state == 'SUCCESS' else ':failed'),
+        app.conf.ASYNC_MAP_TTL
+    )
+    finish_map(key)
+
+
+def finish_map(key):
+    """
+    Send the reducer of the job if all its chunks succeeded. This is called
+    once the last chunk is counted and once all the chunks are sent, as
+    either may come last, but the reducer is only sent once. Like a celery
+    chord, the reducer is not sent if a chunk failed.
+    """
+    state = coordination.get_backend()
+    total = state.get(key + ':total')
+    if total is None:
+        # The chunks are still being sent
+        return
+    done = int(state.get(key + ':done') or 0)
+    if done < int(total) or \
+            not state.add(key + ':reduced', 1, app.conf.ASYNC_MAP_TTL):
+        return
+    reducer = state.get(key + ':reducer')
+    if reducer is None:
+        return
+    call = json_loads(reducer)
+    get_executor().submit(
+        execute,
+        (call['database'], call['user'], call['data']),
+        call['options'] or None,
+        task_id=call['task_id'],
+        **call['celery_options']
+    )
+
+
+def gather_map(map_reduce):
+    """
+    Return the results of the chunks of a job started by `Async.map`, in
+    the order of the chunks. They are all stored when the reducer runs.
+    """
+    total = int(coordination.get_backend().get(map_reduce['key'] + ':total'))
+    return [
+        get_executor().result(
+            execute, u'%s-%d' % (map_reduce['job_id'], index)
+        ).result
+        for index in xrange(total)
+    ]
+
+
+class SavepointError(Exception):
+    """
+    Raised when the savepoint around a payload of a batch could not be set,
+    rolled back to or released. It is not a failure of the payload: the
+    whole batch must be rolled back and retried.
+    """
+
+
+def execute_in_savepoint(transaction, name, func, *args, **kwargs):
+    """
+    Call `func` inside a savepoint of the transaction. If the call fails,
+    only the changes made since the savepoint are rolled back and the
+    exception is raised again.
+
+    The python driver of SQLite commits the transaction before any
+    savepoint statement, so on SQLite the changes of the call are committed
+    instead, or rolled back if it fails, as in a transaction of its own.
+    """
+    cursor = transaction.cursor
+    if backend.name() == 'sqlite':
         try:
-            with Transaction().set_context(payload['context']):
-                results = Async.execute_payload(payload)
-        except RetryWithDelay, exc:
-            # A special error that would be raised by Tryton models to
-            # retry the task after a certain delay. Useful when the task
-            # got triggered before the record is ready and similar cases.
-            transaction.cursor.rollback()
-            raise app.retry(exc=exc, delay=exc.delay)
+            result = func(*args, **kwargs)
+            cursor.commit()
+        except Exception:
+            # The rollback of the cursor also clears its caches
+            cursor.rollback()
+            raise
+        return result
+
+    def savepoint(statement):
+        try:
+            cursor.execute(statement % name)
+        except Exception, exc:
+            raise SavepointError(exc)
+
+    savepoint('SAVEPOINT "%s"')
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        savepoint('ROLLBACK TO SAVEPOINT "%s"')
+        # Records cached by the transaction may hold values written by the
+        # rolled back call. The caches are cleared in place as the records
+        # of the next payloads share them.
+        for cache in cursor.cache.itervalues():
+            cache.clear()
+        raise
+    savepoint('RELEASE SAVEPOINT "%s"')
+    return result
+
+
+@app.task(bind=True, default_retry_delay=2)
+def execute_batch(app, database, user, batch_json, **options):
+    """
+    Execute all the payloads of a batch built by `Async.apply_async_many`
+    in the given database as `user`. The database is prepared once for the
+    whole batch and the payloads are executed in a single transaction, each
+    one in its own savepoint so that a failing payload does not roll back
+    the others. On SQLite, which does not support savepoints through its
+    python driver, each payload is committed on its own.
+
+    Returns one entry per payload, in the order of the payloads:
+
+        * `{'status': 'SUCCESS', 'result': ...}` if the payload succeeded.
+        * `{'status': 'RETRY', 'task_id': ...}` if the payload asked to be
+          retried, in which case it was dispatched again on its own as an
+          `execute` task identified by `task_id`.
+        * `{'status': 'FAILURE', 'exc_type': ..., 'exc_message': ...}` if
+          the payload raised any other exception.
+
+    The metrics of each payload are recorded like the ones of an `execute`
+    call.
+    """
+    batch_call = {
+        'start': time.time(),
+        'phases': {},
+        'task': None,
+        'queued_at': None,
+        'records': 0,
+    }
+    calls = []
+    status = 'failure'
+    try:
+        with pools.using(database):
+            results = _execute_batch(
+                app, database, user, batch_json, batch_call, calls, **options
+            )
+        status = None
+        return results
+    except (Retry, Ignore):
+        status = 'retry'
+        raise
+    finally:
+        record_batch(database, status, len(batch_json), batch_call, calls)
+
+
+def record_batch(database, status, size, batch_call, calls):
+    """
+    Record the metrics of the payloads of a batch with `record_call`. The
+    phases shared by the payloads, like the commit, and the size of the
+    batch are divided evenly between them, and they wait in the queue as
+    long as the batch. If the whole batch failed or is retried, so are all
+    its payloads.
+
+    :param status: The status of the batch, or None if it completed.
+    :param calls: The status and the call of each payload executed.
+    """
+    if not calls:
+        # The batch failed before its payloads were executed
+        record_call(database, status, size, batch_call)
+        return
+    for payload_status, call in calls:
+        for phase, seconds in batch_call['phases'].iteritems():
+            call['phases'][phase] = seconds / len(calls)
+        call['start'] = batch_call['start']
+        call['queued_at'] = batch_call['queued_at']
+        record_call(
+            database, status or payload_status, size / len(calls), call
+        )
+
+
+def _execute_batch(
+        app, database, user, batch_json, batch_call, calls, **options):
+    phases = batch_call['phases']
+    if prepare_database(database):
+        phases['pool_init'] = time.time() - batch_call['start']
+
+    with Transaction().start(database, user) as transaction:
+        start = time.time()
+        clean_cache(database)
+        phases['cache_clean'] = time.time() - start
+
+        Async = Pool().get('async.async')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        start = time.time()
+        batch = Async.deserialize_payload(batch_json, **options)
+        phases['deserialize'] = time.time() - start
+        batch_call['queued_at'] = get_queued_at(app, batch)
+
+        results, retries = [], []
+        with Transaction().set_context(batch['context']):
+            for index, payload in enumerate(batch['payloads']):
+                call = {
+                    'phases': {},
+                    'task': '%s.%s' % (
+                        payload['model_name'], payload['method_name']
+                    ),
+                    'records': count_records(payload),
+                }
+                start = time.time()
+                try:
+                    result = execute_in_savepoint(
+                        transaction, 'async_payload_%d' % index,
+                        execute_payload, Async, payload
+                    )
+                except SavepointError, exc:
+                    transaction.cursor.rollback()
+                    raise app.retry(exc=exc)
+                except RetryWithDelay, exc:
+                    retries.append((index, payload, exc.delay))
+                    results.append(None)
+                    calls.append(('retry', call))
+                except DatabaseOperationalError, exc:
+                    retries.append((index, payload, 0))
+                    results.append(None)
+                    calls.append(('retry', call))
+                except Exception, exc:
+                    results.append({
+                        'status': 'FAILURE',
+                        'exc_type': exc.__class__.__name__,
+                        'exc_message': unicode(exc),
+                    })
+                    calls.append(('failure', call))
+                else:
+                    results.append({'status': 'SUCCESS', 'result': result})
+                    calls.append(('success', call))
+                call['phases']['execute'] = time.time() - start
+
+        try:
+            start = time.time()
+            transaction.cursor.commit()
+            phases['commit'] = time.time() - start
         except DatabaseOperationalError, exc:
-            # Strict transaction handling may cause this.
-            # Rollback and Retry the whole transaction if within
-            # max retries, or raise exception and quit.
             transaction.cursor.rollback()
             raise app.retry(exc=exc)
-        except Exception, exc:
-            transaction.cursor.rollback()
-            raise
-        else:
-            transaction.cursor.commit()
-            return results
+        Async.release_payload(batch_json, batch, **options)
+
+        # The failed payloads are retried alone, once the work of the
+        # others is committed. They are sent where the batch was delivered
+        # and with its priority, or by their route if it was applied.
+        delivery_info = app.request.delivery_info or {}
+        options = dict(
+            (key, delivery_info[key])
+            for key in ('exchange', 'routing_key', 'priority')
+            if delivery_info.get(key) is not None
+        )
+        for index, payload, delay in retries:
+            payload['context'] = batch['context']
+            payload_options = dict(options)
+            if 'routing_key' not in options:
+                queue = Async.get_route(payload)
+                if queue:
+                    payload_options['queue'] = queue
+            retry_result = Async.send_payload(
+                execute, payload,
+                countdown=RetryPolicy.from_payload(payload).get_delay(
+                    0, delay
+                ),
+                **payload_options
+            )
+            results[index] = {'status': 'RETRY', 'task_id': retry_result.id}
+        return results
+
+
+@app.task
+def publish_scheduled(database):
+    """
+    Send the calls of `async.scheduled` which are due before the next run of
+    this task in the database. This is run every `scheduler_interval`
+    seconds by celery beat for the databases of the `scheduler_databases`
+    setting. A run is skipped while another one holds the lock of the table.
+    """
+    with pools.using(database):
+        prepare_database(database)
+
+        with Transaction().start(database, 0):
+            Scheduled = Pool().get('async.scheduled')
+            DatabaseOperationalError = backend.get('DatabaseOperationalError')
+            try:
+                return Scheduled.publish_due(
+                    app.conf.ASYNC_SCHEDULER_BATCH_SIZE,
+                    app.conf.ASYNC_SCHEDULER_INTERVAL
+                )
+            except DatabaseOperationalError:
+                return 0
+
+
+@app.task
+def collect_payloads():
+    """
+    Delete the data left in the payload store by tasks which never
+    completed, for example because they failed. This is meant to be run
+    periodically, with celery beat for example.
+    """
+    return store.collect(app.conf.ASYNC_PAYLOAD_STORE_MAX_AGE)
@@ -4,7 +4,9 @@ import unittest
 import trytond.tests.test_tryton
 
 from tests.test_async import TestAsync
-from tests.test_serialization import TestSerialization
+from tests.test_serialization import TestSerialization, \
+    TestMsgPackSerialization
+from tests.test_tasks import TestTasks
 
 
 def suite():
@@ -15,6 +17,8 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestAsync),
         unittest.TestLoader().loadTestsFromTestCase(TestSerialization),
+        unittest.TestLoader().loadTestsFromTestCase(TestMsgPackSerialization),
+        unittest.TestLoader().loadTestsFromTestCase(TestTasks),
     ])
     return test_suite
 
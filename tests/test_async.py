@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import unittest
 import subprocess
 import threading
@@ -7,6 +8,10 @@ from trytond.tests.test_tryton import POOL, USER
 from trytond.tests.test_tryton import DB_NAME, CONTEXT
 from trytond.transaction import Transaction
 import trytond.tests.test_tryton
+from trytond_async import metrics
+from trytond_async.app import app, parse_routes
+from trytond_async.async import BatchPayloadError, join_datamanager
+from trytond_async.payloadstore import store
 
 
 class Command(object):
@@ -98,6 +103,264 @@ class TestAsync(unittest.TestCase):
             self.assertEqual(result.status, 'SUCCESS')
             self.assertEqual(result.result, expected)
 
+    def test0007_test_apply_async_many(self):
+        """Test dispatching many calls in batches.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            views = View.search([], limit=5)
+            expected = [View.search_read([('id', '=', v.id)]) for v in views]
+            result = self.Async.apply_async_many([
+                (View.__name__, 'search_read', None,
+                    [[('id', '=', v.id)]], None)
+                for v in views
+            ], chunk_size=2)
+
+            # Three batches of 2, 2 and 1 calls
+            self.assertEqual(len(result), len(views))
+            self.assertEqual(
+                len(set(r.batch_result.id for r in result)), 3
+            )
+            self.assertEqual(result[0].status, 'PENDING')
+
+            # Now launch the worker and kill it after 15 seconds
+            command = Command('celery -l info -A trytond_async.tasks worker')
+            command.run(15)
+
+            self.assertEqual(result[0].status, 'SUCCESS')
+            self.assertEqual(result[1].result, expected[1])
+            self.assertEqual(result.get(), expected)
+
+    def test0008_test_apply_async_many_failure(self):
+        """Test that a failing call of a batch does not affect the others.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            expected = View.search_read([])
+            result = self.Async.apply_async_many([
+                (View.__name__, 'search_read', None, [[]], None),
+                (View.__name__, 'no_such_method', None, None, None),
+                (View.__name__, 'search_read', None, [[]], None),
+            ])
+
+            # Now launch the worker and kill it after 15 seconds
+            command = Command('celery -l info -A trytond_async.tasks worker')
+            command.run(15)
+
+            self.assertEqual(result[0].status, 'SUCCESS')
+            self.assertEqual(result[0].get(), expected)
+            self.assertEqual(result[1].status, 'FAILURE')
+            self.assertRaises(BatchPayloadError, result[1].get)
+            self.assertEqual(result[2].get(), expected)
+
+    def test0009_test_payload_compression(self):
+        """Test payloads above the threshold are compressed.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            names = ['view %d' % i for i in range(1000)]
+            payload = {
+                'model_name': View.__name__,
+                'method_name': 'search_read',
+                'instance': None,
+                'args': [[('name', 'in', names)]],
+                'kwargs': {},
+                'context': CONTEXT,
+            }
+            threshold = app.conf.ASYNC_COMPRESSION_THRESHOLD
+            try:
+                app.conf.ASYNC_COMPRESSION_THRESHOLD = 0
+                data, options = self.Async.encode_payload(payload)
+                self.assertEqual(options, {})
+
+                app.conf.ASYNC_COMPRESSION_THRESHOLD = 1024
+                compressed, options = self.Async.encode_payload(payload)
+                self.assertEqual(options, {'encoding': 'zlib'})
+                self.assertTrue(len(compressed) < len(data))
+            finally:
+                app.conf.ASYNC_COMPRESSION_THRESHOLD = threshold
+
+            self.assertEqual(
+                self.Async.deserialize_payload(compressed, **options),
+                self.Async.deserialize_payload(data),
+            )
+
+    def test0010_test_payload_store(self):
+        """Test large binary arguments and payloads are stored aside.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            data = buffer('x' * 4096)
+            payload = {
+                'model_name': 'ir.attachment',
+                'method_name': 'create',
+                'instance': None,
+                'args': [[{'name': 'test', 'data': data}]],
+                'kwargs': {},
+                'context': CONTEXT,
+            }
+            threshold = app.conf.ASYNC_PAYLOAD_STORE_THRESHOLD
+            try:
+                app.conf.ASYNC_PAYLOAD_STORE_THRESHOLD = 1024
+                encoded, options = self.Async.encode_payload(payload)
+            finally:
+                app.conf.ASYNC_PAYLOAD_STORE_THRESHOLD = threshold
+
+            # Only the reference to the data is in the message
+            self.assertTrue(len(encoded) < len(data))
+            self.assertEqual(options, {})
+
+            decoded = self.Async.deserialize_payload(encoded, **options)
+            self.assertEqual(str(decoded['args'][0][0]['data']), str(data))
+            key, = decoded['stored_keys']
+            self.assertTrue(os.path.exists(store.filename(DB_NAME, key)))
+
+            self.Async.release_payload(encoded, decoded, **options)
+            self.assertFalse(os.path.exists(store.filename(DB_NAME, key)))
+
+    def test0011_test_apply_async_after_commit(self):
+        """Test calls deferred after commit are sent on commit only.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as trans:
+            View = POOL.get('ir.ui.view')
+
+            self.Async.apply_async(
+                method='search_read', model=View.__name__, args=[[]],
+                after_commit=True,
+            )
+            datamanager = join_datamanager()
+            self.assertEqual(len(datamanager.batches[0]['payloads']), 1)
+
+            # Dropped on rollback
+            trans.cursor.rollback()
+            self.assertEqual(datamanager.batches, [])
+
+            expected = View.search_read([])
+            results = [
+                self.Async.apply_async(
+                    method='search_read', model=View.__name__, args=[[]],
+                    after_commit=True,
+                ) for _ in range(3)
+            ]
+            # All the calls are sent in one batch
+            datamanager = join_datamanager()
+            self.assertEqual(len(datamanager.batches), 1)
+            self.assertEqual(
+                len(set(r.batch_result.id for r in results)), 1
+            )
+            trans.cursor.commit()
+            self.assertEqual(datamanager.batches, [])
+
+            # Now launch the worker and kill it after 15 seconds
+            command = Command('celery -l info -A trytond_async.tasks worker')
+            command.run(15)
+
+            self.assertEqual(results[0].status, 'SUCCESS')
+            self.assertEqual(results[2].get(), expected)
+
+    def test0012_test_apply_async_dedupe(self):
+        """Test identical pending calls are coalesced.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            metrics.reset()
+            expected = View.search_read([])
+            results = [
+                self.Async.apply_async(
+                    method='search_read', model=View.__name__, args=[[]],
+                    dedupe_key=True,
+                ) for _ in range(3)
+            ]
+            other = self.Async.apply_async(
+                method='search_read', model=View.__name__, args=[[]],
+                dedupe_key='other',
+            )
+            self.assertEqual(len(set(r.id for r in results)), 1)
+            self.assertNotEqual(other.id, results[0].id)
+            self.assertEqual(
+                metrics.get('task_coalesced', task='ir.ui.view.search_read'),
+                2
+            )
+
+            # Now launch the worker and kill it after 15 seconds
+            command = Command('celery -l info -A trytond_async.tasks worker')
+            command.run(15)
+
+            self.assertEqual(results[0].get(), expected)
+
+            # The key is released once the call started
+            result = self.Async.apply_async(
+                method='search_read', model=View.__name__, args=[[]],
+                dedupe_key=True,
+            )
+            self.assertNotEqual(result.id, results[0].id)
+
+    def test0013_test_affinity_queue(self):
+        """Test calls with the same affinity key go to the same queue.
+        """
+        partitions = app.conf.ASYNC_AFFINITY_PARTITIONS
+        try:
+            app.conf.ASYNC_AFFINITY_PARTITIONS = 0
+            self.assertEqual(self.Async.get_affinity_queue('a'), None)
+
+            app.conf.ASYNC_AFFINITY_PARTITIONS = 4
+            queues = set(
+                self.Async.get_affinity_queue('ir.ui.view,%d' % i)
+                for i in range(100)
+            )
+            self.assertEqual(queues, set(
+                'trytond_async.affinity.%d' % i for i in range(4)
+            ))
+            self.assertEqual(
+                self.Async.get_affinity_queue(u'ir.ui.view,1'),
+                self.Async.get_affinity_queue('ir.ui.view,1'),
+            )
+
+            # The instance is the key only if it is a saved record
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                View = POOL.get('ir.ui.view')
+                for instance in (None, View()):
+                    self.assertRaises(
+                        ValueError, self.Async.apply_async,
+                        method='read', model=View.__name__,
+                        instance=instance, affinity=True,
+                    )
+        finally:
+            app.conf.ASYNC_AFFINITY_PARTITIONS = partitions
+
+    def test0014_test_routes(self):
+        """Test calls are routed to the most specific queue.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            routes = app.conf.ASYNC_ROUTES
+            app.conf.ASYNC_ROUTES = parse_routes("""
+                ir.ui.view = views
+                ir.ui.view.search = search
+                %s:ir.ui.view = database_views
+                other:* = other
+            """ % DB_NAME)
+            try:
+                payload = self.Async.build_payload('search', 'ir.ui.view')
+                self.assertEqual(
+                    self.Async.get_route(payload), 'database_views'
+                )
+                del app.conf.ASYNC_ROUTES['%s:ir.ui.view' % DB_NAME]
+                self.assertEqual(self.Async.get_route(payload), 'search')
+                payload = self.Async.build_payload('read', 'ir.ui.view')
+                self.assertEqual(self.Async.get_route(payload), 'views')
+                payload = self.Async.build_payload('read', 'ir.model')
+                self.assertEqual(self.Async.get_route(payload), None)
+            finally:
+                app.conf.ASYNC_ROUTES = routes
+
+            self.assertEqual(
+                self.Async.get_queue({DB_NAME: 'mine', 'other': 'theirs'}),
+                'mine'
+            )
+
 
 def suite():
     """
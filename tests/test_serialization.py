@@ -7,8 +7,14 @@ from decimal import Decimal
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER
 from trytond.tests.test_tryton import DB_NAME, CONTEXT
+from trytond.model import Model
 from trytond.transaction import Transaction
-from trytond_async.serialization import JSONEncoder, JSONDecoder
+from trytond_async.serialization import JSONEncoder, JSONDecoder, \
+    MsgPackEncoder, json_loads, msgpack, msgpack_dumps, msgpack_loads
+
+
+class Timestamp(datetime.datetime):
+    pass
 
 
 class TestSerialization(unittest.TestCase):
@@ -49,6 +55,34 @@ class TestSerialization(unittest.TestCase):
         'Test Decimal'
         self.dumps_loads(Decimal('3.141592653589793'))
 
+    def test_subclass(self):
+        'Test the instances of subclasses are encoded like their base'
+        self.dumps_loads(Timestamp.now())
+        self.dumps_loads(bytearray('\x00\xff'))
+
+    def test_register_subclass(self):
+        'Test a serializer registered for a subclass takes precedence'
+        class Amount(Decimal):
+            pass
+        self.assertEqual(
+            json.loads(json.dumps(Amount('1.5'), cls=JSONEncoder)),
+            {'__class__': 'Decimal', 'decimal': '1.5'}
+        )
+        JSONEncoder.register(Amount, lambda o: {'__class__': 'Amount'})
+        self.assertEqual(
+            json.loads(json.dumps(Amount('1.5'), cls=JSONEncoder)),
+            {'__class__': 'Amount'}
+        )
+
+    def test_json_loads(self):
+        'Test json_loads decodes the data with and without tagged objects'
+        value = {'kwargs': {'lines': [{'quantity': 1.5, 'name': u'Line'}]}}
+        self.assertEqual(json_loads(json.dumps(value)), value)
+        value['kwargs']['date'] = datetime.date.today()
+        self.assertEqual(
+            json_loads(json.dumps(value, cls=JSONEncoder)), value
+        )
+
     def test_active_record(self):
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             View = POOL.get('ir.ui.view')
@@ -63,6 +97,112 @@ class TestSerialization(unittest.TestCase):
             # Result from unsaved record
             # self.dumps_loads(View(name='bla bla'))
 
+    def test_record_dispatch(self):
+        'Test the encoders do not keep the classes of the models'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+            self.dumps_loads(View.search([], limit=1)[0])
+        for encoder in (JSONEncoder, MsgPackEncoder):
+            self.assertFalse([
+                klass for klass in encoder._dispatch
+                if issubclass(klass, Model) and klass is not Model
+            ])
+
+    def test_payload_records(self):
+        'Test the payloads with records are only encoded once'
+        class CountingEncoder(JSONEncoder):
+            passes = []
+
+            def iterencode(self, o, _one_shot=False):
+                self.passes.append(o)
+                return super(CountingEncoder, self).iterencode(o, _one_shot)
+
+            def default(self, obj):
+                if not self._collapsed:
+                    self.passes.append(obj)
+                return super(CountingEncoder, self).default(obj)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+            view = View.search([], limit=1)[0]
+            for payload in (
+                    {'instance': view, 'args': []},
+                    {'instance': None, 'args': [[view], 1]},
+                    {'payloads': [{'instance': None, 'args': [view]}]}):
+                CountingEncoder.passes = []
+                self.assertEqual(
+                    json_loads(json.dumps(payload, cls=CountingEncoder)),
+                    payload
+                )
+                self.assertEqual(CountingEncoder.passes, [payload])
+
+    def test_record_list_reference(self):
+        'Test a list of records is encoded as one reference'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            views = View.search([], limit=10)
+            encoded = json.loads(json.dumps(views, cls=JSONEncoder))
+            self.assertEqual(encoded, {
+                '__class__': 'Model',
+                'model': View.__name__,
+                'ids': [v.id for v in views],
+            })
+
+            # Nested in other containers and mixed with other values
+            self.dumps_loads({'views': views, 'args': [views[0], 1]})
+
+    def test_legacy_record_repr(self):
+        'Test records encoded with their representation can be decoded'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            view = View.search([], limit=1)[0]
+            self.assertEqual(
+                json.loads(
+                    json.dumps({'__class__': 'Model', 'repr': repr(view)}),
+                    object_hook=JSONDecoder()
+                ), view
+            )
+
+
+@unittest.skipIf(msgpack is None, 'msgpack is not installed')
+class TestMsgPackSerialization(TestSerialization):
+    'Test msgpack Serialization'
+
+    def dumps_loads(self, value):
+        self.assertEqual(msgpack_loads(msgpack_dumps(value)), value)
+
+    def test_buffer_size(self):
+        'Test binary data is not base64 encoded'
+        data = buffer('\x00\xff' * 1024)
+        self.assertTrue(len(msgpack_dumps(data)) < len(data) + 16)
+
+    def test_record_list_reference(self):
+        'Test a list of records is encoded as one reference'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            views = View.search([], limit=10)
+            packed = msgpack.unpackb(msgpack_dumps(views))
+            self.assertEqual(packed.code, 6)
+            self.assertEqual(
+                msgpack_loads(packed.data),
+                [View.__name__, [v.id for v in views]]
+            )
+            self.dumps_loads({'views': views, 'args': [views[0], 1]})
+
+    def test_legacy_record_repr(self):
+        'Test records encoded with their representation can be decoded'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            View = POOL.get('ir.ui.view')
+
+            view = View.search([], limit=1)[0]
+            packed = msgpack.packb(
+                msgpack.ExtType(6, msgpack_dumps(repr(view)))
+            )
+            self.assertEqual(msgpack_loads(packed), view)
+
 
 def suite():
     """
@@ -72,6 +212,9 @@ def suite():
     test_suite.addTests(
         unittest.TestLoader().loadTestsFromTestCase(TestSerialization)
     )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMsgPackSerialization)
+    )
     return test_suite
 
 if __name__ == '__main__':
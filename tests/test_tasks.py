@@ -0,0 +1,969 @@
+# -*- coding: utf-8 -*-
+import os
+import gc
+import time
+import shutil
+import pstats
+import datetime
+import tempfile
+import urllib2
+import unittest
+
+from celery.exceptions import Ignore
+from celery.result import AsyncResult
+from celery.backends.cache import CacheBackend
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER
+from trytond.tests.test_tryton import DB_NAME, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond_async import metrics, tasks, coordination, aio, executors, \
+    context, profiling, pools
+from trytond_async.app import app
+
+
+class TaskStub(object):
+    """
+    Stand in for a bound celery task which records the requeued calls.
+    """
+    class request:
+        id = 'test'
+        args = ()
+        kwargs = {}
+        retries = 0
+        delivery_info = {}
+        is_eager = False
+
+    def __init__(self):
+        self.requeued = []
+
+    def apply_async(self, *args, **kwargs):
+        self.requeued.append(kwargs)
+
+
+class ExecutorStub(object):
+    """
+    Stand in for the celery executor which records the submitted calls.
+    """
+    local = False
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, task, args, kwargs=None, **celery_options):
+        self.submitted.append((task, args, kwargs, celery_options))
+        return self.result(task, celery_options.get('task_id'))
+
+    def result(self, task, task_id):
+        return AsyncResult(task_id, task_name=task.name, app=app)
+
+
+class InlineExecutor(executors.LocalExecutor):
+    """
+    A local executor which runs the submitted calls in this thread when
+    asked to, so that they run in the database of the tests.
+    """
+
+    def __init__(self):
+        super(InlineExecutor, self).__init__(1)
+        self.pending = []
+
+    def _start(self, task, args, kwargs, result):
+        self.pending.append((task, args, kwargs, result))
+
+    def run(self):
+        while self.pending:
+            task, args, kwargs, result = self.pending.pop(0)
+            result.set(executors.run_task(task.name, args, kwargs, result.id))
+
+
+class TestTasks(unittest.TestCase):
+    'Test Tasks'
+
+    def setUp(self):
+        """
+        Set up data used in the tests.
+        this method is called before each test function execution.
+        """
+        trytond.tests.test_tryton.install_module('async')
+        metrics.reset()
+        tasks._cache_states.clear()
+        coordination._backend = coordination.LocalBackend()
+
+    def tearDown(self):
+        coordination._backend = None
+
+    def test_clean_cache(self):
+        'Test the cache is cleaned only when it could be stale'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            tasks.clean_cache(DB_NAME)
+            tasks.clean_cache(DB_NAME)
+            self.assertEqual(
+                metrics.get('cache_clean_performed', database=DB_NAME), 1
+            )
+            self.assertEqual(
+                metrics.get('cache_clean_skipped', database=DB_NAME), 1
+            )
+
+            # A new invalidation forces a clean
+            IrCache = POOL.get('ir.cache')
+            now = datetime.datetime.now()
+            _, older = IrCache.create([
+                {'name': 'trytond_async.test', 'timestamp': now},
+                {
+                    'name': 'trytond_async.older',
+                    'timestamp': now - datetime.timedelta(hours=2),
+                },
+            ])
+            # Cache.clean reads the invalidations in a cursor of its own
+            Transaction().cursor.commit()
+            tasks.clean_cache(DB_NAME)
+            self.assertEqual(
+                metrics.get('cache_clean_performed', database=DB_NAME), 2
+            )
+
+            # Even if it is older than the newest one
+            IrCache.delete([older])
+            IrCache.create([{
+                'name': 'trytond_async.older',
+                'timestamp': now - datetime.timedelta(hours=1),
+            }])
+            Transaction().cursor.commit()
+            tasks.clean_cache(DB_NAME)
+            self.assertEqual(
+                metrics.get('cache_clean_performed', database=DB_NAME), 3
+            )
+
+            # So does an expired staleness interval
+            interval = app.conf.ASYNC_CACHE_CLEAN_INTERVAL
+            app.conf.ASYNC_CACHE_CLEAN_INTERVAL = 0
+            try:
+                tasks.clean_cache(DB_NAME)
+            finally:
+                app.conf.ASYNC_CACHE_CLEAN_INTERVAL = interval
+            self.assertEqual(
+                metrics.get('cache_clean_performed', database=DB_NAME), 4
+            )
+            self.assertEqual(
+                metrics.get('cache_clean_skipped', database=DB_NAME), 1
+            )
+
+    def test_concurrency_limit(self):
+        'Test tasks over their concurrency limit are requeued'
+        task = TaskStub()
+        payload = {
+            'model_name': 'ir.ui.view',
+            'method_name': 'search',
+            'limits': {'max_concurrency': 1, 'rate': None},
+        }
+        with tasks.task_limits(task, DB_NAME, payload):
+            self.assertRaises(
+                Ignore, tasks.task_limits(task, DB_NAME, payload).__enter__
+            )
+        self.assertEqual(len(task.requeued), 1)
+        self.assertEqual(task.requeued[0]['retries'], 0)
+        self.assertEqual(metrics.get(
+            'limit_rejected', task='ir.ui.view.search', limit='concurrency'
+        ), 1)
+
+        # The lease is released once the task is done
+        with tasks.task_limits(task, DB_NAME, payload):
+            pass
+        self.assertEqual(len(task.requeued), 1)
+
+    def test_database_limit(self):
+        'Test tasks over the concurrency limit of their database are requeued'
+        task = TaskStub()
+        payload = {'model_name': 'ir.ui.view', 'method_name': 'search'}
+        app.conf.ASYNC_DATABASE_MAX_CONCURRENCY = 1
+        try:
+            with tasks.task_limits(task, DB_NAME, dict(
+                    payload, method_name='read')):
+                self.assertRaises(
+                    Ignore,
+                    tasks.task_limits(task, DB_NAME, payload).__enter__
+                )
+            with tasks.task_limits(task, DB_NAME, payload):
+                pass
+        finally:
+            app.conf.ASYNC_DATABASE_MAX_CONCURRENCY = 0
+        self.assertEqual(len(task.requeued), 1)
+        self.assertEqual(metrics.get(
+            'limit_rejected', task='ir.ui.view.search', limit='database'
+        ), 1)
+
+    def test_rate_limit(self):
+        'Test tasks over their rate are requeued until the next token'
+        task = TaskStub()
+        payload = {
+            'model_name': 'ir.ui.view',
+            'method_name': 'search',
+            'limits': {'max_concurrency': None, 'rate': 0.5},
+        }
+        with tasks.task_limits(task, DB_NAME, payload):
+            pass
+        self.assertRaises(
+            Ignore, tasks.task_limits(task, DB_NAME, payload).__enter__
+        )
+        countdown = task.requeued[0]['countdown']
+        self.assertTrue(0 < countdown <= 2)
+
+        # A call requeued for another limit does not spend a token
+        payload['method_name'] = 'read'
+        app.conf.ASYNC_DATABASE_MAX_CONCURRENCY = 1
+        try:
+            with tasks.task_limits(task, DB_NAME, dict(
+                    payload, method_name='search', limits=None)):
+                self.assertRaises(
+                    Ignore,
+                    tasks.task_limits(task, DB_NAME, payload).__enter__
+                )
+            with tasks.task_limits(task, DB_NAME, payload):
+                pass
+        finally:
+            app.conf.ASYNC_DATABASE_MAX_CONCURRENCY = 0
+        self.assertEqual(len(task.requeued), 2)
+        self.assertEqual(metrics.get(
+            'limit_rejected', task='ir.ui.view.read', limit='database'
+        ), 1)
+
+    def test_coordination_backend(self):
+        'Test the state is only kept in the process when it is not shared'
+        coordination._backend = None
+        url, executor = app.conf.ASYNC_COORDINATION_URL, \
+            app.conf.ASYNC_EXECUTOR
+        app.conf.ASYNC_COORDINATION_URL = 'memory://'
+        try:
+            self.assertRaises(RuntimeError, coordination.get_backend)
+            self.assertRaises(RuntimeError, tasks.task_limits(
+                TaskStub(), DB_NAME, {
+                    'model_name': 'ir.ui.view',
+                    'method_name': 'search',
+                    'limits': {'max_concurrency': 1, 'rate': None},
+                }
+            ).__enter__)
+
+            app.conf.ASYNC_EXECUTOR = 'thread'
+            self.assertTrue(isinstance(
+                coordination.get_backend(), coordination.LocalBackend
+            ))
+        finally:
+            app.conf.ASYNC_COORDINATION_URL = url
+            app.conf.ASYNC_EXECUTOR = executor
+
+    def test_pool_eviction(self):
+        'Test the least recently used pools are released over the limit'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Async = POOL.get('async.async')
+            payload = Async.build_payload('search', 'ir.ui.view', args=[[]])
+            payload['context'] = {}
+            data, options = Async.encode_payload(payload)
+
+        app.conf.ASYNC_MAX_POOLS = 1
+        try:
+            pools._pools.clear()
+            pools._pools['other'] = 0
+            self.assertFalse(pools.prepare(DB_NAME))
+            self.assertEqual(pools._pools.keys(), [DB_NAME])
+            self.assertEqual(metrics.get('pool_hit', database=DB_NAME), 1)
+            self.assertEqual(metrics.get('pool_evicted', database='other'), 1)
+
+            # The pools in use are kept
+            pools._pools['other'] = 0
+            with pools.using(DB_NAME):
+                self.assertEqual(pools.evict(), ['other'])
+            pools._pools['other'] = 0
+            self.assertEqual(pools.evict(), [DB_NAME])
+            self.assertFalse(DB_NAME in Pool.database_list())
+
+            # The released pool is initialised again when it is used
+            result = tasks.execute.apply((DB_NAME, USER, data), options)
+            self.assertEqual(result.status, 'SUCCESS')
+            self.assertEqual(metrics.get('pool_miss', database=DB_NAME), 1)
+            self.assertEqual(pools._pools.keys(), [DB_NAME])
+        finally:
+            app.conf.ASYNC_MAX_POOLS = 0
+            pools._pools.clear()
+
+    def test_preload_databases(self):
+        'Test the pools of the databases to preload are initialised'
+        pools.release(DB_NAME)
+        pools._pools.clear()
+        self.assertFalse(DB_NAME in Pool.database_list())
+
+        app.conf.ASYNC_PRELOAD_DATABASES = [DB_NAME]
+        try:
+            tasks.preload_databases()
+        finally:
+            app.conf.ASYNC_PRELOAD_DATABASES = []
+        self.assertTrue(DB_NAME in Pool.database_list())
+        self.assertEqual(pools._pools.keys(), [DB_NAME])
+        self.assertEqual(metrics.get('pool_miss', database=DB_NAME), 1)
+
+        # The children use the pool without initialising it again
+        self.assertFalse(tasks.prepare_database(DB_NAME))
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertTrue(POOL.get('ir.ui.view').search([], limit=1))
+
+    def test_retry_policy(self):
+        'Test the delays of the retry policies'
+        policy = tasks.RetryPolicy()
+        self.assertEqual(
+            [policy.get_delay(retries) for retries in range(3)], [2, 2, 2]
+        )
+        # The delay of RetryWithDelay is a minimum
+        self.assertEqual(policy.get_delay(0, 5), 5)
+
+        policy = tasks.RetryPolicy.exponential(base_delay=1, max_delay=10)
+        for retries in range(10):
+            delay = policy.get_delay(retries)
+            self.assertTrue(0 <= delay <= min(10, 2 ** retries))
+
+        policy = tasks.RetryPolicy.from_payload({
+            'retry_policy': policy.to_dict(),
+        })
+        self.assertEqual(policy.max_retries, 10)
+        self.assertTrue(policy.jitter)
+
+    def test_result_policy(self):
+        'Test large results are compressed or stored by reference'
+        from kombu.serialization import dumps, loads
+        from trytond_async.serialization import CompressedValue
+        from trytond_async.payloadstore import StoredValue
+
+        self.assertTrue(tasks.execute_ignore_result.ignore_result)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Async = POOL.get('async.async')
+            result = ['result %d' % i for i in range(1000)]
+
+            self.assertEqual(
+                Async.encode_result(result, {'compress_threshold': 10 ** 6}),
+                result
+            )
+            for policy, klass in (
+                    ({'compress_threshold': 1024}, CompressedValue),
+                    ({'store_threshold': 1024}, StoredValue)):
+                encoded = Async.encode_result(result, policy)
+                self.assertTrue(isinstance(encoded, klass))
+                content_type, encoding, data = dumps(encoded, 'tryson')
+                self.assertTrue(len(data) < len(str(result)))
+                self.assertEqual(loads(data, content_type, encoding), result)
+            self.assertEqual(metrics.get('result_compressed'), 1)
+            self.assertEqual(metrics.get('result_stored'), 1)
+
+    def test_map(self):
+        'Test records are mapped in chunks read page by page'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Async = POOL.get('async.async')
+            View = POOL.get('ir.ui.view')
+            views = View.search([], order=[('id', 'ASC')])
+            expected = View.export_data(views, ['name'])
+
+            app.conf.TEST_MODE = True
+            try:
+                result = Async.map(
+                    View.__name__, 'export_data', domain=[], chunk_size=10,
+                    args=[['name']],
+                )
+                by_ids = Async.map(
+                    View, 'export_data', [v.id for v in views],
+                    chunk_size=10, args=[['name']],
+                )
+                # No ids is no records, not all of them
+                self.assertEqual(len(Async.map(View, 'export_data', [])), 0)
+                self.assertRaises(ValueError, Async.map, View, 'export_data')
+            finally:
+                app.conf.TEST_MODE = False
+
+            self.assertEqual(len(result), (len(views) + 9) // 10)
+            self.assertEqual(sum(result.get(), []), expected)
+            self.assertEqual(sum(by_ids.get(), []), expected)
+            self.assertEqual(result.progress(), {
+                'done': len(result), 'failed': 0, 'total': len(result),
+            })
+            self.assertTrue(result.ready())
+
+    def test_map_reduce(self):
+        'Test the reducer is sent once all the chunks of the job are done'
+        View = POOL.get('ir.ui.view')
+        View.reduce_ids = classmethod(lambda cls, results: [
+            [record['id'] for record in chunk] for chunk in results
+        ])
+        executor = executors._executor = InlineExecutor()
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async = POOL.get('async.async')
+                ids = [v.id for v in View.search([], limit=25)]
+                result = Async.map(
+                    View, 'read', ids, chunk_size=10, reducer='reduce_ids',
+                    args=[['name']],
+                )
+                empty = Async.map(View, 'read', [], reducer='reduce_ids')
+            self.assertEqual(len(result), 3)
+            self.assertEqual(result.progress(), {
+                'done': 0, 'failed': 0, 'total': 3,
+            })
+
+            executor.run()
+            self.assertEqual(result.progress(), {
+                'done': 3, 'failed': 0, 'total': 3,
+            })
+            self.assertEqual(len(empty), 0)
+            self.assertEqual(empty.progress()['total'], 0)
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                self.assertEqual(
+                    [len(chunk) for chunk in result.get()], [10, 10, 5]
+                )
+                # The reducer is called with the results of the chunks
+                self.assertEqual(result.reduced.get(), [
+                    [record['id'] for record in chunk]
+                    for chunk in result.get()
+                ])
+                self.assertEqual(empty.reduced.get(), [])
+        finally:
+            executors._executor = None
+            del View.reduce_ids
+
+    def test_thread_executor(self):
+        'Test calls run in a local pool of threads'
+        from trytond_async.executors import ThreadExecutor
+
+        executor = ThreadExecutor(2)
+        # The result exists before the call is submitted
+        pending = executor.result(tasks.collect_payloads, 'pending')
+        self.assertEqual(pending.status, 'PENDING')
+        self.assertFalse(pending.ready())
+
+        result = executor.submit(
+            tasks.collect_payloads, (), task_id='pending'
+        )
+        self.assertTrue(result is pending)
+        self.assertEqual(result.get(timeout=10), 0)
+        self.assertEqual(result.status, 'SUCCESS')
+
+        delayed = executor.submit(tasks.collect_payloads, (), countdown=0.1)
+        self.assertEqual(delayed.get(timeout=10), 0)
+
+        # The finished results are kept once nothing holds them
+        task_id = executor.submit(tasks.collect_payloads, ()).id
+        executor.pool.close()
+        executor.pool.join()
+        gc.collect()
+        self.assertEqual(executor.result(
+            tasks.collect_payloads, task_id
+        ).get(timeout=0), 0)
+
+    def test_local_executor_eta(self):
+        'Test the local executors honour the eta and expires of the calls'
+        from celery.exceptions import TaskRevokedError
+
+        executor = InlineExecutor()
+        now = datetime.datetime.utcnow()
+        later = executor.submit(
+            tasks.collect_payloads, (), eta=now + datetime.timedelta(hours=1)
+        )
+        executor.submit(
+            tasks.collect_payloads, (), eta=now - datetime.timedelta(hours=1)
+        )
+        self.assertEqual(len(executor.pending), 1)
+        self.assertFalse(later.ready())
+
+        expired = executor.submit(
+            tasks.collect_payloads, (),
+            expires=now - datetime.timedelta(minutes=1)
+        )
+        self.assertEqual(expired.status, 'REVOKED')
+        self.assertRaises(TaskRevokedError, expired.get, timeout=0)
+        delayed = executor.submit(
+            tasks.collect_payloads, (), countdown=0.1, expires=0.01
+        )
+        self.assertRaises(TaskRevokedError, delayed.get, timeout=10)
+        self.assertEqual(len(executor.pending), 1)
+
+    @unittest.skipIf(
+        DB_NAME == ':memory:',
+        'The threads do not share the in-memory database'
+    )
+    def test_thread_executor_execute(self):
+        'Test calls of execute run in a pool of threads like on a worker'
+        executor = executors.ThreadExecutor(2)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Async = POOL.get('async.async')
+            View = POOL.get('ir.ui.view')
+            expected = View.search_count([])
+            payload = Async.build_payload(
+                'search_count', View.__name__, args=[[]]
+            )
+            payload['context'] = {}
+            data, options = Async.encode_payload(payload)
+            missing = Async.encode_payload(
+                dict(payload, method_name='nosuchmethod')
+            )
+
+        result = executor.submit(
+            tasks.execute, (DB_NAME, USER, missing[0]), missing[1]
+        )
+        self.assertRaises(AttributeError, result.get, timeout=30)
+        self.assertEqual(result.status, 'FAILURE')
+
+        # Read by its id once the call is done, like a call retried out of
+        # a batch
+        task_id = executor.submit(
+            tasks.execute, (DB_NAME, USER, data), options
+        ).id
+        executor.pool.close()
+        executor.pool.join()
+        gc.collect()
+        result = executor.result(tasks.execute, task_id)
+        self.assertEqual(result.get(timeout=0), expected)
+        self.assertEqual(result.status, 'SUCCESS')
+
+    def test_scheduled(self):
+        'Test long delayed calls are kept in the database until due'
+        executor = executors._executor = ExecutorStub()
+        app.conf.ASYNC_SCHEDULE_THRESHOLD = 60
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async = POOL.get('async.async')
+                Scheduled = POOL.get('async.scheduled')
+                payload = Async.build_payload('search', 'ir.ui.view')
+                payload['context'] = {}
+
+                Async.send_payload(tasks.execute, payload, countdown=10)
+                self.assertEqual(len(executor.submitted), 1)
+                self.assertEqual(Scheduled.search([], count=True), 0)
+
+                results = [
+                    Async.send_payload(tasks.execute, payload, countdown=3600)
+                    for _ in range(3)
+                ]
+                self.assertEqual(len(executor.submitted), 1)
+                self.assertEqual(Scheduled.search([], count=True), 3)
+                self.assertEqual(
+                    metrics.get('calls_scheduled', task=tasks.execute.name),
+                    3
+                )
+
+                # Not due yet
+                self.assertEqual(Scheduled.publish_due(), 0)
+                self.assertEqual(
+                    Scheduled.publish_due(batch_size=2, lookahead=7200), 3
+                )
+                self.assertEqual(Scheduled.search([], count=True), 0)
+                self.assertEqual(
+                    [options['task_id'] for _, _, _, options
+                        in executor.submitted[1:]],
+                    [result.id for result in results]
+                )
+                task, args, _, options = executor.submitted[-1]
+                self.assertEqual(task.name, tasks.execute.name)
+                self.assertEqual(args[0], DB_NAME)
+                self.assertTrue('eta' in options)
+                self.assertEqual(
+                    Async.deserialize_payload(args[2])['method_name'],
+                    'search'
+                )
+        finally:
+            app.conf.ASYNC_SCHEDULE_THRESHOLD = 0
+            executors._executor = None
+
+    def test_context(self):
+        'Test contexts are minimised and sent by fingerprint'
+        app.conf.ASYNC_MINIMISE_CONTEXT = True
+        app.conf.ASYNC_CONTEXT_FINGERPRINT = True
+        context.clear()
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async = POOL.get('async.async')
+                User = POOL.get('res.user')
+                preferences = User.get_preferences(context_only=True)
+                self.assertTrue('language' in preferences)
+
+                payload = Async.build_payload('search', 'ir.ui.view')
+                payload['context'] = dict(preferences, active_test=False)
+                del payload['context']['language']
+                data, options = Async.encode_payload(payload)
+                self.assertFalse('active_test' in data)
+                self.assertTrue(metrics.get('context_bytes_saved') > 0)
+
+                for _ in range(2):
+                    decoded = Async.deserialize_payload(data, **options)
+                    self.assertEqual(decoded['context'], payload['context'])
+                self.assertEqual(metrics.get('context_cache_miss'), 1)
+                self.assertEqual(metrics.get('context_cache_hit'), 1)
+
+                # Only minimised with records
+                payload['context'] = dict(
+                    payload['context'], user=User(USER)
+                )
+                data, options = Async.encode_payload(payload)
+                self.assertFalse('context_fingerprint' in data)
+                decoded = Async.deserialize_payload(data, **options)
+                self.assertEqual(decoded['context'], payload['context'])
+
+                coordination._backend = coordination.LocalBackend()
+                context.clear()
+                payload['context'] = {'active_test': False}
+                data, options = Async.encode_payload(payload)
+                coordination._backend = coordination.LocalBackend()
+                context.clear()
+                self.assertRaises(
+                    context.ContextExpired,
+                    Async.deserialize_payload, data, **options
+                )
+
+                # The next call stores the lost context again
+                Async.encode_payload(payload)
+                coordination._backend = coordination.LocalBackend()
+                data, options = Async.encode_payload(payload)
+                decoded = Async.deserialize_payload(data, **options)
+                self.assertEqual(decoded['context'], payload['context'])
+        finally:
+            app.conf.ASYNC_MINIMISE_CONTEXT = False
+            app.conf.ASYNC_CONTEXT_FINGERPRINT = False
+
+    def test_metrics(self):
+        'Test the phases of the calls are timed and exported'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Async = POOL.get('async.async')
+            View = POOL.get('ir.ui.view')
+            payload = Async.build_payload(
+                'read', 'ir.ui.view',
+                args=[View.search([], limit=3), ['name']]
+            )
+            payload['context'] = {}
+            payload['queued_at'] = time.time()
+            data, options = Async.encode_payload(payload)
+
+        result = tasks.execute.apply((DB_NAME, USER, data), options)
+        self.assertEqual(result.status, 'SUCCESS')
+        labels = {'database': DB_NAME, 'task': 'ir.ui.view.read'}
+        for phase in ('cache_clean', 'deserialize', 'execute', 'commit'):
+            self.assertEqual(metrics.get_histogram(
+                'phase_seconds', phase=phase, **labels
+            )[0], 1)
+        self.assertEqual(
+            metrics.get_histogram('queue_wait_seconds', **labels)[0], 1
+        )
+        self.assertEqual(metrics.get('calls', status='success', **labels), 1)
+        self.assertEqual(metrics.get('records', **labels), 3)
+        self.assertEqual(metrics.get('payload_bytes', **labels), len(data))
+
+        exported = metrics.export()
+        self.assertTrue(
+            '# TYPE trytond_async_phase_seconds histogram\n' in exported
+        )
+        self.assertTrue(
+            'trytond_async_calls_total{database="%s",status="success",'
+            'task="ir.ui.view.read"} 1.0\n' % DB_NAME in exported
+        )
+        self.assertTrue(
+            'trytond_async_queue_wait_seconds_count{database="%s",'
+            'task="ir.ui.view.read"} 1\n' % DB_NAME in exported
+        )
+
+        server = metrics.serve(0)
+        try:
+            response = urllib2.urlopen(
+                'http://127.0.0.1:%d/metrics' % server.server_address[1]
+            )
+            self.assertTrue('trytond_async_calls_total' in response.read())
+        finally:
+            server.shutdown()
+
+    def test_send_after_commit(self):
+        'Test a batch which can not be sent does not fail the commit'
+        executor = executors._executor = ExecutorStub()
+        submit = executor.submit
+
+        def fail_once(*args, **kwargs):
+            executor.submit = submit
+            raise IOError('The broker is down')
+        executor.submit = fail_once
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT) as trans:
+                Async = POOL.get('async.async')
+                for queue in ('a', 'b'):
+                    Async.apply_async(
+                        'search_count', 'ir.ui.view', args=[[]],
+                        after_commit=True, queue=queue,
+                    )
+                trans.cursor.commit()
+        finally:
+            executors._executor = None
+        self.assertEqual(len(executor.submitted), 1)
+        self.assertEqual(executor.submitted[0][3]['queue'], 'b')
+        self.assertEqual(metrics.get('batch_send_failed'), 1)
+
+    def test_send_many_after_commit(self):
+        'Test the calls sent after commit are routed like the others'
+        executor = executors._executor = ExecutorStub()
+        routes = app.conf.ASYNC_ROUTES
+        app.conf.ASYNC_ROUTES = {'ir.ui.view.read': 'views'}
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT) as trans:
+                Async = POOL.get('async.async')
+                result = Async.apply_async_many([
+                    ('ir.ui.view', 'read', None, [[], ['name']], None),
+                    ('ir.ui.view', 'search_count', None, [[]], None),
+                    ('ir.ui.view', 'read', None, [[], ['model']], None),
+                ], after_commit=True, priority=3)
+                self.assertEqual(executor.submitted, [])
+                trans.cursor.commit()
+        finally:
+            executors._executor = None
+            app.conf.ASYNC_ROUTES = routes
+        queues = dict(
+            (celery_options['task_id'], celery_options.get('queue'))
+            for _, _, _, celery_options in executor.submitted
+        )
+        self.assertEqual(len(queues), 2)
+        self.assertEqual(
+            [queues[item.batch_result.id] for item in result],
+            ['views', None, 'views']
+        )
+        for _, _, _, celery_options in executor.submitted:
+            self.assertEqual(celery_options['priority'], 3)
+
+    def test_execute_batch_retry(self):
+        'Test the retried payloads of a batch are sent like the batch'
+        View = POOL.get('ir.ui.view')
+
+        def retry_later(cls):
+            raise tasks.RetryWithDelay(0)
+
+        View.retry_later = classmethod(retry_later)
+        executor = executors._executor = ExecutorStub()
+        routes = app.conf.ASYNC_ROUTES
+        app.conf.ASYNC_ROUTES = {'ir.ui.view.retry_later': 'views'}
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async = POOL.get('async.async')
+                data, options = Async.encode_payload({
+                    'context': {},
+                    'payloads': [
+                        Async.build_payload('retry_later', View),
+                    ],
+                    'queued_at': time.time(),
+                })
+
+            # Applied, the payload is sent by its route
+            result = tasks.execute_batch.apply((DB_NAME, USER, data), options)
+            self.assertEqual(result.result[0]['status'], 'RETRY')
+
+            # Delivered by the broker, it is sent where the batch was
+            tasks.execute_batch.push_request(delivery_info={
+                'exchange': 'async', 'routing_key': 'batches', 'priority': 3,
+            })
+            try:
+                tasks.execute_batch.run(DB_NAME, USER, data, **options)
+            finally:
+                tasks.execute_batch.pop_request()
+        finally:
+            executors._executor = None
+            app.conf.ASYNC_ROUTES = routes
+            del View.retry_later
+        (_, _, _, routed), (_, _, _, delivered) = executor.submitted
+        self.assertEqual(routed['queue'], 'views')
+        self.assertFalse('priority' in routed)
+        self.assertFalse('queue' in delivered)
+        self.assertEqual(delivered['exchange'], 'async')
+        self.assertEqual(delivered['routing_key'], 'batches')
+        self.assertEqual(delivered['priority'], 3)
+
+    def test_execute_batch_rollback(self):
+        'Test the payloads of a batch do not read the rolled back values'
+        Group = POOL.get('res.group')
+
+        def fail_write(cls, groups):
+            cls.write(groups, {'name': 'Rolled back'})
+            [group.name for group in groups]
+            raise ValueError('rolled back')
+
+        Group.fail_write = classmethod(fail_write)
+        Group.get_name = lambda self: self.name
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async = POOL.get('async.async')
+                group, = Group.create([{'name': 'Async batch'}])
+                Transaction().cursor.commit()
+                payloads = [
+                    Async.build_payload('fail_write', Group, args=[[group]]),
+                    Async.build_payload('get_name', instance=group),
+                    Async.build_payload(
+                        'write', Group, args=[[group], {'name': 'Written'}]
+                    ),
+                    Async.build_payload('get_name', instance=group),
+                ]
+                data, options = Async.encode_payload({
+                    'context': {},
+                    'payloads': payloads,
+                    'queued_at': time.time(),
+                })
+
+            result = tasks.execute_batch.apply(
+                (DB_NAME, USER, data), options
+            )
+            self.assertEqual(
+                [item['status'] for item in result.result],
+                ['FAILURE', 'SUCCESS', 'SUCCESS', 'SUCCESS']
+            )
+            self.assertEqual(result.result[1]['result'], 'Async batch')
+            self.assertEqual(result.result[3]['result'], 'Written')
+        finally:
+            del Group.fail_write
+            del Group.get_name
+
+    def test_execute_batch(self):
+        'Test the payloads of a batch succeed or fail on their own'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Async = POOL.get('async.async')
+            payloads = [
+                Async.build_payload(
+                    'create', 'ir.cache',
+                    args=[[{'name': 'trytond_async.batch'}]]
+                ),
+                Async.build_payload('nosuchmethod', 'ir.ui.view'),
+                Async.build_payload('search_count', 'ir.ui.view', args=[[]]),
+            ]
+            data, options = Async.encode_payload({
+                'context': {},
+                'payloads': payloads,
+                'queued_at': time.time(),
+            })
+
+        result = tasks.execute_batch.apply((DB_NAME, USER, data), options)
+        self.assertEqual(result.status, 'SUCCESS')
+        self.assertEqual(
+            [item['status'] for item in result.result],
+            ['SUCCESS', 'FAILURE', 'SUCCESS']
+        )
+        self.assertEqual(result.result[1]['exc_type'], 'AttributeError')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(POOL.get('ir.cache').search_count([
+                ('name', '=', 'trytond_async.batch'),
+            ]), 1)
+            self.assertEqual(
+                result.result[2]['result'],
+                POOL.get('ir.ui.view').search_count([])
+            )
+
+        # The metrics are recorded for each payload
+        for task, status in (
+                ('ir.cache.create', 'success'),
+                ('ir.ui.view.nosuchmethod', 'failure'),
+                ('ir.ui.view.search_count', 'success')):
+            self.assertEqual(metrics.get(
+                'calls', database=DB_NAME, task=task, status=status
+            ), 1)
+            for phase in ('cache_clean', 'deserialize', 'execute', 'commit'):
+                self.assertEqual(metrics.get_histogram(
+                    'phase_seconds', database=DB_NAME, task=task, phase=phase
+                )[0], 1)
+            self.assertEqual(metrics.get_histogram(
+                'queue_wait_seconds', database=DB_NAME, task=task
+            )[0], 1)
+        self.assertEqual(metrics.get(
+            'payload_bytes', database=DB_NAME, task='ir.cache.create'
+        ), len(data) // 3)
+
+    def test_profiling(self):
+        'Test the sampled calls are profiled by model.method'
+        path = tempfile.mkdtemp()
+        app.conf.ASYNC_PROFILE_TASKS = ['ir.ui.view.search']
+        app.conf.ASYNC_PROFILE_PATH = path
+        app.conf.ASYNC_PROFILE_FLUSH_INTERVAL = 0
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                Async = POOL.get('async.async')
+                payloads = [
+                    Async.build_payload(method, 'ir.ui.view', args=[[]])
+                    for method in ('search', 'search_count')
+                ]
+                for payload in payloads:
+                    payload['context'] = {}
+                encoded = [Async.encode_payload(p) for p in payloads]
+
+            for sampler in (False, True):
+                app.conf.ASYNC_PROFILER = 'sampler' if sampler else 'cprofile'
+                profiling.configure()
+                for data, options in encoded:
+                    tasks.execute.apply((DB_NAME, USER, data), options)
+
+            filenames = sorted(os.listdir(path))
+            self.assertEqual(len(filenames), 2)
+            self.assertTrue(filenames[0].startswith('ir.ui.view.search.'))
+            self.assertTrue(filenames[0].endswith('.folded'))
+            self.assertTrue(filenames[1].endswith('.prof'))
+            stats = pstats.Stats(os.path.join(path, filenames[1]))
+            self.assertTrue(stats.total_calls > 0)
+            self.assertEqual(
+                metrics.get('profiled_calls', task='ir.ui.view.search'), 2
+            )
+            self.assertTrue(metrics.get(
+                'profiled_sql_queries', task='ir.ui.view.search'
+            ) > 0)
+            self.assertEqual(metrics.get(
+                'profiled_calls', task='ir.ui.view.search_count'
+            ), 0)
+
+            # The oldest files are removed
+            profiling.hook.max_files = 1
+            profiling.hook.flush()
+            self.assertEqual(len(os.listdir(path)), 1)
+        finally:
+            app.conf.ASYNC_PROFILE_TASKS = []
+            app.conf.ASYNC_PROFILER = 'cprofile'
+            profiling.configure()
+            shutil.rmtree(path)
+        self.assertTrue(profiling.hook is None)
+
+    @unittest.skipIf(aio.asyncio is None, 'trollius is not installed')
+    def test_aio_wait(self):
+        'Test results are awaited in an event loop'
+        from trytond_async.executors import ThreadExecutor
+
+        executor = ThreadExecutor(4)
+        loop = aio.asyncio.new_event_loop()
+        try:
+            results = [
+                executor.submit(tasks.collect_payloads, (), countdown=0.1)
+                for _ in range(100)
+            ]
+            values = loop.run_until_complete(aio.gather(results, loop))
+            self.assertEqual(values, [0] * 100)
+
+            failed = executor.submit(tasks.collect_payloads, (1,))
+            self.assertRaises(
+                TypeError, loop.run_until_complete, aio.wait(failed, loop)
+            )
+
+            # The results of a result backend are polled in batches
+            backend = CacheBackend(app=app, backend='memory')
+            results = [
+                AsyncResult('aio-%d' % i, backend=backend)
+                for i in range(100)
+            ]
+
+            def store():
+                for i, result in enumerate(results):
+                    backend.store_result(result.id, i, 'SUCCESS')
+            loop.call_later(0.1, store)
+            values = loop.run_until_complete(aio.gather(results, loop))
+            self.assertEqual(values, range(100))
+        finally:
+            loop.close()
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestTasks)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())